@@ -2,619 +2,5610 @@ import tkinter as tk
 from tkinter import ttk
 import tkinter.font as tkfont
 import json
+import csv
+import argparse
+import asyncio
 import os
+import sys
+import signal
+import mmap
+import struct
+import base64
+import hashlib
 import re
 import math
+import decimal
+import heapq
+import bisect
+import ast
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict, namedtuple, deque
+from functools import lru_cache
+from urllib.parse import unquote, urlsplit
+
+try:
+    import numpy as np
+except ImportError:  # 数组变量需要 NumPy，未安装时其余功能不受影响
+    np = None
+else:
+    np.seterr(all="ignore")  # 数组除零等情况得到 inf / nan，而不是输出警告
+NDARRAY = np.ndarray if np is not None else None  # 运算结果是否为数组按类型判断（热路径上比 isinstance 快）
+
+# 状态文件路径：二进制工作簿；旧版本保存的 JSON 状态文件仍可读取
+STATE_FILE = "state.vcb"
+LEGACY_STATE_FILE = "state.json"
+# 二进制工作簿：文件头标识，以及 sheet 索引项（数据块偏移、数据块长度、行数）和行长度的编码
+WORKBOOK_MAGIC = b"VCWB0002"
+WORKBOOK_INDEX = struct.Struct("<QQI")
+WORKBOOK_LENGTH = struct.Struct("<I")
+# 各版本文件中每个 sheet 的行数据块（按索引顺序）；索引项的行数为 WORKBOOK_ABSENT 表示没有该数据块
+WORKBOOK_BLOCKS = {b"VCWB0001": ("contents",), b"VCWB0002": ("contents", "results")}
+WORKBOOK_ABSENT = 0xFFFFFFFF
+# 结果缓存：保存各行的计算结果和内容哈希，打开时哈希一致的行直接使用保存的结果
+RESULT_CACHE_VERSION = "1"          # 计算规则变化时修改，使旧的缓存全部失效
+RESULT_CACHE_ARRAY_SIZE = 1000000   # 缓存的数组最多元素个数，更大的数组打开时重新计算
+RESULT_CACHE_SEP = "\x1f"           # 结果缓存各字段的分隔符
+# 自动保存日志：未正常退出时，启动时把日志重放到状态文件之上
+JOURNAL_FILE = "state.journal"
+JOURNAL_FLUSH_MS = 1000          # 编辑后最迟多久写入日志（毫秒）
+JOURNAL_COMPACT_BYTES = 1 << 20  # 日志超过该大小时在后台合并为快照
+COMPACT_POLL_MS = 100            # 检查后台合并是否完成的间隔（毫秒）
+
+# 词法分析：缓存的行数
+TOKEN_CACHE_SIZE = 65536
+# 词法模式：注释（双引号括起来的内容）、跨 sheet 引用（Sheet1!rate，名称不是标识符时加单引号 'My Sheet'!rate）、
+# 数字、变量名、运算符、问号、空白
+TOKEN_PATTERN = re.compile(r"""
+    (?P<comment>"[^"]*")
+  | (?P<xref>(?:'[^'\n]+'|[^\W\d]\w*)![^\W\d]\w*)
+  | (?P<number>(?:\d+(?:\.(?!\.)\d*)?|\.\d+)(?:[eE][+-]?\d+)?[jJ]?)
+  | (?P<name>[^\W\d]\w*)
+  | (?P<op>\*\*|//|==|!=|<=|>=|\.\.|[-+*/%()\[\]<>=,])
+  | (?P<query>[?？])
+  | (?P<space>\s+)
+  | (?P<other>.)
+""", re.VERBOSE)
+# 跨 sheet 引用：引用名为 "sheet 名!变量名"；编译后的表达式中以 XREF_PREFIX 加十六进制编码的参数名访问
+XREF_MARK = "!"
+XREF_PREFIX = "__ref_"
+IDENTIFIER = re.compile(r"[^\W\d]\w*")
+# 粘贴为数组时每个单元格必须是的数字格式
+PASTED_NUMBER = re.compile(r"[+-]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?")
+
+# 后台计算进程池
+POOL_SIZE = max(1, min(16, (os.cpu_count() or 2) - 1))  # 计算进程个数
+ROW_TIMEOUT = 10.0         # 单行最长计算时间（秒），超时后结束计算进程
+SHEET_TIMEOUT = 120.0      # 整个 sheet 最长计算时间（秒），超时后改在界面进程中分片计算
+PARALLEL_MIN_ROWS = 5000   # 工作簿总行数达到该值时，打开时各 sheet 并行计算
+POOL_POLL_MS = 20          # 检查后台计算结果的间隔（毫秒）
+
+# 重算调度：连续输入时合并重算，每帧最多重算一次
+FRAME_MS = 16              # 一帧的间隔（毫秒）
+FRAME_BUDGET = 0.008       # 每帧用于重算的时间（秒）
+MAX_COALESCE_MS = 100      # 连续输入时最多推迟重算的时间（毫秒）
+RESIZE_THROTTLE_MS = 50    # 画布尺寸变化后重新布局的节流间隔（毫秒）
+
+# 行布局（像素）
+ROW_PAD_Y = 3              # 行上下间距
+RESULT_LABEL_PAD = 4       # 结果标签文字之外的宽度
+ADD_BUTTON_SPACE = 40      # 最后一行之后为添加按钮留出的高度
+
+# 字体度量缓存与缩放
+TEXT_WIDTH_CACHE_SIZE = 65536   # 按文本缓存的像素宽度个数
+DEFAULT_FONT_SIZE = 12
+MIN_FONT_SIZE = 6               # 缩放时的字体大小范围
+MAX_FONT_SIZE = 40
+
+# 表达式引擎：编译缓存大小与计算限制
+EVAL_CACHE_SIZE = 4096
+BATCH_CACHE_SIZE = 65536     # 命令行批量计算的编译缓存大小（输入通常远大于界面中的 sheet）
+MAX_EXPR_LENGTH = 10000      # 表达式最大字符数
+MAX_AST_NODES = 5000         # 表达式最大语法节点数
+MAX_INT_BITS = 200000        # 整数运算结果最大位数（约 6 万位十进制）
+MAX_ARRAY_SIZE = 10000000    # 数组最多元素个数
+INLINE_INT_BITS = 20000      # 界面进程中直接计算的整数运算结果最大位数，更大的交给后台进程
+INLINE_ARRAY_SIZE = 100000   # 界面进程中直接计算的数组最多元素个数，更大的交给后台进程
+ARRAY_PREVIEW = 3            # 数组结果首尾各显示的元素个数
+INT_ARRAY_LIMIT = 2 ** 62    # 整数数组元素的绝对值上限，超出时改用浮点数，避免 int64 溢出回绕
+
+# 结果显示：Ctrl+[ / Ctrl+] 减少或增加有效数字位数，Ctrl+Shift+E 切换记数法
+RESULT_DIGITS = 12           # 默认显示的有效数字位数
+MIN_RESULT_DIGITS = 1        # 有效数字位数的范围
+MAX_RESULT_DIGITS = 17
+RESULT_NOTATIONS = {"auto": "自动", "sci": "科学记数法", "eng": "工程记数法"}
+EXACT_INT_DIGITS = 30        # 自动记数法下按原样显示的整数最多位数，更大的整数按有效数字显示
+RESULT_MAX_CHARS = 120       # 结果标签最多显示的字符数，更长的截断（复制时仍得到完整的值）
+
+# 性能分析：F12 开关，Ctrl+F12 导出 trace；设置该环境变量时启动即开启
+PROFILE_ENV = "VARCALC_PROFILE"
+PROFILE_TRACE_EVENTS = 200000              # trace 最多保留的（最近的）事件个数
+PROFILE_SLOWEST = 3                        # 状态栏显示的最慢行个数
+PROFILE_PHASES = ("解析", "计算", "高亮", "布局", "刷新", "日志")  # 状态栏按此顺序显示各阶段
+
+# 符号面板：Ctrl+Shift+F 打开，F3 跳到定义，Shift+F3 查找用法
+SYMBOL_LIST_LIMIT = 200      # 符号列表最多显示的变量个数
+SYMBOL_USAGE_LIMIT = 1000    # 用法列表最多显示的行数
+
+# 撤销/重做：Ctrl+Z 撤销，Ctrl+Y 或 Ctrl+Shift+Z 重做
+UNDO_LIMIT = 1000            # 每个 sheet 最多保留的撤销步数
+UNDO_MAX_CHARS = 1 << 20     # 每个 sheet 的撤销历史最多保存的字符数，超过时丢弃最早的步骤
+UNDO_COALESCE_MS = 1000      # 同一行的连续输入间隔不超过该值（毫秒）时合并为一步
+UNDO_SHEET_STEPS = 50        # 最多保留的 sheet 删除/改名步数（被删除的 sheet 在丢弃该步之前保留在内存中）
+
+# sheet 栏
+SHEET_BAR_HEIGHT = 30        # sheet 栏高度（像素）
+SHEET_TAB_PAD = 10           # sheet 标签中名称两侧的留白（像素）
+SHEET_TAB_GAP = 4            # 相邻 sheet 标签之间的间距（像素）
+SHEET_SCROLL_STEP = 60       # 鼠标滚轮每格横向滚动的像素
+SHEET_SWITCH_LIMIT = 200     # 快速切换列表最多显示的 sheet 个数
+
+# 本地计算服务：python 变量计算器.py serve
+SERVE_HOST = "127.0.0.1"        # 只监听本机
+SERVE_PORT = 8765
+SERVE_MAX_REQUEST = 16 << 20    # 单个请求最大字节数
+WATCH_INTERVAL = 0.5            # 检查状态文件和日志是否变化的间隔（秒）
+
+
+# ================= 表达式引擎 =================
+class EvalError(Exception):
+    """
+    表达式无法计算（语法不支持、变量未定义、超出计算限制等）
+    """
+
+
+class Offload(Exception):
+    """
+    表达式计算量较大，应交给后台进程计算（只由界面进程使用的引擎抛出）
+    """
+
+
+class ExpressionEvaluator:
+    """
+    表达式引擎：把表达式解析为白名单内的 AST，编译成可复用的函数，
+    并按规范化后的表达式文本缓存在有界 LRU 中，热表重算时无需重新解析。
+    乘方和乘法在运行时检查操作数大小，9**9**9 之类的输入会立即报错而不是卡死界面。
+    offload 模式下，大整数、大数组等较重的运算在开始前抛出 Offload，由调用方转交后台进程。
+    """
+
+    BIN_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+    UNARY_OPS = (ast.UAdd, ast.USub)
+    COMPARE_OPS = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+    CONSTANT_TYPES = (int, float, complex)
+
+    def __init__(self, cache_size=EVAL_CACHE_SIZE, offload=False):
+        """
+        :param cache_size: 编译缓存最多保存的表达式数
+        :param offload: 是否对较重的运算抛出 Offload 而不是直接计算
+        """
+        self.cache_size = cache_size
+        self.offload = offload
+        self.builtins = INLINE_BUILTINS if offload else BUILTINS
+        self.cache = OrderedDict()       # 表达式文本 -> 绑定了常量的函数
+        self.templates = OrderedDict()   # 常量替换为参数后的表达式 -> 编译结果
+
+    def evaluate(self, expr, variables):
+        """
+        计算表达式
+        :param expr: 表达式
+        :param variables: 变量字典
+        :return: 计算结果，失败时抛出 EvalError
+        """
+        return self.compile(expr)(variables)
+
+    def compile(self, expr):
+        """
+        取得表达式对应的已编译函数，优先命中缓存
+        :param expr: 表达式
+        :return: 函数 f(variables)
+        """
+        key = " ".join(expr.split())
+        compiled = self.cache.get(key)
+        if compiled is not None:
+            self.cache.move_to_end(key)
+            return compiled
+        compiled = self._specialize(key)
+        self._remember(self.cache, key, compiled)
+        return compiled
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def _specialize(self, expr):
+        """
+        把数字常量提取为参数：只有常量不同的表达式（如 x = 1、x = 2）共用同一份编译结果；
+        只含数字的列表（如粘贴的一列数据 [1 2 3]）整体作为一个常量
+        """
+        parts, literals = [], []
+        tokens = [(m.lastgroup, m.group()) for m in TOKEN_PATTERN.finditer(expr)]
+        i = 0
+        while i < len(tokens):
+            kind, text = tokens[i]
+            if text == "[":
+                end, items = self._number_list(tokens, i)
+                if end is not None:
+                    parts.append(f" __k{len(literals)} ")
+                    literals.append(items)
+                    i = end + 1
+                    continue
+            if kind == "number":
+                parts.append(f" __k{len(literals)} ")
+                literals.append(text)
+            elif kind == "name" and text.startswith("__"):
+                return self._failure(f"不支持的变量名 {text}")
+            elif kind == "xref":
+                parts.append(f" {xref_ident(xref_key(text))} ")
+            else:
+                parts.append(text)
+            i += 1
+        shape = "".join(parts).strip()
+        template = self.templates.get(shape)
+        if template is None:
+            template = self._build(shape)
+            self._remember(self.templates, shape, template)
+        else:
+            self.templates.move_to_end(shape)
+        try:
+            constants = tuple(self._number(text) for text in literals)
+        except ValueError:
+            return self._failure("数值过大")
+        except EvalError as e:
+            return self._failure(str(e))
+        return lambda variables: template(variables, constants)
+
+    @staticmethod
+    def _number_list(tokens, start):
+        """
+        识别只含数字的列表，元素之间用逗号或空白分隔，数字前可带正负号
+        :param tokens: (类型, 文本) 列表
+        :param start: 左方括号的位置
+        :return: (右方括号的位置, 元素文本元组)，不是数字列表时为 (None, None)
+        """
+        items, sign = [], ""
+        for j in range(start + 1, len(tokens)):
+            kind, text = tokens[j]
+            if kind == "number":
+                items.append(sign + text)
+                sign = ""
+            elif text in ("-", "+") and not sign:
+                sign = text
+            elif text == "]" and not sign:
+                return j, tuple(items)
+            elif kind != "space" and not (text == "," and not sign):
+                break
+        return None, None
+
+    @classmethod
+    def _number(cls, text):
+        """
+        把数字字面量转换为数值，数字列表转换为数组
+        """
+        if isinstance(text, tuple):
+            array = make_array([cls._number(item) for item in text])
+            array.flags.writeable = False  # 常量数组在多次计算之间共享
+            return array
+        if text[-1] in "jJ":
+            return complex(text)
+        if "." in text or "e" in text or "E" in text:
+            return float(text)
+        return int(text)
+
+    @staticmethod
+    def _failure(message):
+        """
+        返回一个直接抛出错误的函数，错误同样会被缓存
+        """
+        def fail(variables, constants=None):
+            raise EvalError(message)
+        return fail
+
+    def _build(self, shape):
+        """
+        解析、校验并编译常量已替换为参数的表达式
+        :return: 函数 f(variables, constants)
+        """
+        try:
+            names, count, body = self._parse(shape)
+            # 编译为 lambda 内部函数...: lambda 变量..., 常量...: 表达式，变量以局部变量方式访问
+            params = names + tuple(f"__k{i}" for i in range(count))
+            inner = ast.Lambda(args=self._arguments(params), body=body)
+            outer = ast.Lambda(args=self._arguments(tuple(self.builtins)), body=inner)
+            code = compile(ast.fix_missing_locations(ast.Expression(body=outer)), "<expr>", "eval")
+        except EvalError as e:
+            return self._failure(str(e))
+        except (RecursionError, MemoryError):
+            # 嵌套过深（如 "-" 重复几千次）时遍历和编译会超出递归深度
+            return self._failure("表达式过长")
+        func = eval(code, {"__builtins__": None})(*self.builtins.values())
+        offload = self.offload
+        keys = tuple(ident_key(name) for name in names)   # 变量表中的名称
+
+        def run(variables, constants):
+            try:
+                args = [variables[key] for key in keys]
+            except KeyError as e:
+                raise EvalError(f"未定义的变量 {e.args[0]}")
+            if offload and (any(is_large(v) for v in args) or any(is_large(v) for v in constants)):
+                raise Offload()
+            try:
+                return func(*args, *constants)
+            except (EvalError, Offload):
+                raise
+            except ZeroDivisionError:
+                raise EvalError("除数为零")
+            except OverflowError:
+                raise EvalError("数值溢出")
+            except ValueError as e:
+                if "broadcast" in str(e):
+                    raise EvalError("数组长度不一致")
+                raise EvalError(str(e) or type(e).__name__)
+            except Exception as e:
+                raise EvalError(str(e) or type(e).__name__)
+        return run
+
+    def _parse(self, expr):
+        """
+        解析表达式并检查语法白名单
+        :return: (引用的变量名元组, 常量参数个数, 改写后的 AST)
+        """
+        if not expr:
+            raise EvalError("表达式为空")
+        if len(expr) > MAX_EXPR_LENGTH:
+            raise EvalError("表达式过长")
+        try:
+            tree = ast.parse(self._rewrite(expr), mode="eval")
+        except (SyntaxError, ValueError, RecursionError, MemoryError):
+            raise EvalError("语法错误")
+        names = []
+        constants = 0
+        count = 0
+        for node in ast.walk(tree):
+            count += 1
+            if count > MAX_AST_NODES:
+                raise EvalError("表达式过长")
+            if isinstance(node, ast.Name):
+                if node.id.startswith("__k"):
+                    constants += 1  # 常量参数
+                elif node.id.startswith(XREF_PREFIX):
+                    if node.id not in names:
+                        names.append(node.id)  # 跨 sheet 引用
+                elif node.id.startswith("__"):
+                    pass  # 内部函数，用户输入的 __ 开头变量名已被拒绝
+                elif node.id not in names:
+                    names.append(node.id)
+            elif isinstance(node, ast.Call):
+                if (not isinstance(node.func, ast.Name) or not node.func.id.startswith("__")
+                        or node.keywords or any(isinstance(arg, ast.Starred) for arg in node.args)):
+                    raise EvalError("不支持的函数调用")
+            elif isinstance(node, ast.List):
+                pass
+            elif isinstance(node, ast.Constant):
+                if not isinstance(node.value, self.CONSTANT_TYPES):
+                    raise EvalError("不支持的常量")
+            elif isinstance(node, ast.BinOp):
+                if not isinstance(node.op, self.BIN_OPS):
+                    raise EvalError("不支持的运算符")
+            elif isinstance(node, ast.UnaryOp):
+                if not isinstance(node.op, self.UNARY_OPS):
+                    raise EvalError("不支持的运算符")
+            elif isinstance(node, ast.Compare):
+                if not all(isinstance(op, self.COMPARE_OPS) for op in node.ops):
+                    raise EvalError("不支持的运算符")
+            elif not isinstance(node, (ast.Expression, ast.Load) + self.BIN_OPS + self.UNARY_OPS + self.COMPARE_OPS):
+                raise EvalError("不支持的语法")
+        return tuple(names), constants, _GuardTransformer().visit(tree.body)
+
+    @classmethod
+    def _rewrite(cls, expr):
+        """
+        把范围语法 a..b step c 改写为内部函数调用，函数名改写为内部名称（sum -> __sum）
+        """
+        tokens = [t for t in tokenize_row(expr) if t.kind != "space"]
+        keywords = keyword_positions(tokens)
+        closers = {"(": ")", "[": "]"}
+        stack = [[[]]]   # 每层括号中的参数列表，每个参数是文本片段列表
+        openers = []
+        for i, t in enumerate(tokens):
+            if t.text in closers:
+                openers.append(t.text)
+                stack.append([[]])
+            elif t.text in (")", "]"):
+                if not openers or closers[openers[-1]] != t.text:
+                    raise EvalError("括号不匹配")
+                inner = cls._join_args(stack.pop())
+                stack[-1][-1].append(openers.pop() + inner + t.text)
+            elif t.text == "," and openers:
+                stack[-1].append([])
+            elif i in keywords:
+                stack[-1][-1].append(STEP_MARK if t.text == "step" else "__" + t.text)
+            else:
+                stack[-1][-1].append(t.text)
+        if openers:
+            raise EvalError("括号不匹配")
+        return cls._join_args(stack[0])
+
+    @staticmethod
+    def _join_args(args):
+        """
+        拼接逗号分隔的参数，含 .. 的参数改写为 __range(起点, 终点, 步长)
+        """
+        result = []
+        for pieces in args:
+            if ".." not in pieces:
+                result.append(" ".join(pieces))
+                continue
+            i = pieces.index("..")
+            lo, rest = pieces[:i], pieces[i + 1:]
+            bounds = [lo, rest]
+            if STEP_MARK in rest:
+                j = rest.index(STEP_MARK)
+                bounds = [lo, rest[:j], rest[j + 1:]]
+            if not all(bounds) or any(".." in part for part in bounds):
+                raise EvalError("范围语法错误")
+            result.append("__range(" + ", ".join("(" + " ".join(part) + ")" for part in bounds) + ")")
+        return ", ".join(result)
+
+    @staticmethod
+    def _arguments(names):
+        return ast.arguments(posonlyargs=[], args=[ast.arg(arg=name) for name in names],
+                             kwonlyargs=[], kw_defaults=[], defaults=[])
+
+
+class _GuardTransformer(ast.NodeTransformer):
+    """
+    把乘方、乘法、加减法改写为带大小检查的函数调用
+    """
+    GUARDS = {ast.Pow: "__pow", ast.Mult: "__mul", ast.Add: "__add", ast.Sub: "__sub"}
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        guard = self.GUARDS.get(type(node.op))
+        if guard is None:
+            return node
+        return ast.Call(func=ast.Name(id=guard, ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+
+    def visit_List(self, node):
+        # 列表字面量转换为数组
+        self.generic_visit(node)
+        return ast.Call(func=ast.Name(id="__array", ctx=ast.Load()), args=[node], keywords=[])
+
+
+def guarded_pow(a, b):
+    """
+    带结果大小检查的乘方
+    """
+    if isinstance(a, int) and isinstance(b, int) and b > 0 and abs(a) > 1:
+        if (abs(a).bit_length() - 1) * b > MAX_INT_BITS:
+            raise EvalError("指数过大")
+    result = a ** b
+    if type(result) is NDARRAY:
+        return checked_array(result, np.power, a, b)
+    return result
+
+
+def guarded_mul(a, b):
+    """
+    带结果大小检查的乘法
+    """
+    if isinstance(a, int) and isinstance(b, int):
+        if a.bit_length() + b.bit_length() > MAX_INT_BITS:
+            raise EvalError("数值过大")
+    result = a * b
+    if type(result) is NDARRAY:
+        return checked_array(result, np.multiply, a, b)
+    return result
+
+
+def guarded_add(a, b):
+    """
+    加法：检查整数数组结果是否溢出
+    """
+    result = a + b
+    if type(result) is NDARRAY:
+        return checked_array(result, np.add, a, b)
+    return result
+
+
+def guarded_sub(a, b):
+    """
+    减法：检查整数数组结果是否溢出
+    """
+    result = a - b
+    if type(result) is NDARRAY:
+        return checked_array(result, np.subtract, a, b)
+    return result
+
+
+def checked_array(result, ufunc, a, b):
+    """
+    检查数组运算结果：int64 运算溢出时会静默回绕，所以整数结果再按 float64 算一遍，
+    超出 INT_ARRAY_LIMIT 时改用浮点数结果
+    :param result: 按原类型计算的结果
+    :param ufunc: 对应的 NumPy 函数
+    :param a: 左操作数
+    :param b: 右操作数
+    """
+    if result.dtype.kind in "iu":
+        approx = ufunc(np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64))
+        if not (np.abs(approx) < INT_ARRAY_LIMIT).all():
+            return approx
+    return result
+
+
+def require_numpy():
+    """
+    数组功能需要 NumPy
+    """
+    if np is None:
+        raise EvalError("需要安装 NumPy 才能使用数组")
+
+
+def make_range(lo, hi, step=1):
+    """
+    生成范围数组 lo..hi step step（包含终点）
+    """
+    require_numpy()
+    if not all(isinstance(v, (int, float)) for v in (lo, hi, step)):
+        raise EvalError("范围的起点、终点和步长必须是实数")
+    count = range_size(lo, hi, step)
+    if all(isinstance(v, int) for v in (lo, hi, step)) and max(abs(lo), abs(hi)) < INT_ARRAY_LIMIT:
+        return lo + step * np.arange(count, dtype=np.int64)
+    return lo + step * np.arange(count, dtype=np.float64)
+
+
+def range_size(lo, hi, step):
+    """
+    计算范围数组的元素个数，并检查步长和大小
+    """
+    if step == 0:
+        raise EvalError("步长不能为零")
+    count = max(0, math.floor((hi - lo) / step + 1e-9) + 1)
+    if count > MAX_ARRAY_SIZE:
+        raise EvalError("数组过大")
+    return count
+
+
+def make_array(items):
+    """
+    把列表转换为一维数值数组
+    """
+    require_numpy()
+    if len(items) > MAX_ARRAY_SIZE:
+        raise EvalError("数组过大")
+    try:
+        array = np.array(items)
+        if array.dtype.kind in "uO" or array.dtype.kind == "i" and (np.abs(array) >= INT_ARRAY_LIMIT).any():
+            array = np.array(items, dtype=np.float64)  # 超出 int64 安全范围的整数按浮点数保存
+    except OverflowError:
+        raise EvalError("数值过大")
+    except (ValueError, TypeError):
+        raise EvalError("数组元素必须是数值")
+    if array.ndim != 1:
+        raise EvalError("只支持一维数组")
+    if array.dtype.kind not in "biufc":
+        raise EvalError("数组元素必须是数值")
+    return array
+
+
+def reduce_values(name, args):
+    """
+    对参数中的所有元素做归约（数组按元素展开），结果为标量
+    :param name: sum / mean / max / min
+    :param args: 参数（标量或数组）
+    """
+    if not args:
+        raise EvalError(f"{name} 至少需要一个参数")
+    if np is not None and any(isinstance(a, np.ndarray) for a in args):
+        values = np.concatenate([np.ravel(a) for a in args])
+        if values.size == 0:
+            if name == "sum":
+                return 0
+            raise EvalError("数组为空")
+        if name == "sum" and values.dtype.kind in "iu" and not abs(values.sum(dtype=np.float64)) < INT_ARRAY_LIMIT:
+            return sum(values.tolist())  # int64 求和会溢出，改用 Python 整数精确求和
+        return getattr(np, name)(values).item()
+    if name == "sum":
+        return sum(args)
+    if name == "mean":
+        return sum(args) / len(args)
+    return max(args) if name == "max" else min(args)
+
+
+# 改写范围语法时 step 关键字的占位符（不会与任何词法单元相同）
+STEP_MARK = "..step"
+# 可在表达式中调用的函数
+FUNCTIONS = {name: (lambda *args, name=name: reduce_values(name, args)) for name in ("sum", "mean", "max", "min")}
+# 编译后的表达式可以访问的内部函数（参数名 -> 函数）
+BUILTINS = {"__pow": guarded_pow, "__mul": guarded_mul, "__add": guarded_add, "__sub": guarded_sub,
+            "__range": make_range, "__array": make_array}
+BUILTINS.update(("__" + name, func) for name, func in FUNCTIONS.items())
+
+
+def is_large(value):
+    """
+    判断数值是否大到应交给后台进程计算
+    """
+    if isinstance(value, int):
+        return value.bit_length() > INLINE_INT_BITS
+    return np is not None and isinstance(value, np.ndarray) and value.size > INLINE_ARRAY_SIZE
+
+
+def inline_pow(a, b):
+    """
+    界面进程中的乘方：结果过大时报错，较大时转交后台进程
+    """
+    if isinstance(a, int) and isinstance(b, int) and b > 0 and abs(a) > 1:
+        bits = (abs(a).bit_length() - 1) * b
+        if bits <= MAX_INT_BITS and bits > INLINE_INT_BITS:
+            raise Offload()
+    return guarded_pow(a, b)
+
+
+def inline_mul(a, b):
+    """
+    界面进程中的乘法：结果过大时报错，较大时转交后台进程
+    """
+    if isinstance(a, int) and isinstance(b, int):
+        bits = a.bit_length() + b.bit_length()
+        if bits <= MAX_INT_BITS and bits > INLINE_INT_BITS:
+            raise Offload()
+    return guarded_mul(a, b)
+
+
+def inline_range(lo, hi, step=1):
+    """
+    界面进程中的范围：元素较多时转交后台进程
+    """
+    require_numpy()
+    if all(isinstance(v, (int, float)) for v in (lo, hi, step)) and range_size(lo, hi, step) > INLINE_ARRAY_SIZE:
+        raise Offload()
+    return make_range(lo, hi, step)
+
+
+# 界面进程使用的内部函数：较重的运算抛出 Offload
+INLINE_BUILTINS = dict(BUILTINS, __pow=inline_pow, __mul=inline_mul, __range=inline_range)
+
+
+# 结果的显示方式：有效数字位数和记数法（RESULT_NOTATIONS 中的键）
+ResultStyle = namedtuple("ResultStyle", "digits notation")
+
+
+def leading_digits(value, digits):
+    """
+    把一个非零的数舍入为 digits 位有效数字。大整数只取最高的若干位换算，不做完整的十进制转换，
+    用时与整数大小基本无关，也不受 Python 整数转字符串的位数上限限制
+    :return: (有效数字串（去掉末尾的 0）, 首位数字的十进制指数)
+    """
+    if isinstance(value, float):
+        mantissa, exponent = f"{abs(value):.{digits - 1}e}".split("e")
+        return mantissa.replace(".", "").rstrip("0"), int(exponent)
+    with decimal.localcontext() as ctx:
+        ctx.Emax, ctx.Emin = decimal.MAX_EMAX, decimal.MIN_EMIN
+        # 保留的二进制位远多于需要的精度，舍去的低位不影响结果
+        shift = max(0, value.bit_length() - 4 * digits - 64)
+        ctx.prec = digits + 20
+        number = decimal.Decimal(abs(value) >> shift) * decimal.Decimal(2) ** shift
+        ctx.prec = digits
+        number = +number
+    _, digit_tuple, exponent = number.as_tuple()
+    return "".join(map(str, digit_tuple)).rstrip("0"), exponent + len(digit_tuple) - 1
+
+
+def format_number(value, style):
+    """
+    按有效数字位数和记数法格式化一个数
+    :param value: 整数、浮点数或复数
+    :param style: ResultStyle
+    """
+    if isinstance(value, complex):
+        imag = format_number(abs(value.imag), style)
+        return f"({format_number(value.real, style)}{'-' if value.imag < 0 else '+'}{imag}j)"
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, float) and not math.isfinite(value):
+        return str(value)
+    if isinstance(value, int) and style.notation == "auto" and -10 ** EXACT_INT_DIGITS < value < 10 ** EXACT_INT_DIGITS:
+        return str(value)
+    sign = "-" if value < 0 else ""
+    if value == 0:
+        significant, exponent = "0", 0
+    else:
+        significant, exponent = leading_digits(value, style.digits)
+    if style.notation == "auto" and -5 <= exponent < style.digits:
+        # 按普通小数显示
+        if exponent < 0:
+            text = "0." + "0" * (-exponent - 1) + significant
+        elif len(significant) > exponent + 1:
+            text = significant[:exponent + 1] + "." + significant[exponent + 1:]
+        else:
+            text = significant + "0" * (exponent + 1 - len(significant))
+            if isinstance(value, float):
+                text += ".0"
+        return sign + text
+    lead = 1
+    if style.notation == "eng":
+        # 工程记数法：指数为 3 的倍数
+        lead += exponent % 3
+        exponent -= exponent % 3
+    significant = significant.ljust(lead, "0")
+    mantissa = significant[:lead] + ("." + significant[lead:] if len(significant) > lead else "")
+    return f"{sign}{mantissa}e{'-' if exponent < 0 else '+'}{abs(exponent):02d}"
+
+
+def format_value(value, style=None):
+    """
+    把计算结果格式化为显示文本；数组显示元素个数和首尾几个元素
+    :param value: 结果
+    :param style: ResultStyle；为 None 时按原样显示（命令行的文本输出），
+                  给定时按有效数字显示，用时和文本长度与数的大小无关（界面的结果标签）
+    """
+    if np is not None and isinstance(value, np.generic):
+        value = value.item()
+    show = str if style is None else (lambda v: format_number(v, style))
+    if np is not None and isinstance(value, np.ndarray):
+        if value.size <= 2 * ARRAY_PREVIEW:
+            preview = ", ".join(show(v) for v in value.tolist())
+        else:
+            head = ", ".join(show(v) for v in value[:ARRAY_PREVIEW].tolist())
+            tail = ", ".join(show(v) for v in value[-ARRAY_PREVIEW:].tolist())
+            preview = f"{head}, …, {tail}"
+        return f"[{preview}]（{value.size} 个）"
+    if style is not None:
+        return format_number(value, style)
+    # 命令行输出完整的值，整数不受 Python 整数转字符串的位数上限限制
+    return full_value_text(value)
+
+
+def full_value_text(value):
+    """
+    结果的完整文本（复制结果和命令行输出使用）：整数不受 Python 整数转字符串的位数上限限制，
+    浮点数保留全部精度，数组列出所有元素
+    """
+    if np is not None and isinstance(value, np.generic):
+        value = value.item()
+    if np is not None and isinstance(value, np.ndarray):
+        return "[" + ", ".join(full_value_text(v) for v in value.tolist()) + "]"
+    if isinstance(value, int) and not isinstance(value, bool) and hasattr(sys, "set_int_max_str_digits"):
+        limit = sys.get_int_max_str_digits()
+        sys.set_int_max_str_digits(0)
+        try:
+            return str(value)
+        finally:
+            sys.set_int_max_str_digits(limit)
+    return str(value)
+
+
+def describe_result(kind, name, ok, value, error, style=None):
+    """
+    生成一行结果的显示文本（界面的结果标签和命令行的文本输出共用）
+    :param kind: 行类型
+    :param name: 定义的变量名
+    :param ok: 是否计算成功
+    :param value: 结果
+    :param error: 失败的原因
+    :param style: 结果的显示方式，见 format_value
+    """
+    if kind == "empty":
+        return "= ?"
+    if not ok:
+        return f"= 错误：{error}" if error else "= 错误"
+    if kind == "assign":
+        return f"= {name} → {format_value(value, style)}"
+    return f"= {format_value(value, style)}"
+
+
+# ================= 词法分析 =================
+Token = namedtuple("Token", "kind text start end")
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def tokenize_row(text):
+    """
+    把一行文本切分为词法单元，按行文本缓存；注释高亮、计算表达式和变量引用都由它得出
+    :param text: 行文本
+    :return: Token 元组
+    """
+    return tuple(Token(m.lastgroup, m.group(), m.start(), m.end()) for m in TOKEN_PATTERN.finditer(text))
+
+
+def comment_spans(text):
+    """
+    返回行内注释的位置
+    :param text: 行文本
+    :return: [(起始偏移, 结束偏移), ...]
+    """
+    return [(t.start, t.end) for t in tokenize_row(text) if t.kind == "comment"]
+
+
+def _join_tokens(tokens):
+    return "".join(t.text for t in tokens).strip()
+
+
+def keyword_positions(tokens):
+    """
+    找出不是变量引用的名字：函数调用的函数名（sum(...)）以及范围中的 step
+    :param tokens: Token 序列
+    :return: 下标集合
+    """
+    result = set()
+    significant = [i for i, t in enumerate(tokens) if t.kind not in ("space", "comment")]
+    ranges = [0]   # 每层括号中当前参数的范围状态：0 无，1 已出现 ..，2 已出现 step
+    for pos, i in enumerate(significant):
+        t = tokens[i]
+        if t.text in ("(", "["):
+            ranges.append(0)
+        elif t.text in (")", "]"):
+            if len(ranges) > 1:
+                ranges.pop()
+        elif t.text == ",":
+            ranges[-1] = 0
+        elif t.text == "..":
+            ranges[-1] = 1
+        elif t.kind == "name":
+            following = tokens[significant[pos + 1]].text if pos + 1 < len(significant) else None
+            if t.text in FUNCTIONS and following == "(":
+                result.add(i)
+            elif t.text == "step" and ranges[-1] == 1:
+                ranges[-1] = 2
+                result.add(i)
+    return result
+
+
+def _references(tokens):
+    """
+    返回表达式引用的变量名（跨 sheet 引用为 "sheet 名!变量名"）
+    """
+    names = frozenset(t.text for t in tokens if t.kind == "name")
+    if "step" in names or not names.isdisjoint(FUNCTIONS):
+        keywords = keyword_positions(tokens)
+        names = frozenset(t.text for i, t in enumerate(tokens) if t.kind == "name" and i not in keywords)
+    if any(t.kind == "xref" for t in tokens):
+        names |= frozenset(xref_key(t.text) for t in tokens if t.kind == "xref")
+    return names
+
+
+def xref_key(text):
+    """
+    把跨 sheet 引用的文本（Sheet1!rate 或 'My Sheet'!rate）转换为引用名 "sheet 名!变量名"
+    """
+    title, _, name = text.rpartition(XREF_MARK)
+    if title.startswith("'"):
+        title = title[1:-1]
+    return f"{title}{XREF_MARK}{name}"
+
+
+def split_ref(key):
+    """
+    把引用名拆分为 (sheet 名, 变量名)
+    """
+    title, _, name = key.rpartition(XREF_MARK)
+    return title, name
+
+
+def sheet_ref(title, name):
+    """
+    生成跨 sheet 引用的文本，sheet 名不是标识符时加单引号
+    """
+    if not IDENTIFIER.fullmatch(title):
+        title = f"'{title}'"
+    return f"{title}{XREF_MARK}{name}"
+
+
+def rename_sheet_refs(text, old, new):
+    """
+    把行文本中对 sheet old 的引用改为引用 sheet new（注释中的内容不变）
+    :return: 新的行文本
+    """
+    parts = []
+    for t in tokenize_row(text):
+        if t.kind == "xref":
+            title, name = split_ref(xref_key(t.text))
+            if title == old:
+                parts.append(sheet_ref(new, name))
+                continue
+        parts.append(t.text)
+    return "".join(parts)
+
+
+def xref_ident(key):
+    """
+    引用名 -> 编译后表达式中的参数名
+    """
+    return XREF_PREFIX + key.encode("utf-8").hex()
+
+
+def ident_key(ident):
+    """
+    编译后表达式中的参数名 -> 变量表中的名称
+    """
+    if ident.startswith(XREF_PREFIX):
+        return bytes.fromhex(ident[len(XREF_PREFIX):]).decode("utf-8")
+    return ident
+
+
+@lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def parse_row(text):
+    """
+    解析一行内容
+    :param text: 行文本
+    :return: (类型, 定义的变量名, 待计算表达式, 引用的变量名集合)，类型为 empty / assign / expr
+    """
+    # 去掉注释
+    tokens = [t for t in tokenize_row(text) if t.kind != "comment"]
+    significant = [i for i, t in enumerate(tokens) if t.kind != "space"]
+    if not significant:
+        return "empty", None, "", frozenset()
+    # 以问号结尾为查询：去掉结尾的问号和等号，例如 A + B = ?
+    if tokens[significant[-1]].kind == "query":
+        while significant and tokens[significant[-1]].kind == "query":
+            significant.pop()
+        if significant and tokens[significant[-1]].text == "=":
+            significant.pop()
+        body = tokens[:significant[-1] + 1] if significant else []
+        return "expr", None, _join_tokens(body), _references(body)
+    # 包含等号则为变量赋值
+    for i in significant:
+        if tokens[i].text == "=":
+            value = tokens[i + 1:]
+            return "assign", _join_tokens(tokens[:i]), _join_tokens(value), _references(value)
+    # 否则为表达式计算
+    return "expr", None, _join_tokens(tokens), _references(tokens)
+
+
+# ================= 依赖图 =================
+
+
+def same_value(a, b):
+    """
+    判断两个计算结果是否相同，用于决定是否需要向下游传播
+    """
+    if a is b:
+        return True
+    if np is not None and isinstance(a, np.ndarray):
+        return (isinstance(b, np.ndarray) and a.shape == b.shape and a.dtype == b.dtype
+                and bool(np.array_equal(a, b)))
+    try:
+        return type(a) is type(b) and bool(a == b)
+    except Exception:
+        return False
+
+
+# 行在等待上游的后台计算结果
+WAITING = 0
+
+
+class RowState:
+    """
+    单行的解析与计算结果缓存
+    """
+    __slots__ = ("text", "index", "parsed", "kind", "name", "expr", "refs", "value", "ok", "error", "job",
+                 "lines", "width", "layout_key", "display")
+
+    def __init__(self, text=""):
+        self.text = text
+        self.index = 0
+        self.parsed = None        # 解析结果对应的行文本，文本未变时重算无需重新解析
+        self.kind = "empty"
+        self.name = None          # 赋值行定义的变量名
+        self.expr = ""            # 去掉注释后的待计算表达式
+        self.refs = frozenset()   # 引用的变量名
+        self.value = None
+        self.ok = False           # 是否计算成功
+        self.error = None         # 计算失败的原因
+        self.job = None           # 后台计算的任务号，WAITING 表示等待上游结果，None 表示不在计算中
+        # 布局缓存（由界面计算）
+        self.lines = 1            # 输入框行数
+        self.width = 0            # 输入框宽度（字符数）
+        self.layout_key = None    # 上次布局时的 (文本, 结果, 画布宽度)
+        self.display = None       # 上次生成的结果文本 (结果, 行状态与显示方式, 文本)
+
+
+class SheetGraph:
+    """
+    单个 sheet 的依赖图：记录哪些行定义了哪些变量、哪些行读取了它们。
+    变量引用总是解析到它上方最近一次成功的定义，因此下游行一定在定义行之后，
+    按行号升序重算即为拓扑序。
+    """
+
+    def __init__(self, evaluate, submit=None, cancel=None, index=None):
+        """
+        :param evaluate: 计算函数 evaluate(expr, variables)，失败时抛出 EvalError，需要后台计算时抛出 Offload
+        :param submit: 提交后台计算 submit(node, expr, variables)，返回任务号
+        :param cancel: 取消后台计算 cancel(任务号)
+        :param index: 工作簿索引，用于解析跨 sheet 引用；为 None 时跨 sheet 引用视为未定义
+        """
+        self.evaluate = evaluate
+        self.submit = submit
+        self.cancel = cancel
+        self.index = index
+        self.rows = []
+        self.definers = {}   # 变量名 -> 按行号排序的（成功的）定义行列表
+        self.readers = {}    # 变量名 -> 按行号排序的读取行列表
+        self.dirty = set()   # 待重算的行
+        self._heap = None    # 待重算行的最小堆（按行号），结构变化后置空并按需重建
+        self.timer = None    # 性能分析开启时的计时回调 timer(行, 开始时间, 解析用时, 计算用时)
+
+    # ---------- 结构修改 ----------
+    def insert(self, index, text=""):
+        """
+        在指定位置插入一行
+        :param index: 行号
+        :param text: 行文本
+        """
+        node = RowState(text)
+        self.rows.insert(index, node)
+        self._renumber(index)
+        self.dirty.add(node)
+        return node
+
+    def insert_many(self, index, texts):
+        """
+        在指定位置批量插入多行，只重新编号一次
+        :param index: 行号
+        :param texts: 各行文本
+        :return: 新插入的行列表
+        """
+        nodes = [RowState(text) for text in texts]
+        self.rows[index:index] = nodes
+        self._renumber(index)
+        self.dirty.update(nodes)
+        return nodes
+
+    def delete(self, index):
+        """
+        删除指定行，并把依赖它的下游行标记为待重算
+        :param index: 行号
+        """
+        node = self.rows[index]
+        if self._defines(node):
+            self._propagate(node.name, node.index)
+        self._cancel(node)
+        self._unlink(node)
+        self.dirty.discard(node)
+        del self.rows[index]
+        self._renumber(index)
+
+    def delete_many(self, index, count):
+        """
+        批量删除从 index 开始的 count 行，只重新编号一次
+        :param index: 行号
+        :param count: 行数
+        """
+        removed = self.rows[index:index + count]
+        for node in removed:
+            if self._defines(node):
+                self._propagate(node.name, node.index)
+            self._cancel(node)
+            self._unlink(node)
+        del self.rows[index:index + count]
+        self.dirty.difference_update(removed)
+        self._renumber(index)
+
+    def set_text(self, index, text):
+        """
+        修改指定行的文本，内容未变时不做任何事
+        :param index: 行号
+        :param text: 新文本
+        :return: 内容是否发生变化
+        """
+        node = self.rows[index]
+        if node.text == text:
+            return False
+        node.text = text
+        self._mark(node)
+        return True
+
+    def alive(self, node):
+        """
+        判断行是否仍在表中（未被删除）
+        :param node: 行
+        """
+        return node.index < len(self.rows) and self.rows[node.index] is node
+
+    def invalidate_all(self):
+        """
+        把所有行标记为待重算
+        """
+        self.dirty.update(self.rows)
+        self._heap = None
+
+    def variables(self):
+        """
+        返回整张表计算完毕后的变量表（自上而下，后定义的覆盖先定义的）
+        """
+        result = {}
+        for node in self.rows:
+            if node.kind == "assign" and node.ok:
+                result[node.name] = node.value
+        return result
+
+    # ---------- 重算 ----------
+    def recalculate(self, deadline=None, targets=None):
+        """
+        按拓扑序重算待重算的行及其下游行，未受影响的行保留缓存结果
+        :param deadline: 截止时间（time.perf_counter），超时后剩余的行留待下次重算
+        :param targets: 优先的行（正在编辑的行和可见行）：先按行号顺序重算它们的上游闭包，
+                        其余的行再按行号顺序重算；先算的行若上游随后变化，会被重新标记并再算一次
+        :return: 被重算的行号列表（升序）
+        """
+        if self._heap is None:
+            self._heap = [(node.index, id(node), node) for node in self.dirty]
+            heapq.heapify(self._heap)
+        heap = self._heap
+        touched = []
+        if targets and self.dirty:
+            for node in self.upstream_closure(targets, deadline) or ():
+                if deadline is not None and touched and time.perf_counter() > deadline:
+                    break
+                if node in self.dirty:
+                    self.dirty.discard(node)
+                    self._evaluate(node)
+                    touched.append(node.index)
+        while heap:
+            if deadline is not None and touched and time.perf_counter() > deadline:
+                break  # 时间片用完：剩余的行留在堆中，下次继续
+            _, _, node = heapq.heappop(heap)
+            if node not in self.dirty:
+                continue  # 已在优先的行中算过
+            self.dirty.discard(node)
+            if not self.alive(node):
+                continue  # 已被删除
+            self._evaluate(node)
+            touched.append(node.index)
+        if targets:
+            touched = sorted(set(touched))
+        return touched
+
+    def upstream_closure(self, targets, deadline=None):
+        """
+        求若干行的上游闭包：它们直接或间接引用的变量在上方最近的定义行，
+        以及上方待重算、新文本中定义这些变量的行
+        :param targets: 行列表
+        :param deadline: 截止时间；待重算的行太多、超时前来不及解析时返回 None（按行号顺序重算）
+        :return: 闭包中仍在表中的行（按行号升序），或 None
+        """
+        targets = [node for node in targets if self.alive(node)]
+        if not targets:
+            return []
+        limit = max(node.index for node in targets)
+        # 待重算的行按新文本定义的变量分组（parse_row 有缓存，随后重算时不会重复解析）
+        pending = {}
+        for node in self.dirty:
+            if node.index < limit and self.alive(node):
+                if deadline is not None and time.perf_counter() > deadline:
+                    return None
+                name = node.name if node.parsed == node.text else parse_row(node.text)[1]
+                if name is not None:
+                    pending.setdefault(name, []).append(node)
+        closure = set(targets)
+        todo = list(targets)
+        while todo:
+            node = todo.pop()
+            refs = node.refs if node.parsed == node.text else parse_row(node.text)[3]
+            for ref in refs:
+                if XREF_MARK in ref:
+                    continue  # 其他 sheet 的行由它们自己的依赖图重算
+                definer = self._resolve(ref, node.index)
+                floor = -1 if definer is None else definer.index
+                found = [d for d in pending.get(ref, ()) if floor < d.index < node.index]
+                if definer is not None:
+                    found.append(definer)
+                for definer in found:
+                    if definer not in closure:
+                        closure.add(definer)
+                        todo.append(definer)
+        return sorted(closure, key=lambda node: node.index)
+
+    def _evaluate(self, node):
+        """
+        重新解析并计算一行，更新定义索引；定义发生变化时把下游行标记为待重算
+        """
+        old_name, old_ok, old_value, old_busy = node.name, node.ok, node.value, node.job is not None
+        old_defines = self._defines(node)
+        if self.timer is None:
+            self._reparse(node)
+            self._compute(node)
+        else:
+            started = time.perf_counter()
+            self._reparse(node)
+            parsed = time.perf_counter()
+            self._compute(node)
+            self.timer(node, started, parsed - started, time.perf_counter() - parsed)
+        # 只有成功（或仍在计算中）的定义才能被引用
+        defines = self._defines(node)
+        if old_defines and (node.name != old_name or not defines):
+            self._remove_sorted(self.definers, old_name, node)
+        if defines and (node.name != old_name or not old_defines):
+            self._add_sorted(self.definers, node.name, node)
+        # 定义发生变化时，通知读取该变量的下游行
+        if node.name != old_name:
+            if old_defines:
+                self._propagate(old_name, node.index)
+            if defines:
+                self._propagate(node.name, node.index)
+        elif node.name is not None and (node.ok != old_ok or (node.job is not None) != old_busy or
+                                        (node.ok and not same_value(node.value, old_value))):
+            self._propagate(node.name, node.index)
+
+    def complete(self, node, job, ok, value, error=None):
+        """
+        后台计算完成后写入结果，并通知下游行；行已被修改或删除时忽略过期结果
+        :param node: 行
+        :param job: 任务号
+        :param ok: 是否计算成功
+        :param value: 计算结果
+        :param error: 失败原因
+        :return: 结果是否被采用
+        """
+        if node.job != job or not self.alive(node):
+            return False
+        node.job = None
+        node.value, node.ok, node.error = value, ok, error
+        if node.name is not None:
+            if not ok:
+                self._remove_sorted(self.definers, node.name, node)
+            self._propagate(node.name, node.index)
+        return True
+
+    def load_results(self, results):
+        """
+        写入在其他进程中算好的整表结果（行文本必须与计算时一致），并重建定义/引用索引
+        :param results: 各行的 (是否成功, 结果, 错误)
+        """
+        if self.index is not None:
+            self.index.drop_symbols(self)
+        self.definers = {}
+        self.readers = {}
+        self.dirty.clear()
+        self._heap = None
+        for node, (ok, value, error) in zip(self.rows, results):
+            self._cancel(node)
+            node.kind, node.name, node.expr, node.refs = parse_row(node.text)
+            node.parsed = node.text
+            node.ok, node.value, node.error = ok, value, error
+            for ref in node.refs:
+                self.readers.setdefault(ref, []).append(node)
+                if XREF_MARK in ref:
+                    self.dirty.add(node)  # 计算进程看不到其他 sheet，引用其他 sheet 的行在本地重算
+            if self._defines(node):
+                self.definers.setdefault(node.name, []).append(node)
+        if self.index is not None:
+            self.index.rewatch(self)
+            self.index.changed_sheet(self)
+
+    def cache_entries(self):
+        """
+        生成各行的结果缓存，字段为：内容哈希、定义的变量名（赋值行以 = 开头）、引用的变量名、编码后的结果
+        （计算失败的行为空）。哈希由行文本和它引用的各变量的定义行的哈希组成，上游任何一行变化都会改变下游的哈希。
+        :return: 各行的缓存文本，待重算、计算中或结果无法缓存的行为空字符串
+        """
+        latest = {}   # 变量名 -> 上方最近一次成功定义的哈希，None 表示不确定
+        entries = []
+        for node in self.rows:
+            if node in self.dirty:
+                name, digest = parse_row(node.text)[1], None
+            else:
+                name = node.name
+                digest = row_hash(node.text, node.refs, latest) if node.kind != "empty" and node.job is None else None
+            entry = ""
+            if digest is not None:
+                payload = encode_result(node.value) if node.ok else ""
+                if payload is None or (name is not None and RESULT_CACHE_SEP in name):
+                    digest = None
+                else:
+                    entry = RESULT_CACHE_SEP.join((digest, "" if name is None else "=" + name,
+                                                   ",".join(sorted(node.refs)), payload))
+            entries.append(entry)
+            if name is not None:
+                if digest is None:
+                    latest[name] = None
+                elif node.ok:
+                    latest[name] = digest
+        return entries
+
+    def load_cache(self, entries):
+        """
+        载入保存的结果缓存：哈希与当前内容一致的行直接采用保存的结果（无需解析），其余的行标记为待重算。
+        保存时失败的行仍会重算（以得到错误原因），但不影响下游行使用缓存。
+        :param entries: cache_entries 生成的各行缓存文本
+        :return: 采用缓存结果的行数
+        """
+        if self.index is not None:
+            self.index.drop_symbols(self)
+        self.definers = {}
+        self.readers = {}
+        self.dirty.clear()
+        self._heap = None
+        latest = {}
+        restored = 0
+        for node in self.rows:
+            entry = entries[node.index] if node.index < len(entries) else ""
+            self._cancel(node)
+            node.value, node.ok, node.error = None, False, None
+            fields = entry.split(RESULT_CACHE_SEP)
+            ok = None   # None 表示不确定是否成功
+            if len(fields) == 4:
+                digest, name, refs, payload = fields
+                refs = frozenset(refs.split(",")) if refs else frozenset()
+                if row_hash(node.text, refs, latest) != digest:
+                    ok = None
+                elif not payload:
+                    ok = False
+                else:
+                    try:
+                        node.value = decode_result(payload)
+                        ok = True
+                    except (ValueError, TypeError, EvalError):
+                        pass
+            if ok:
+                # 保存的解析结果与行文本一致（哈希包含行文本），表达式在重算时才重新解析
+                node.kind, node.name = ("assign", name[1:]) if name else ("expr", None)
+                node.expr, node.refs, node.ok, node.parsed = "", refs, True, None
+                restored += 1
+            else:
+                node.kind, node.name, node.expr, node.refs = parse_row(node.text)
+                node.parsed = node.text
+                if node.kind != "empty":
+                    self.dirty.add(node)
+            for ref in node.refs:
+                self.readers.setdefault(ref, []).append(node)
+            if node.name is not None:
+                if ok:
+                    self.definers.setdefault(node.name, []).append(node)
+                    latest[node.name] = digest
+                elif ok is None:
+                    latest[node.name] = None
+        if self.index is not None:
+            self.index.rewatch(self)
+        return restored
+
+    def cancel_all(self):
+        """
+        取消所有后台计算，被取消的行标记为待重算
+        """
+        for node in self.rows:
+            if node.job is not None:
+                self._cancel(node)
+                self._mark(node)
+
+    def mark_readers(self, name):
+        """
+        把读取 name 的所有行标记为待重算（用于其他 sheet 中的定义发生变化）
+        :return: 是否有行被标记
+        """
+        readers = self.readers.get(name, ())
+        for node in readers:
+            self._mark(node)
+        return bool(readers)
+
+    def last_definer(self, name):
+        """
+        返回变量最后一次成功（或仍在计算中）的定义，即其他 sheet 引用到的定义
+        """
+        lst = self.definers.get(name)
+        return lst[-1] if lst else None
+
+    def upstream(self, node):
+        """
+        返回一行引用的各变量当前的定义行
+        :return: [(依赖图, 定义行), ...]
+        """
+        result = []
+        for ref in node.refs:
+            found = self.definition(ref, node.index)
+            if found is not None:
+                result.append(found)
+        return result
+
+    def definition(self, ref, index):
+        """
+        返回 index 行读取 ref 时用到的定义：上方最近一次成功的定义，跨 sheet 引用为目标 sheet 中最后一次成功的定义
+        :return: (依赖图, 定义行)，没有时为 None
+        """
+        if XREF_MARK in ref:
+            return self.index.lookup(ref) if self.index is not None else None
+        definer = self._resolve(ref, index)
+        return (self, definer) if definer is not None else None
+
+    def _reparse(self, node):
+        """
+        重新解析行文本，并同步依赖图中的定义/引用关系
+        """
+        if node.parsed == node.text:
+            return
+        kind, name, expr, refs = parse_row(node.text)
+        node.parsed = node.text
+        node.name = name
+        if refs != node.refs:
+            for ref in node.refs - refs:
+                self._remove_sorted(self.readers, ref, node)
+            for ref in refs - node.refs:
+                self._add_sorted(self.readers, ref, node)
+            node.refs = refs
+        node.kind = kind
+        node.expr = expr
+
+    def _compute(self, node):
+        """
+        用上方各变量的当前定义计算一行
+        """
+        self._cancel(node)
+        node.error = None
+        if node.kind == "empty":
+            node.value, node.ok = None, False
+            return
+        variables = {}
+        for ref in node.refs:
+            if XREF_MARK not in ref:
+                definer = self._resolve(ref, node.index)
+            elif self.index is None:
+                continue
+            else:
+                try:
+                    definer = self.index.resolve(ref, self, node)
+                except EvalError as e:
+                    node.value, node.ok, node.error = None, False, str(e)
+                    return
+            if definer is None:
+                continue
+            if definer.job is not None:
+                # 上游还在计算，等它的结果
+                node.value, node.ok, node.job = None, False, WAITING
+                return
+            variables[ref] = definer.value
+        try:
+            value = self.evaluate(node.expr, variables)
+        except Offload:
+            node.value, node.ok = None, False
+            node.job = self.submit(node, node.expr, variables)
+            return
+        except EvalError as e:
+            value, node.error = None, str(e)
+        except Exception:
+            value = None
+        node.value, node.ok = value, value is not None
+
+    def _resolve(self, name, index):
+        """
+        查找 index 行上方最近一次成功（或仍在计算中）的定义
+        :return: 定义行，没有时为 None
+        """
+        lst = self.definers.get(name)
+        if not lst:
+            return None
+        pos = self._bisect(lst, index) - 1
+        return lst[pos] if pos >= 0 else None
+
+    def _propagate(self, name, index):
+        """
+        把 index 行之后、下一次成功定义之前（含）读取 name 的行加入重算队列，并通知引用它的其他 sheet
+        """
+        if self.index is not None:
+            self.index.changed(self, name)
+        readers = self.readers.get(name)
+        if not readers:
+            return
+        lst = self.definers.get(name, ())
+        pos = self._bisect(lst, index + 1)
+        limit = lst[pos].index if pos < len(lst) else len(self.rows)
+        for pos in range(self._bisect(readers, index + 1), len(readers)):
+            node = readers[pos]
+            if node.index > limit:
+                break
+            self._mark(node)
+
+    def _mark(self, node):
+        """
+        标记一行待重算；堆有效时同时入堆
+        """
+        if node not in self.dirty:
+            self.dirty.add(node)
+            if self._heap is not None:
+                heapq.heappush(self._heap, (node.index, id(node), node))
+
+    # ---------- 内部工具 ----------
+    def _unlink(self, node):
+        """
+        从依赖图中移除一行的定义与引用
+        """
+        if self._defines(node):
+            self._remove_sorted(self.definers, node.name, node)
+        for ref in node.refs:
+            self._remove_sorted(self.readers, ref, node)
+
+    @staticmethod
+    def _defines(node):
+        """
+        行是否提供变量定义：计算成功或仍在计算中
+        """
+        return node.name is not None and (node.ok or node.job is not None)
+
+    def _cancel(self, node):
+        """
+        取消行的后台计算
+        """
+        if node.job is not None and node.job != WAITING:
+            self.cancel(node.job)
+        node.job = None
+
+    def _add_sorted(self, table, name, node):
+        """
+        把行按行号顺序加入 table[name]
+        """
+        lst = table.get(name)
+        if lst is None:
+            lst = table[name] = []
+            if self.index is not None:
+                if XREF_MARK not in name:
+                    self.index.add_symbol(name, self)
+                elif table is self.readers:
+                    self.index.watch(name, self)
+        if not lst or lst[-1].index < node.index:
+            lst.append(node)
+        else:
+            lst.insert(self._bisect(lst, node.index), node)
+
+    def _remove_sorted(self, table, name, node):
+        """
+        从 table[name] 中移除行，列表为空时删除该变量名
+        """
+        lst = table.get(name)
+        if lst is None:
+            return
+        pos = self._bisect(lst, node.index)
+        if pos < len(lst) and lst[pos] is node:
+            del lst[pos]
+        else:
+            lst.remove(node)
+        if not lst:
+            del table[name]
+            if self.index is not None:
+                if XREF_MARK not in name:
+                    if name not in self.definers and name not in self.readers:
+                        self.index.remove_symbol(name, self)
+                elif table is self.readers:
+                    self.index.unwatch(name, self)
+
+    def _renumber(self, start):
+        """
+        从 start 开始重新编号；行号变化后堆中的顺序失效，需要重建
+        """
+        for i in range(start, len(self.rows)):
+            self.rows[i].index = i
+        self._heap = None
+
+    @staticmethod
+    def _bisect(lst, index):
+        """
+        在按行号排序的列表中查找第一个行号 >= index 的位置
+        """
+        lo, hi = 0, len(lst)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if lst[mid].index < index:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class WorkbookIndex:
+    """
+    工作簿范围的跨 sheet 引用索引：sheet 名 -> 依赖图（定义），"sheet 名!变量名" -> 读取它的依赖图（被依赖）。
+    行级的定义/引用关系仍由各依赖图维护，索引负责解析跨 sheet 引用，并只把变化转发给引用了该变量的 sheet。
+    跨 sheet 引用解析为目标 sheet 中该变量最后一次成功的定义。
+    另外记录每个变量名出现在哪些 sheet 中（随各依赖图的定义/引用表增量更新），供符号面板查找定义和用法。
+    """
+
+    def __init__(self, open_sheet=None, touched=None):
+        """
+        :param open_sheet: 按名称载入尚未建立依赖图的 sheet：open_sheet(名称)，返回依赖图，没有该 sheet 时返回 None
+        :param touched: 依赖图中有行因其他 sheet 而被重算或标记为待重算时调用 touched(依赖图)
+        """
+        self.open_sheet = open_sheet
+        self.touched = touched
+        self.sheets = {}     # sheet 名 -> 依赖图（重名时为先登记的）
+        self.titles = {}     # 依赖图 -> sheet 名
+        self.watchers = {}   # "sheet 名!变量名" -> 读取它的依赖图集合
+        self.busy = set()    # 正在重算、等待所引用 sheet 算完的依赖图
+        self.symbols = {}    # 变量名 -> 定义或读取它的依赖图集合（不含跨 sheet 引用）
+        self._folded = None  # (按小写排序的变量名的小写形式, 变量名)，变量名增减后置空并在查找时重建
+        self._links = None   # sheet 之间的引用关系（依赖图 -> 它引用的依赖图集合），变化后置空并按需重建
+
+    # ---------- 登记 ----------
+    def add(self, title, graph):
+        """
+        登记一个 sheet 的依赖图，并通知此前引用该名称（未定义）的行
+        """
+        self.titles[graph] = title
+        self.sheets.setdefault(title, graph)
+        self._links = None
+        self.changed_sheet(graph)
+
+    def remove(self, graph):
+        """
+        移除被删除的 sheet，引用它的行重算后显示为未定义
+        """
+        for key in [key for key, graphs in self.watchers.items() if graph in graphs]:
+            self.unwatch(key, graph)
+        self.drop_symbols(graph)
+        title = self.titles.get(graph)
+        if title is None:
+            return
+        self.changed_sheet(graph)
+        del self.titles[graph]
+        self._release(title, graph)
+
+    def rename(self, graph, title):
+        """
+        sheet 改名：新旧名称的引用行都需要重新解析
+        """
+        old = self.titles.get(graph)
+        if old is None or old == title:
+            return
+        self.changed_sheet(graph)
+        self._release(old, graph)
+        self.titles[graph] = title
+        self.sheets.setdefault(title, graph)
+        self.changed_sheet(graph)
+
+    def _release(self, title, graph):
+        """
+        名称不再指向 graph；有重名的 sheet 时改为指向它
+        """
+        if self.sheets.get(title) is graph:
+            del self.sheets[title]
+            for other, other_title in self.titles.items():
+                if other_title == title and other is not graph:
+                    self.sheets[title] = other
+                    break
+        self._links = None
+
+    def watch(self, key, graph):
+        """
+        记录 graph 中有行读取 key
+        """
+        self.watchers.setdefault(key, set()).add(graph)
+        self._links = None
+
+    def unwatch(self, key, graph):
+        """
+        graph 中不再有行读取 key
+        """
+        graphs = self.watchers.get(key)
+        if graphs is not None:
+            graphs.discard(graph)
+            if not graphs:
+                del self.watchers[key]
+        self._links = None
+
+    def rewatch(self, graph):
+        """
+        依赖图整体重建定义/引用表后，重新登记它读取的跨 sheet 引用和出现的变量名
+        """
+        for key in [key for key, graphs in self.watchers.items() if graph in graphs]:
+            self.unwatch(key, graph)
+        for key in graph.readers:
+            if XREF_MARK in key:
+                self.watch(key, graph)
+            else:
+                self.add_symbol(key, graph)
+        for name in graph.definers:
+            self.add_symbol(name, graph)
+
+    # ---------- 符号 ----------
+    def add_symbol(self, name, graph):
+        """
+        记录 graph 中有行定义或读取 name
+        """
+        graphs = self.symbols.get(name)
+        if graphs is None:
+            graphs = self.symbols[name] = set()
+            self._folded = None
+        graphs.add(graph)
+
+    def remove_symbol(self, name, graph):
+        """
+        graph 中不再有行定义或读取 name
+        """
+        graphs = self.symbols.get(name)
+        if graphs is not None:
+            graphs.discard(graph)
+            if not graphs:
+                del self.symbols[name]
+                self._folded = None
+
+    def drop_symbols(self, graph):
+        """
+        依赖图被删除或即将整体重建定义/引用表：移除它出现的所有变量名
+        """
+        for table in (graph.definers, graph.readers):
+            for name in table:
+                if XREF_MARK not in name:
+                    self.remove_symbol(name, graph)
+
+    def find_symbols(self, pattern, limit=SYMBOL_LIST_LIMIT):
+        """
+        查找名称包含 pattern 的变量（不区分大小写），以 pattern 开头的排在前面
+        :return: 变量名列表，最多 limit 个
+        """
+        if self._folded is None:
+            names = sorted(self.symbols, key=lambda name: (name.lower(), name))
+            self._folded = ([name.lower() for name in names], names)
+        folded, names = self._folded
+        pattern = pattern.strip().lower()
+        # 以 pattern 开头的变量名在排序后的列表中是连续的一段
+        result = []
+        for pos in range(bisect.bisect_left(folded, pattern), len(folded)):
+            if len(result) >= limit or not folded[pos].startswith(pattern):
+                break
+            result.append(names[pos])
+        if len(result) < limit:
+            for key, name in zip(folded, names):
+                if pattern in key and not key.startswith(pattern):
+                    result.append(name)
+                    if len(result) >= limit:
+                        break
+        return result
+
+    def occurrences(self, name):
+        """
+        变量在整个工作簿中出现的位置：各 sheet 中定义（成功的定义）和读取它的行，以及其他 sheet 中以跨 sheet 引用读取它的行
+        :return: {依赖图: [(行, 是否为定义), ...]}，各列表按行号排序
+        """
+        found = {}
+        for graph in self.symbols.get(name, ()):
+            marks = found.setdefault(graph, {})
+            for node in graph.definers.get(name, ()):
+                marks[node] = True
+            for node in graph.readers.get(name, ()):
+                marks.setdefault(node, False)
+            title = self.titles.get(graph)
+            if title is not None and self.sheets.get(title) is graph:
+                key = f"{title}{XREF_MARK}{name}"
+                for reader in self.watchers.get(key, ()):
+                    reader_marks = found.setdefault(reader, {})
+                    for node in reader.readers.get(key, ()):
+                        reader_marks.setdefault(node, False)
+        return {graph: sorted(marks.items(), key=lambda item: item[0].index) for graph, marks in found.items() if marks}
+
+    # ---------- 解析 ----------
+    def lookup(self, key):
+        """
+        查找引用当前指向的定义，不做任何计算
+        :return: (依赖图, 定义行)，没有时为 None
+        """
+        title, name = split_ref(key)
+        target = self.sheets.get(title)
+        definer = target.last_definer(name) if target is not None else None
+        return (target, definer) if definer is not None else None
+
+    def resolve(self, key, graph, node):
+        """
+        解析 graph 中 node 行的跨 sheet 引用：目标 sheet 还有待重算的行时先把它算完
+        （目标正在重算时使用它当前的结果，之后的变化会再通知到这里）
+        :return: 定义行，没有时为 None；sheet 不存在或形成循环引用时抛出 EvalError
+        """
+        title, name = split_ref(key)
+        target = self.sheets.get(title)
+        if target is None and self.open_sheet is not None:
+            target = self.open_sheet(title)
+        if target is None:
+            raise EvalError(f"未定义的 sheet {title}")
+        if target.dirty and target is not graph and target not in self.busy:
+            self.busy.add(graph)
+            try:
+                target.recalculate()
+            finally:
+                self.busy.discard(graph)
+            if self.touched is not None:
+                self.touched(target)
+        definer = target.last_definer(name)
+        if definer is not None and self._cycle(target, definer, graph, node):
+            raise EvalError("循环引用")
+        # 成环的各行都算不出结果，因而都不是成功的定义：按行文本检查环，不把它当作未定义
+        if definer is None and self._reaches(target, graph) and self._text_cycle(target, name, node):
+            raise EvalError("循环引用")
+        return definer
+
+    def _cycle(self, target, definer, graph, node):
+        """
+        判断 definer 是否（经由其他 sheet）依赖 node 本身；只有 sheet 之间的引用成环时才需要逐行检查
+        """
+        if not self._reaches(target, graph):
+            return False
+        stack = [(target, definer)]
+        seen = set()
+        while stack:
+            owner, row = stack.pop()
+            if row is node:
+                return True
+            if row in seen:
+                continue
+            seen.add(row)
+            stack.extend(owner.upstream(row))
+        return False
+
+    def _text_cycle(self, target, name, node):
+        """
+        按行文本（不论各行是否计算成功）判断 target 中 name 的最后一次赋值是否（经由其他 sheet）依赖 node 本身
+        """
+        assigned = {}   # 依赖图 -> {变量名: 按行号排序的赋值行}，按需建立
+        start = self._assigner(target, name, None, assigned)
+        stack = [(target, start)] if start is not None else []
+        seen = set()
+        while stack:
+            owner, row = stack.pop()
+            if row is node:
+                return True
+            if row in seen:
+                continue
+            seen.add(row)
+            refs = row.refs if row.parsed == row.text else parse_row(row.text)[3]
+            for ref in refs:
+                if XREF_MARK in ref:
+                    title, ref_name = split_ref(ref)
+                    other = self.sheets.get(title)
+                    found = self._assigner(other, ref_name, None, assigned) if other is not None else None
+                else:
+                    other = owner
+                    found = self._assigner(owner, ref, row.index, assigned)
+                if found is not None:
+                    stack.append((other, found))
+        return False
+
+    @staticmethod
+    def _assigner(graph, name, index, assigned):
+        """
+        graph 中 index 行上方（index 为 None 时为整张表中）最后一个给 name 赋值的行，不论是否计算成功
+        :param assigned: 各依赖图的赋值行表缓存
+        """
+        table = assigned.get(graph)
+        if table is None:
+            table = assigned[graph] = {}
+            for row in graph.rows:
+                row_name = row.name if row.parsed == row.text else parse_row(row.text)[1]
+                if row_name is not None:
+                    table.setdefault(row_name, []).append(row)
+        rows = table.get(name)
+        if not rows:
+            return None
+        pos = len(rows) if index is None else SheetGraph._bisect(rows, index)
+        return rows[pos - 1] if pos > 0 else None
+
+    def _reaches(self, source, target):
+        """
+        sheet 之间的引用关系中，source 是否（间接）引用 target
+        """
+        if self._links is None:
+            self._links = {}
+            for key, graphs in self.watchers.items():
+                referenced = self.sheets.get(split_ref(key)[0])
+                if referenced is not None:
+                    for reader in graphs:
+                        self._links.setdefault(reader, set()).add(referenced)
+        stack, seen = [source], {source}
+        while stack:
+            current = stack.pop()
+            if current is target:
+                return True
+            for nxt in self._links.get(current, ()):
+                if nxt not in seen:
+                    seen.add(nxt)
+                    stack.append(nxt)
+        return False
+
+    # ---------- 变化通知 ----------
+    def changed(self, graph, name):
+        """
+        graph 中 name 的定义发生变化：把其他 sheet 中读取它的行标记为待重算
+        """
+        if not self.watchers:
+            return
+        title = self.titles.get(graph)
+        if title is not None and self.sheets.get(title) is graph:
+            self._notify(f"{title}{XREF_MARK}{name}")
+
+    def changed_sheet(self, graph):
+        """
+        graph 的所有定义都可能发生变化（登记、改名、删除、整表载入结果）
+        """
+        title = self.titles.get(graph)
+        if title is None:
+            return
+        prefix = title + XREF_MARK
+        for key in [key for key in self.watchers if key.startswith(prefix) and XREF_MARK not in key[len(prefix):]]:
+            self._notify(key)
+
+    def _notify(self, key):
+        for reader in list(self.watchers.get(key, ())):
+            if reader.mark_readers(key) and self.touched is not None:
+                self.touched(reader)
+
+
+# ================= 结果缓存 =================
+def row_hash(text, refs, latest):
+    """
+    计算一行的内容哈希
+    :param text: 行文本
+    :param refs: 引用的变量名
+    :param latest: 变量名 -> 上方最近一次成功定义的哈希（None 表示不确定）
+    :return: 十六进制哈希，引用的变量定义不确定或引用其他 sheet 时为 None
+    """
+    parts = [RESULT_CACHE_VERSION, text]
+    for ref in sorted(refs):
+        if XREF_MARK in ref:
+            return None  # 引用其他 sheet 的行每次打开时重算
+        if ref in latest:
+            if latest[ref] is None:
+                return None
+            parts.append(f"{ref}={latest[ref]}")
+        else:
+            parts.append(ref)  # 上方没有定义
+    return hashlib.blake2b("\0".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def encode_result(value):
+    """
+    把计算结果无损地编码为文本
+    :return: 文本，无法缓存的结果为 None
+    """
+    if isinstance(value, bool):
+        return "b1" if value else "b0"
+    if isinstance(value, int):
+        return "i" + format(value, "x")
+    if isinstance(value, float):
+        return "f" + value.hex()
+    if isinstance(value, complex):
+        return f"c{value.real.hex()},{value.imag.hex()}"
+    if np is not None and isinstance(value, np.ndarray):
+        if value.ndim != 1 or value.dtype.kind not in "biufc" or value.size > RESULT_CACHE_ARRAY_SIZE:
+            return None
+        return f"a{value.dtype.str}:" + base64.b64encode(value.tobytes()).decode("ascii")
+    return None
+
+
+def decode_result(text):
+    """
+    解码 encode_result 生成的文本，格式错误时抛出 ValueError
+    """
+    tag, body = text[:1], text[1:]
+    if tag == "b":
+        return body == "1"
+    if tag == "i":
+        return int(body, 16)
+    if tag == "f":
+        return float.fromhex(body)
+    if tag == "c":
+        real, imag = body.split(",")
+        return complex(float.fromhex(real), float.fromhex(imag))
+    if tag == "a":
+        require_numpy()
+        dtype, data = body.split(":", 1)
+        return np.frombuffer(base64.b64decode(data), dtype=np.dtype(dtype)).copy()
+    raise ValueError("未知的结果类型")
+
+
+# ================= 后台计算 =================
+_worker_evaluator = None
+
+
+def worker_evaluator():
+    """
+    计算进程中的表达式引擎（不转交后台，直接计算）
+    """
+    global _worker_evaluator
+    if _worker_evaluator is None:
+        _worker_evaluator = ExpressionEvaluator()
+    return _worker_evaluator
+
+
+def evaluate_expression(expr, variables):
+    """
+    计算进程任务：计算一个表达式
+    """
+    return worker_evaluator().evaluate(expr, variables)
+
+
+def evaluate_sheet(texts):
+    """
+    计算进程任务：计算整个 sheet
+    :param texts: 各行文本
+    :return: 各行的 (是否成功, 结果, 错误)
+    """
+    graph = SheetGraph(worker_evaluator().evaluate)
+    graph.insert_many(0, texts)
+    graph.recalculate()
+    return [(node.ok, node.value, node.error) for node in graph.rows]
+
+
+def worker_main(conn):
+    """
+    计算进程：逐个接收 (任务号, 任务函数, 参数)，返回 (任务号, 是否成功, 结果, 错误)
+    :param conn: 与界面进程之间的连接
+    """
+    while True:
+        try:
+            job, func, args = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            conn.send((job, True, func(*args), None))
+        except EvalError as e:
+            conn.send((job, False, None, str(e)))
+        except Exception as e:
+            conn.send((job, False, None, str(e) or type(e).__name__))
+
+
+class EvalPool:
+    """
+    后台计算进程池：每个进程一次执行一个任务（计算一行或整个 sheet）；
+    超时或被取消的任务直接结束其进程，需要时再启动新的进程
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        """
+        :param size: 进程个数上限
+        """
+        self.size = size
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = []       # [进程, 连接, 正在执行的任务号或 None, 开始时间, 超时]
+        self.queue = deque()    # 等待执行的 (任务号, 任务函数, 参数, 超时)
+        self.callbacks = {}     # 未完成的任务号 -> 回调 callback(任务号, 是否成功, 结果, 错误)
+        self.failed = []        # 无法发送给计算进程的任务
+        self.next_job = 1
+
+    def submit(self, func, args, callback, timeout=ROW_TIMEOUT):
+        """
+        提交一个计算任务
+        :param func: 任务函数（模块级函数，在计算进程中执行 func(*args)）
+        :param args: 参数
+        :param callback: 完成后的回调 callback(任务号, 是否成功, 结果, 错误)
+        :param timeout: 最长计算时间（秒）
+        :return: 任务号
+        """
+        job = self.next_job
+        self.next_job += 1
+        self.callbacks[job] = callback
+        self.queue.append((job, func, args, timeout))
+        self._dispatch()
+        return job
+
+    def cancel(self, job):
+        """
+        取消任务：还在排队的直接丢弃，正在计算的结束其进程
+        """
+        if self.callbacks.pop(job, None) is None:
+            return
+        for worker in self.workers:
+            if worker[2] == job:
+                self._stop(worker)
+                break
+        self._dispatch()
+
+    def busy(self):
+        """
+        是否还有未完成的任务
+        """
+        return bool(self.callbacks or self.failed)
+
+    def poll(self):
+        """
+        收取已完成的结果并检查超时，结果通过回调交给调用方（在界面线程中调用）
+        """
+        now = time.perf_counter()
+        done, self.failed = self.failed, []
+        for worker in list(self.workers):
+            process, conn, job, started, timeout = worker
+            if job is None:
+                continue
+            try:
+                if conn.poll():
+                    done.append(conn.recv())
+                    worker[2] = None
+                    continue
+            except (EOFError, OSError):
+                pass
+            else:
+                if process.is_alive() and now - started <= timeout:
+                    continue
+                if process.is_alive():
+                    self._stop(worker)
+                    done.append((job, False, None, "计算超时"))
+                    continue
+            self._stop(worker)
+            done.append((job, False, None, "计算进程异常退出"))
+        self._dispatch()
+        for job, ok, value, error in done:
+            callback = self.callbacks.pop(job, None)
+            if callback is not None:
+                callback(job, ok, value, error)
+
+    def shutdown(self):
+        """
+        结束所有计算进程
+        """
+        for worker in list(self.workers):
+            self._stop(worker)
+        self.queue.clear()
+        self.callbacks.clear()
+
+    def _dispatch(self):
+        """
+        把排队的任务分配给空闲的进程，进程不足时启动新进程
+        """
+        while self.queue:
+            job, func, args, timeout = self.queue[0]
+            if job not in self.callbacks:
+                self.queue.popleft()  # 已取消
+                continue
+            worker = next((w for w in self.workers if w[2] is None), None)
+            if worker is None:
+                if len(self.workers) >= self.size:
+                    return
+                try:
+                    worker = self._start()
+                except Exception:
+                    self.queue.popleft()
+                    self.failed.append((job, False, None, "无法启动计算进程"))
+                    continue
+            self.queue.popleft()
+            try:
+                worker[1].send((job, func, args))
+            except Exception:
+                self._stop(worker)
+                self.failed.append((job, False, None, "无法发送给计算进程"))
+                continue
+            worker[2], worker[3], worker[4] = job, time.perf_counter(), timeout
+
+    def _start(self):
+        parent, child = self.context.Pipe()
+        process = self.context.Process(target=worker_main, args=(child,), daemon=True)
+        process.start()
+        child.close()
+        worker = [process, parent, None, 0.0, None]
+        self.workers.append(worker)
+        return worker
+
+    def _stop(self, worker):
+        process, conn = worker[0], worker[1]
+        if process.is_alive():
+            process.terminate()
+            process.join(0.5)
+        conn.close()
+        self.workers.remove(worker)
+
+
+# ================= 性能分析 =================
+class Profiler:
+    """
+    可选的性能分析：按阶段累计最近一次操作（重算、打开、保存）的用时和次数，记录其中最慢的行，
+    并保留最近的事件用于导出 Chrome trace（chrome://tracing、Perfetto 可直接打开）。
+    关闭时 start() 返回 None、stop() 直接返回，依赖图也不设置计时回调
+    """
+
+    def __init__(self, titles):
+        """
+        :param titles: 依赖图 -> sheet 名（工作簿索引的 titles）
+        """
+        self.titles = titles
+        self.enabled = False
+        self.origin = time.perf_counter()
+        self.events = deque(maxlen=PROFILE_TRACE_EVENTS)  # (阶段, 开始时间, 用时, 参数)
+        self.spent = 0.0                                  # 已记录的各行自身用时之和
+        self.finished = deque(maxlen=PROFILE_TRACE_EVENTS)  # 已记录的行：(结束时间, 记录前的 spent)
+        self.order = 0
+        self.begin()
+
+    def begin(self, name="重算"):
+        """
+        开始统计新的一次操作，状态栏显示最近一次的统计
+        :param name: 操作名称；同名的阶段用时即为整个操作的用时
+        """
+        self.name = name
+        self.phases = {}    # 阶段 -> [用时, 次数]
+        self.slowest = []   # 最慢的行：(计算用时, 序号, 依赖图, 行) 的小顶堆
+
+    def start(self):
+        """
+        :return: 开始时间，关闭时为 None
+        """
+        return time.perf_counter() if self.enabled else None
+
+    def stop(self, phase, started, count=1):
+        """
+        结束一个阶段的计时
+        :param phase: 阶段名
+        :param started: start() 的返回值
+        :param count: 该阶段处理的个数
+        """
+        if started is not None:
+            self.record(phase, started, time.perf_counter() - started, count)
+
+    def record(self, phase, started, elapsed, count=1, args=None, own=None):
+        """
+        记录一个事件
+        :param own: 计入阶段用时的自身用时，默认为 elapsed（trace 中的事件总是包含嵌套的用时）
+        """
+        total = self.phases.get(phase)
+        if total is None:
+            total = self.phases[phase] = [0.0, 0]
+        total[0] += elapsed if own is None else own
+        total[1] += count
+        self.events.append((phase, started, elapsed, args))
+
+    def row(self, graph, node, started, parse, compute):
+        """
+        记录一行的解析和计算用时（依赖图的计时回调）。
+        跨 sheet 引用可能在计算这一行时先重算被引用的 sheet，那些行已单独记录，不计入这一行的用时
+        """
+        before = self.spent
+        for finished, spent in reversed(self.finished):
+            if finished <= started:
+                break
+            before = spent
+        own = compute - (self.spent - before)
+        args = {"sheet": self.titles.get(graph), "row": node.index + 1}
+        self.record("解析", started, parse, 1, args)
+        self.record("计算", started + parse, compute, 1, args, own=own)
+        self.finished.append((time.perf_counter(), before))
+        self.spent += parse + own
+        self.order += 1
+        entry = (own, self.order, graph, node)
+        if len(self.slowest) < PROFILE_SLOWEST:
+            heapq.heappush(self.slowest, entry)
+        elif own > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def summary(self):
+        """
+        状态栏显示的摘要：总用时、各阶段用时、计算行数和最慢的行
+        """
+        phases = self.phases
+        if self.name in phases:
+            total = phases[self.name][0]
+        else:
+            total = sum(phases[phase][0] for phase in PROFILE_PHASES if phase in phases)
+        parts = [f"{self.name} {total * 1000:.1f} ms"]
+        for phase in PROFILE_PHASES:
+            if phase in phases:
+                elapsed, count = phases[phase]
+                parts.append(f"{phase} {count} 行 {elapsed * 1000:.1f} ms" if phase == "计算"
+                             else f"{phase} {elapsed * 1000:.1f} ms")
+        slowest = []
+        for compute, _, graph, node in sorted(self.slowest, reverse=True):
+            if graph.alive(node):
+                slowest.append(f"{self.titles.get(graph, '?')} 第 {node.index + 1} 行 {compute * 1000:.1f} ms")
+        if slowest:
+            parts.append("最慢：" + "、".join(slowest))
+        return " · ".join(parts)
+
+    def export(self, path):
+        """
+        把保留的事件写成 Chrome trace JSON 文件
+        :param path: 文件路径
+        """
+        pid = os.getpid()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "VarCalc"}}]
+        for phase, started, elapsed, args in list(self.events):
+            event = {"name": phase, "cat": "varcalc", "ph": "X", "pid": pid, "tid": 0,
+                     "ts": round((started - self.origin) * 1e6, 1), "dur": round(elapsed * 1e6, 1)}
+            if args:
+                event["args"] = args
+            events.append(event)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+
+# ================= 自动保存日志 =================
+def read_journal(path):
+    """
+    读取日志记录；最后一行可能因异常退出而不完整，遇到无法解析的行即停止
+    :param path: 日志文件路径
+    :return: 记录列表
+    """
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+    return records
+
+
+def replay_journal(state, records):
+    """
+    把日志记录按顺序应用到状态数据上，跳过快照已包含的记录
+    :param state: 状态数据（会被修改）
+    :param records: 日志记录
+    :return: 最后一条记录的序号
+    """
+    seq = state.get("seq", 0)
+    tabs = state.setdefault("tabs", [])
+    for record in records:
+        if record["seq"] <= seq:
+            continue
+        op = record["op"]
+        try:
+            if op == "add_sheet":
+                # 撤销删除 sheet 时带有位置和内容
+                tabs.insert(record.get("sheet", len(tabs)), {"title": record["title"], "contents": record.get("contents", [])})
+            elif op == "rename_sheet":
+                tabs[record["sheet"]]["title"] = record["title"]
+            elif op == "delete_sheet":
+                del tabs[record["sheet"]]
+            else:
+                sheet = tabs[record["sheet"]]
+                contents = sheet["contents"] = list(sheet["contents"])
+                # 结果缓存与行保持对齐；修改过的行哈希不再一致，打开时会重算
+                results = sheet["results"] = list(sheet.get("results", ()))
+                row = record["row"]
+                if op == "insert":
+                    contents[row:row] = record["texts"]
+                    results[row:row] = [""] * len(record["texts"])
+                elif op == "delete":
+                    count = record.get("count", 1)
+                    del contents[row:row + count]
+                    del results[row:row + count]
+                elif op == "set":
+                    contents[row] = record["text"]
+        except (IndexError, KeyError):
+            break  # 日志与快照不一致，之后的记录无法应用
+        seq = record["seq"]
+    state["seq"] = seq
+    return seq
+
+
+def write_snapshot(state, path=STATE_FILE):
+    """
+    原子地写入状态快照：先写临时文件并落盘，再替换状态文件
+    :param state: 状态数据
+    :param path: 文件路径，按扩展名决定使用 JSON 还是二进制工作簿格式
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(encode_state(state, path))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+# ================= 工作簿文件 =================
+# 二进制工作簿格式（整数均为小端）：
+#   WORKBOOK_MAGIC
+#   u32 元数据长度 + 元数据 JSON（状态数据去掉各 sheet 的行数据块，其余字段原样保存）
+#   u32 sheet 个数 + 每个 sheet 的每种行数据块一个索引项（u64 数据块偏移, u64 数据块长度, u32 行数）
+#   各数据块：每行为 u32 字节数 + UTF-8 文本
+# 行数据块见 WORKBOOK_BLOCKS：contents 为各行文本，results 为各行的结果缓存
+class BinaryWorkbook:
+    """
+    以 mmap 打开的二进制工作簿：打开时只读取文件头，各 sheet 的行在第一次访问时才解码
+    """
+
+    def __init__(self, path):
+        """
+        :param path: 文件路径
+        """
+        self.path = os.path.abspath(path)
+        self.file = open(path, "rb")
+        try:
+            stat = os.fstat(self.file.fileno())
+            self.stamp = (stat.st_size, stat.st_mtime_ns)
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.file.close()
+            raise
+        try:
+            self.meta, self.index = self._read_header()
+        except (struct.error, ValueError):
+            self.close()
+            raise ValueError("不是有效的工作簿文件")
+
+    def _read_header(self):
+        buf = self.map
+        self.blocks = WORKBOOK_BLOCKS.get(bytes(buf[:len(WORKBOOK_MAGIC)]))
+        if self.blocks is None:
+            raise ValueError("文件标识不匹配")
+        pos = len(WORKBOOK_MAGIC)
+        (size,) = WORKBOOK_LENGTH.unpack_from(buf, pos)
+        pos += WORKBOOK_LENGTH.size
+        meta = json.loads(buf[pos:pos + size].decode("utf-8"))
+        pos += size
+        (count,) = WORKBOOK_LENGTH.unpack_from(buf, pos)
+        pos += WORKBOOK_LENGTH.size
+        if len(meta.get("tabs", [])) != count:
+            raise ValueError("sheet 个数不一致")
+        width = len(self.blocks)
+        index = [[WORKBOOK_INDEX.unpack_from(buf, pos + (i * width + j) * WORKBOOK_INDEX.size) for j in range(width)]
+                 for i in range(count)]
+        return meta, index
+
+    def state(self):
+        """
+        返回状态数据，各 sheet 的行数据块（contents 等）为延迟解码的 SheetRows
+        """
+        state = dict(self.meta)
+        state["tabs"] = []
+        for sheet, entries in zip(self.meta["tabs"], self.index):
+            sheet = dict(sheet)
+            for field, (offset, length, count) in zip(self.blocks, entries):
+                if count != WORKBOOK_ABSENT:
+                    sheet[field] = SheetRows(self, offset, length, count)
+            state["tabs"].append(sheet)
+        return state
+
+    def decode(self, offset, length, count):
+        """
+        解码一个 sheet 的数据块
+        :return: 行文本列表
+        """
+        return list(self.iter_rows(offset, length, count))
+
+    def iter_rows(self, offset, length, count):
+        """
+        逐行解码一个 sheet 的数据块，不保留已解码的行
+        :return: 生成器，逐个产生行文本
+        """
+        buf = self.map
+        end = offset + length
+        if end > len(buf):
+            raise ValueError("数据块超出文件范围")
+        pos = offset
+        unpack = WORKBOOK_LENGTH.unpack_from
+        for _ in range(count):
+            (size,) = unpack(buf, pos)
+            pos += 4
+            yield buf[pos:pos + size].decode("utf-8")
+            pos += size
+        if pos != end:
+            raise ValueError("数据块长度不一致")
+
+    def close(self):
+        """
+        关闭文件映射；之后只能访问已经解码过的 sheet
+        """
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = None
+
+
+class SheetRows:
+    """
+    二进制工作簿中一个 sheet 的行：行数可以直接取得，行文本在第一次访问时才解码。
+    发送给计算进程时只传文件位置，由计算进程自己读取和解码。
+    """
+
+    def __init__(self, workbook, offset, length, count):
+        self.workbook = workbook
+        self.offset = offset
+        self.length = length
+        self.count = count
+        self.rows = None
+
+    def decode(self):
+        """
+        解码并缓存行文本
+        """
+        if self.rows is None:
+            self.rows = self.workbook.decode(self.offset, self.length, self.count)
+            self.workbook = None
+        return self.rows
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.decode())
+
+    def __getitem__(self, index):
+        return self.decode()[index]
+
+    def __reduce__(self):
+        if self.rows is not None:
+            return list, (self.rows,)
+        workbook = self.workbook
+        return read_sheet_rows, (workbook.path, workbook.stamp, self.offset, self.length, self.count)
+
+
+def read_sheet_rows(path, stamp, offset, length, count):
+    """
+    在计算进程中直接从工作簿文件读取一个 sheet 的行；文件已被替换时报错
+    """
+    workbook = BinaryWorkbook(path)
+    try:
+        if workbook.stamp != stamp:
+            raise EvalError("工作簿文件已更新")
+        return workbook.decode(offset, length, count)
+    finally:
+        workbook.close()
+
+
+def encode_workbook(state):
+    """
+    把状态数据编码为二进制工作簿
+    :param state: 状态数据
+    :return: 字节串
+    """
+    fields = WORKBOOK_BLOCKS[WORKBOOK_MAGIC]
+    meta = {key: value for key, value in state.items() if key != "tabs"}
+    meta["tabs"] = [{key: value for key, value in sheet.items() if key not in fields}
+                    for sheet in state.get("tabs", [])]
+    meta_bytes = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    blocks = []
+    for sheet in state.get("tabs", []):
+        for field in fields:
+            if field not in sheet:
+                blocks.append((b"", WORKBOOK_ABSENT))
+                continue
+            parts = []
+            for text in sheet[field]:
+                data = text.encode("utf-8")
+                parts.append(WORKBOOK_LENGTH.pack(len(data)))
+                parts.append(data)
+            blocks.append((b"".join(parts), len(sheet[field])))
+    header_size = (len(WORKBOOK_MAGIC) + WORKBOOK_LENGTH.size + len(meta_bytes)
+                   + WORKBOOK_LENGTH.size + WORKBOOK_INDEX.size * len(blocks))
+    out = [WORKBOOK_MAGIC, WORKBOOK_LENGTH.pack(len(meta_bytes)), meta_bytes,
+           WORKBOOK_LENGTH.pack(len(state.get("tabs", [])))]
+    offset = header_size
+    for block, count in blocks:
+        out.append(WORKBOOK_INDEX.pack(offset, len(block), count))
+        offset += len(block)
+    out.extend(block for block, _ in blocks)
+    return b"".join(out)
+
+
+def encode_state(state, path):
+    """
+    按文件扩展名编码状态数据：.json 为 JSON，其余为二进制工作簿
+    """
+    if path.endswith(".json"):
+        return json.dumps(state, ensure_ascii=False).encode("utf-8")
+    return encode_workbook(state)
+
+
+def materialize(state):
+    """
+    把状态数据中延迟解码的行全部解码为列表
+    """
+    for sheet in state.get("tabs", []):
+        for field in WORKBOOK_BLOCKS[WORKBOOK_MAGIC]:
+            if field in sheet:
+                sheet[field] = list(sheet[field])
+    return state
+
+
+def read_state(path):
+    """
+    读取状态文件（JSON 或二进制工作簿），所有行都解码为列表
+    """
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    workbook = BinaryWorkbook(path)
+    try:
+        return materialize(workbook.state())
+    finally:
+        workbook.close()
+
+
+def convert_state(source, target):
+    """
+    在 JSON 状态文件和二进制工作簿之间转换，内容无损
+    :param source: 源文件路径
+    :param target: 目标文件路径（按扩展名决定格式）
+    """
+    write_snapshot(read_state(source), target)
+
+
+# ================= 命令行批量计算 =================
+def read_text_rows(stream):
+    """
+    逐行读取文本，每行为一行表达式
+    :param stream: 文本文件对象
+    :return: 生成器，逐个产生去掉行尾换行符的行文本
+    """
+    for line in stream:
+        yield line.rstrip("\r\n")
+
+
+def evaluate_rows(rows, evaluator, table, xref=None):
+    """
+    按顺序流式计算各行，只保留变量表（每个变量最近一次成功的定义），
+    与依赖图中“引用解析到上方最近一次成功的定义”的规则一致
+    :param rows: 行文本的可迭代对象（可以是生成器）
+    :param evaluator: 表达式引擎
+    :param table: 变量表（变量名 -> 结果），计算过程中更新，结束时为该 sheet 的最终定义
+    :param xref: 解析跨 sheet 引用 xref(引用名)，返回结果，未定义时返回 None，出错时抛出 EvalError；
+                 为 None 时跨 sheet 引用视为未定义
+    :return: 生成器，逐行产生 (行号, 行文本, 类型, 变量名, 是否成功, 结果, 错误)
+    """
+    for number, text in enumerate(rows, 1):
+        kind, name, expr, refs = parse_row(text)
+        value = error = None
+        if kind != "empty":
+            try:
+                variables = {}
+                for ref in refs:
+                    if XREF_MARK not in ref:
+                        found = table.get(ref)
+                    else:
+                        found = xref(ref) if xref is not None else None
+                    if found is not None:
+                        variables[ref] = found
+                value = evaluator.evaluate(expr, variables)
+            except EvalError as e:
+                value, error = None, str(e)
+            except Exception:
+                value = None
+        ok = value is not None
+        if ok and name is not None:
+            table[name] = value
+        yield number, text, kind, name, ok, value, error
+
+
+class BatchEvaluator:
+    """
+    命令行批量计算：从状态文件、文本文件或标准输入流式读取各行并计算，结果逐行产生，
+    内存中只保留变量表，因此可以处理任意大的输入文件
+    """
+
+    def __init__(self):
+        self.evaluator = ExpressionEvaluator(cache_size=BATCH_CACHE_SIZE)
+        self.sheets = {}        # 当前工作簿中的 sheet 名 -> 返回该 sheet 行迭代器的函数
+        self.tables = {}        # 已算完的 sheet 名 -> 变量表
+        self.running = {}       # 正在计算的 sheet 名 -> 到目前为止的变量表
+
+    def run(self, paths, only=None):
+        """
+        依次计算各输入
+        :param paths: 输入文件路径列表，"-" 或空列表为标准输入；.vcb / .json 为状态文件，其余为每行一个表达式的文本
+        :param only: 状态文件中只输出这些 sheet（仍可引用其他 sheet）
+        :return: 生成器，逐行产生 (sheet 名, 行号, 行文本, 类型, 变量名, 是否成功, 结果, 错误)，文本输入的 sheet 名为 None
+        """
+        for path in paths or ["-"]:
+            if path == "-":
+                yield from self.run_sheet(None, read_text_rows(sys.stdin))
+            elif path.endswith((".vcb", ".json")):
+                yield from self.run_workbook(path, only)
+            else:
+                with open(path, "r", encoding="utf-8") as f:
+                    yield from self.run_sheet(None, read_text_rows(f))
+
+    def run_workbook(self, path, only=None):
+        """
+        计算状态文件中的各个 sheet：二进制工作簿直接从文件映射中逐行解码，不整体读入内存
+        """
+        workbook = None
+        if path.endswith(".json"):
+            with open(path, "r", encoding="utf-8") as f:
+                tabs = [(sheet["title"], lambda rows=sheet.get("contents", []): iter(rows))
+                        for sheet in json.load(f).get("tabs", [])]
+        else:
+            workbook = BinaryWorkbook(path)
+            tabs = [(sheet["title"], lambda block=entries[0]: workbook.iter_rows(*block))
+                    for sheet, entries in zip(workbook.meta["tabs"], workbook.index)]
+        self.sheets, self.tables = {}, {}
+        for title, rows in tabs:
+            self.sheets.setdefault(title, rows)  # 重名时引用先出现的 sheet，与界面一致
+        try:
+            for title, rows in tabs:
+                if only and title not in only:
+                    continue
+                yield from self.run_sheet(title, rows())
+        finally:
+            if workbook is not None:
+                workbook.close()
+
+    def run_sheet(self, title, rows):
+        """
+        流式计算一个 sheet，算完后保留它的变量表供其他 sheet 引用
+        """
+        table = {}
+        if title is not None:
+            self.running[title] = table
+        try:
+            for result in evaluate_rows(rows, self.evaluator, table, self.xref):
+                yield (title,) + result
+        finally:
+            self.running.pop(title, None)
+        if title is not None:
+            self.tables.setdefault(title, table)
+
+    def xref(self, key):
+        """
+        解析跨 sheet 引用：目标 sheet 尚未算完时先把它完整地计算一遍（不输出）；
+        目标正在计算中（引用本 sheet 或相互引用）时只能用到它已算过的定义
+        """
+        title, name = split_ref(key)
+        table = self.tables.get(title)
+        if table is None:
+            table = self.running.get(title)
+            if table is not None:
+                return table.get(name)
+            rows = self.sheets.get(title)
+            if rows is None:
+                raise EvalError(f"未定义的 sheet {title}")
+            for _ in self.run_sheet(title, rows()):
+                pass
+            table = self.tables[title]
+        return table.get(name)
+
+
+def plain_value(value):
+    """
+    把结果转换为可写入 JSON 的值：整数、浮点数、布尔值原样保留，数组转换为列表，其余转换为文本；
+    超过 1000 位（二进制）的整数转换为完整的十进制文本，避免读取方按浮点数解析时丢失精度
+    """
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if np is not None and isinstance(value, np.generic):
+        return plain_value(value.item())
+    if isinstance(value, int):
+        return value if value.bit_length() <= 1000 else full_value_text(value)
+    if isinstance(value, float):
+        return value if math.isfinite(value) else str(value)
+    if np is not None and isinstance(value, np.ndarray):
+        if value.dtype.kind == "f" and np.isfinite(value).all() or value.dtype.kind in "biu":
+            return value.tolist()
+        return [plain_value(v) for v in value.tolist()]
+    return str(value)
+
+
+def result_record(sheet, number, text, name, ok, value, error):
+    """
+    一行结果的 JSON 记录（jsonl 输出和计算服务共用）
+    """
+    return {"sheet": sheet, "row": number, "text": text, "name": name, "ok": ok,
+            "value": plain_value(value), "error": error}
+
+
+def write_results(results, fmt, out):
+    """
+    把计算结果逐行写出
+    :param results: BatchEvaluator.run 产生的结果
+    :param fmt: text（与界面相同的结果文本）/ csv / jsonl
+    :param out: 输出的文本文件对象
+    """
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(["sheet", "row", "text", "name", "ok", "value", "error"])
+    current = None
+    for sheet, number, text, kind, name, ok, value, error in results:
+        if fmt == "jsonl":
+            out.write(json.dumps(result_record(sheet, number, text, name, ok, value, error), ensure_ascii=False) + "\n")
+        elif writer is not None:
+            # 与 jsonl 相同输出完整的值：数组列出所有元素，整数不做近似
+            writer.writerow([sheet or "", number, text, name or "", int(ok), full_value_text(value) if ok else "", error or ""])
+        else:
+            if sheet != current:
+                out.write(f"[{sheet}]\n")
+                current = sheet
+            out.write(f"{text}  {describe_result(kind, name, ok, value, error)}\n")
+
+
+def batch_main(argv):
+    """
+    命令行批量计算入口：python 变量计算器.py eval [输入 ...] [--format text|csv|jsonl] [--sheet 名称 ...] [-o 输出]
+    :return: 退出码
+    """
+    parser = argparse.ArgumentParser(prog="变量计算器.py eval", description="不打开界面，流式计算状态文件、文本文件或标准输入中的各行")
+    parser.add_argument("inputs", nargs="*", help="输入：.vcb / .json 状态文件，或每行一个表达式的文本文件；省略或 - 为标准输入")
+    parser.add_argument("--format", choices=("text", "csv", "jsonl"), default="text", help="输出格式")
+    parser.add_argument("--sheet", nargs="+", help="只输出状态文件中的这些 sheet")
+    parser.add_argument("-o", "--output", help="输出文件，默认为标准输出")
+    args = parser.parse_args(argv)
+    results = BatchEvaluator().run(args.inputs, args.sheet)
+    try:
+        if args.output:
+            with open(args.output, "w", encoding="utf-8", newline="") as out:
+                write_results(results, args.format, out)
+        else:
+            if hasattr(sys.stdout, "reconfigure"):
+                sys.stdout.reconfigure(encoding="utf-8")
+            write_results(results, args.format, sys.stdout)
+            sys.stdout.flush()
+    except BrokenPipeError:
+        # 输出被提前关闭（例如接到 head）：不再输出，也不报错
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    except (OSError, ValueError) as e:
+        print(f"错误：{e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+# ================= 本地计算服务 =================
+def file_stamp(path):
+    """
+    文件的 (大小, 修改时间)，用于判断文件是否变化
+    :return: 文件不存在时为 None
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def sync_rows(graph, texts):
+    """
+    把依赖图的各行同步为新的行文本：只修改首尾相同部分之间的行，其余行保留计算结果
+    :param graph: 依赖图
+    :param texts: 新的行文本列表
+    :return: 被修改、插入或删除的行数
+    """
+    rows = graph.rows
+    start, old_end, new_end = 0, len(rows), len(texts)
+    while start < old_end and start < new_end and rows[start].text == texts[start]:
+        start += 1
+    while old_end > start and new_end > start and rows[old_end - 1].text == texts[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    common = min(old_end, new_end) - start
+    for offset in range(common):
+        graph.set_text(start + offset, texts[start + offset])
+    if new_end > old_end:
+        graph.insert_many(old_end, texts[old_end:new_end])
+    if old_end > new_end:
+        graph.delete_many(new_end, old_end - new_end)
+    return max(old_end, new_end) - start
+
+
+class QueryTable(dict):
+    """
+    查询时的变量表：本次请求中赋值的变量优先，其余取 sheet 中该变量最后一次成功的定义，
+    即把请求中的表达式当作追加在 sheet 末尾的行来计算（不修改 sheet）
+    """
+
+    def __init__(self, graph):
+        super().__init__()
+        self.graph = graph
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        definer = self.graph.last_definer(name)
+        return definer.value if definer is not None and definer.ok else default
+
+
+class EvalServer:
+    """
+    本地计算服务：工作簿只载入一次，各 sheet 的依赖图（变量表）和表达式编译缓存常驻内存，
+    用 asyncio 并发响应“在 sheet X 上计算这些表达式”的批量请求。
+    定时检查状态文件和日志，变化后只把有变化的行同步到依赖图中，按依赖关系重算受影响的行。
+    """
+
+    def __init__(self, path, interval=WATCH_INTERVAL):
+        """
+        :param path: 状态文件路径（.vcb / .json）；界面未正常关闭前的编辑在同目录的日志中
+        :param interval: 检查文件变化的间隔（秒）
+        """
+        self.path = path
+        self.journal = os.path.join(os.path.dirname(path), JOURNAL_FILE)
+        self.interval = interval
+        self.evaluator = ExpressionEvaluator(cache_size=BATCH_CACHE_SIZE)
+        self.index = WorkbookIndex()
+        self.sheets = []     # [(sheet 名, 依赖图)]，与状态文件中的顺序一致
+        self.stamp = None    # 已载入的 (状态文件, 日志) 的 file_stamp
+        self.base = None     # (状态文件的 file_stamp, 状态数据)：只有日志变化时不必重新读取状态文件
+        self.seq = 0         # 已载入的最后一条编辑的序号
+
+    # ---------- 载入 ----------
+    def read(self, snapshot):
+        """
+        读取状态文件并重放日志（在线程池中执行）；状态文件未变化时沿用上次读取的内容，只重放日志
+        :param snapshot: 状态文件的 file_stamp
+        :return: 状态数据
+        """
+        if self.base is None or self.base[0] != snapshot:
+            self.base = (snapshot, read_state(self.path) if snapshot is not None else {"tabs": []})
+        base = self.base[1]
+        # replay_journal 会替换被修改的 sheet 的行列表，复制到 sheet 一级即可
+        state = dict(base, tabs=[dict(sheet) for sheet in base.get("tabs", [])])
+        replay_journal(state, read_journal(self.journal))
+        return state
+
+    def apply(self, state):
+        """
+        把状态数据同步到各依赖图：同名的 sheet 只修改有变化的行，新 sheet 用保存的结果缓存建立依赖图
+        :return: 被修改的行数
+        """
+        old = list(self.sheets)
+        sheets = []
+        changed = 0
+        for sheet in state.get("tabs", []):
+            title, texts = sheet["title"], sheet.get("contents", [])
+            found = next((pair for pair in old if pair[0] == title), None)
+            if found is None:
+                graph = SheetGraph(self.evaluator.evaluate, index=self.index)
+                graph.insert_many(0, texts)
+                if sheet.get("results"):
+                    graph.load_cache(sheet["results"])
+                self.index.add(title, graph)
+                changed += len(texts)
+            else:
+                old.remove(found)
+                graph = found[1]
+                changed += sync_rows(graph, texts)
+            sheets.append((title, graph))
+        for title, graph in old:
+            self.index.remove(graph)
+            changed += len(graph.rows)
+        self.sheets = sheets
+        self.seq = state.get("seq", 0)
+        return changed
+
+    async def reload(self):
+        """
+        状态文件或日志有变化时重新载入，并分片重算（每片之后处理其间到达的请求）
+        """
+        stamp = (file_stamp(self.path), file_stamp(self.journal))
+        if stamp == self.stamp:
+            return
+        started = time.perf_counter()
+        try:
+            state = await asyncio.get_running_loop().run_in_executor(None, self.read, stamp[0])
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            print(f"无法载入 {self.path}：{e}", file=sys.stderr, flush=True)
+            self.stamp = stamp  # 文件再次变化时重试
+            return
+        self.stamp = stamp
+        changed = self.apply(state)
+        while True:
+            pending = [graph for _, graph in self.sheets if graph.dirty]
+            if not pending:
+                break
+            for graph in pending:
+                graph.recalculate(time.perf_counter() + FRAME_BUDGET)
+                await asyncio.sleep(0)
+        print(f"已载入 {self.path}（序号 {self.seq}，{changed} 行变化，{time.perf_counter() - started:.3f} 秒）",
+              file=sys.stderr, flush=True)
+
+    # ---------- 查询 ----------
+    def sheet(self, title):
+        """
+        取得 sheet 的依赖图，有待重算的行时先算完（重载后的分片重算尚未轮到它时）
+        :return: 依赖图；sheet 不存在时抛出 LookupError
+        """
+        graph = self.index.sheets.get(title)
+        if graph is None:
+            raise LookupError(f"未定义的 sheet {title}")
+        if graph.dirty:
+            graph.recalculate()
+        return graph
+
+    def xref(self, key):
+        """
+        解析查询中的跨 sheet 引用
+        """
+        title, name = split_ref(key)
+        try:
+            graph = self.sheet(title)
+        except LookupError as e:
+            raise EvalError(str(e))
+        definer = graph.last_definer(name)
+        return definer.value if definer is not None and definer.ok else None
+
+    def handle(self, request):
+        """
+        处理一个请求
+        :param request: {"op": "evaluate", "sheet": 名称, "expressions": [表达式, ...]}、{"op": "rows", "sheet": 名称}、
+                        {"op": "variables", "sheet": 名称} 或 {"op": "sheets"}
+        :return: 响应数据；请求格式有误时抛出 ValueError，sheet 不存在时抛出 LookupError
+        """
+        if not isinstance(request, dict):
+            raise ValueError("请求必须是 JSON 对象")
+        op = request.get("op")
+        if op == "sheets":
+            return {"seq": self.seq, "sheets": [{"title": title, "rows": len(graph.rows)} for title, graph in self.sheets]}
+        title = request.get("sheet")
+        if not isinstance(title, str):
+            raise ValueError("缺少 sheet")
+        graph = self.sheet(title)
+        if op == "evaluate":
+            expressions = request.get("expressions")
+            if not isinstance(expressions, list) or not all(isinstance(text, str) for text in expressions):
+                raise ValueError("expressions 必须是字符串列表")
+            results = [result_record(title, number, text, name, ok, value, error) for number, text, kind, name, ok, value, error
+                       in evaluate_rows(expressions, self.evaluator, QueryTable(graph), self.xref)]
+            return {"seq": self.seq, "sheet": title, "results": results}
+        if op == "rows":
+            rows = [result_record(title, node.index + 1, node.text, node.name, node.ok, node.value, node.error)
+                    for node in graph.rows]
+            return {"seq": self.seq, "sheet": title, "rows": rows}
+        if op == "variables":
+            variables = {name: plain_value(lst[-1].value) for name, lst in graph.definers.items() if lst and lst[-1].ok}
+            return {"seq": self.seq, "sheet": title, "variables": variables}
+        raise ValueError(f"未知的操作 {op}")
+
+    def route(self, method, target, body):
+        """
+        把 HTTP 请求转换为 handle 的请求：
+        GET /sheets、GET /sheets/名称、GET /sheets/名称/variables、POST /evaluate（请求体为 {"sheet", "expressions"}）
+        :return: (状态码, 响应数据)
+        """
+        parts = [unquote(part) for part in urlsplit(target).path.split("/")[1:]]
+        try:
+            if method == "GET" and parts == ["sheets"]:
+                request = {"op": "sheets"}
+            elif method == "GET" and len(parts) == 2 and parts[0] == "sheets":
+                request = {"op": "rows", "sheet": parts[1]}
+            elif method == "GET" and len(parts) == 3 and parts[0] == "sheets" and parts[2] == "variables":
+                request = {"op": "variables", "sheet": parts[1]}
+            elif method == "POST" and parts == ["evaluate"]:
+                request = json.loads(body)
+                if isinstance(request, dict):
+                    request = dict(request, op="evaluate")
+            else:
+                return 404, {"error": f"未知的请求 {method} {target}"}
+            return 200, self.handle(request)
+        except LookupError as e:
+            return 404, {"error": str(e)}
+        except ValueError as e:
+            return 400, {"error": str(e)}
+
+    # ---------- 连接 ----------
+    async def serve_http(self, reader, writer):
+        """
+        处理一个 HTTP/1.1 连接，支持持久连接（同一连接上连续发送多个请求）
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                if length > SERVE_MAX_REQUEST:
+                    status, payload = 413, {"error": "请求过大"}
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, payload = self.route(method, target, body)
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                keep = (version == "HTTP/1.1" and headers.get("connection", "").lower() != "close" and status != 413)
+                writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                             f"Content-Type: application/json; charset=utf-8\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep else 'close'}\r\n\r\n".encode("latin-1") + data)
+                await writer.drain()
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, asyncio.CancelledError):
+            pass  # 连接断开、请求格式错误或服务退出：关闭连接
+        finally:
+            writer.close()
+
+    async def serve_lines(self, reader, writer):
+        """
+        处理一个 Unix socket 连接：每行一个 JSON 请求，按顺序每行返回一个 JSON 响应
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    payload = self.handle(json.loads(line))
+                except (LookupError, ValueError) as e:
+                    payload = {"error": str(e)}
+                writer.write(json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, ValueError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=SERVE_HOST, port=SERVE_PORT, socket_path=None):
+        """
+        载入工作簿并开始监听，之后定时检查文件变化，直到被中断
+        :param host: HTTP 监听地址
+        :param port: HTTP 端口，为 None 时不监听 HTTP
+        :param socket_path: Unix socket 路径，为 None 时不监听
+        """
+        await self.reload()
+        try:
+            # 被 kill 时与 Ctrl+C 一样正常退出，删除 socket 文件
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        except (NotImplementedError, AttributeError):
+            pass
+        servers = []
+        try:
+            if port is not None:
+                servers.append(await asyncio.start_server(self.serve_http, host, port, limit=SERVE_MAX_REQUEST))
+                print(f"计算服务：http://{host}:{port}", file=sys.stderr, flush=True)
+            if socket_path is not None:
+                servers.append(await asyncio.start_unix_server(self.serve_lines, socket_path, limit=SERVE_MAX_REQUEST))
+                print(f"计算服务：{socket_path}", file=sys.stderr, flush=True)
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.reload()
+        finally:
+            for server in servers:
+                server.close()
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+def serve_main(argv):
+    """
+    本地计算服务入口：python 变量计算器.py serve [状态文件] [--port 端口] [--socket 路径]
+    :return: 退出码
+    """
+    parser = argparse.ArgumentParser(prog="变量计算器.py serve", description="常驻的本地计算服务，状态文件变化时自动重新载入")
+    parser.add_argument("state", nargs="?", default=STATE_FILE, help=f"状态文件，默认为 {STATE_FILE}")
+    parser.add_argument("--host", default=SERVE_HOST, help="HTTP 监听地址")
+    parser.add_argument("--port", type=int, help=f"HTTP 端口，默认为 {SERVE_PORT}；只指定 --socket 时不监听 HTTP")
+    parser.add_argument("--socket", help="Unix socket 路径，每行一个 JSON 请求")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL, help="检查文件变化的间隔（秒）")
+    args = parser.parse_args(argv)
+    if args.socket and not hasattr(asyncio, "start_unix_server"):
+        parser.error("当前系统不支持 Unix socket")
+    path = args.state
+    if path == STATE_FILE and not os.path.exists(path) and os.path.exists(LEGACY_STATE_FILE):
+        path = LEGACY_STATE_FILE
+    port = args.port if args.port is not None or args.socket else SERVE_PORT
+    try:
+        asyncio.run(EvalServer(path, args.interval).serve(args.host, port, args.socket))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    except OSError as e:
+        print(f"错误：{e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+# ================= 粘贴 =================
+def split_cells(text):
+    """
+    把剪贴板文本拆成单元格：每行按制表符拆分（Excel 等表格软件复制的格式），去掉首尾的空行
+    :param text: 剪贴板文本
+    :return: 各行的单元格列表
+    """
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").strip("\n").split("\n")
+    return [[cell.strip() for cell in line.split("\t")] for line in lines]
+
+
+def pasted_rows(text):
+    """
+    把多行（或含制表符的）剪贴板内容转换为行文本：每个单元格一行，空行保留，
+    "变量名<Tab>值" 这样的两列转换为赋值行
+    :param text: 剪贴板文本
+    :return: 行文本列表
+    """
+    rows = []
+    for cells in split_cells(text):
+        filled = [cell for cell in cells if cell]
+        if len(filled) == 2 and IDENTIFIER.fullmatch(filled[0]):
+            rows.append(f"{filled[0]} = {filled[1]}")
+        elif filled:
+            rows.extend(filled)
+        else:
+            rows.append("")
+    return rows
+
+
+def pasted_array(text):
+    """
+    把粘贴的一列（或一块）数值转换为数组字面量，第一个单元格可以是作为变量名的表头
+    :param text: 剪贴板文本
+    :return: (变量名，没有表头时为 None, 数组字面量)；含有非数值的单元格时为 None
+    """
+    cells = [cell for row in split_cells(text) for cell in row if cell]
+    name = None
+    if cells and IDENTIFIER.fullmatch(cells[0]):
+        name = cells.pop(0)
+    if not cells or not all(PASTED_NUMBER.fullmatch(cell) for cell in cells):
+        return None
+    return name, "[" + " ".join(cells) + "]"
+
+
+# ================= 撤销/重做 =================
+class HistoryStep:
+    """
+    撤销历史中的一步
+    """
+
+    def __init__(self, seq, edits, chars=0):
+        """
+        :param seq: 完成（或撤销）这一步时的编辑序号，多个历史之间按它决定撤销、重做的先后
+        :param edits: 修改列表
+        :param chars: 保存的字符数
+        """
+        self.seq = seq
+        self.edits = edits
+        self.chars = chars
+
+
+class EditHistory:
+    """
+    一个 sheet 的撤销/重做历史。每一步是若干处行替换 (起始行号, 替换前的各行, 替换后的各行)，
+    只保存被修改的行文本（与依赖图中的行共用同一个字符串），不复制整个 sheet；
+    撤销时按相反顺序把替换后的行换回替换前的行，依赖图只重算这些行及其下游行。
+    同一行的连续输入合并为一步；超过步数或字符数上限时丢弃最早的步骤。
+    """
+
+    def __init__(self):
+        self.done = deque()   # 可撤销的步骤，最新的在右端
+        self.undone = []      # 可重做的步骤，最近撤销的在末尾
+        self.chars = 0        # 两个栈中保存的字符数之和
+        self.typing = None    # 最后一步是连续输入时为 (行号, 时间)，同一行的下一次输入并入这一步
+        self.depth = 0        # begin / end 的嵌套层数
+        self.joined = False   # 当前这组修改是否已经开始了一步
+
+    def begin(self):
+        """
+        开始一组修改（例如粘贴时填入当前行并插入多行），end 之前记录的修改合为一步
+        """
+        if self.depth == 0:
+            self.joined = False
+            self.typing = None
+        self.depth += 1
+
+    def end(self):
+        """
+        结束一组修改
+        """
+        self.depth -= 1
+
+    def record(self, seq, row, before, after, typing=False):
+        """
+        记录一处行替换，并清空可重做的步骤
+        :param seq: 编辑序号
+        :param row: 起始行号
+        :param before: 替换前的各行文本（元组）
+        :param after: 替换后的各行文本（元组）
+        :param typing: 是否为输入引起的单行修改：与上一次输入是同一行且间隔不超过 UNDO_COALESCE_MS 时合并
+        """
+        for step in self.undone:
+            self.chars -= step.chars
+        self.undone.clear()
+        now = time.perf_counter()
+        if self.depth and self.joined:
+            step = self.done[-1]
+            step.edits.append((row, before, after))
+            chars = step.chars + sum(map(len, before)) + sum(map(len, after))
+        elif (typing and not self.depth and self.typing is not None and self.typing[0] == row
+              and (now - self.typing[1]) * 1000 <= UNDO_COALESCE_MS):
+            step = self.done[-1]
+            before = step.edits[0][1]
+            if before == after:
+                # 又改回了这一步之前的内容：这一步不再有意义
+                self.done.pop()
+                self.chars -= step.chars
+                self.typing = None
+                return
+            step.edits[0] = (row, before, after)
+            chars = len(before[0]) + len(after[0])
+        else:
+            step = HistoryStep(seq, [(row, before, after)])
+            self.done.append(step)
+            self.joined = self.depth > 0
+            chars = sum(map(len, before)) + sum(map(len, after))
+        self.chars += chars - step.chars
+        step.chars = chars
+        step.seq = seq
+        self.typing = (row, now) if typing and not self.depth else None
+        while len(self.done) > 1 and (len(self.done) > UNDO_LIMIT or self.chars > UNDO_MAX_CHARS):
+            self.chars -= self.done.popleft().chars
+
+    def undo(self, seq):
+        """
+        取出最近的一步并移入可重做的步骤
+        :return: 这一步，没有可撤销的步骤时为 None
+        """
+        if not self.done:
+            return None
+        step = self.done.pop()
+        step.seq = seq
+        self.undone.append(step)
+        self.typing = None
+        return step
+
+    def redo(self, seq):
+        """
+        取出最近撤销的一步并移回可撤销的步骤
+        :return: 这一步，没有可重做的步骤时为 None
+        """
+        if not self.undone:
+            return None
+        step = self.undone.pop()
+        step.seq = seq
+        self.done.append(step)
+        self.typing = None
+        return step
+
+
+# ================= 字体度量 =================
+class FontMetrics:
+    """
+    字体度量缓存：逐字符的宽度表和按文本缓存的像素宽度，行尺寸计算基本只是 Python 运算，
+    只有遇到新字符时才调用 Tk 测量。按字体描述在整个工作簿共享，字体变化（缩放）后取得新的缓存
+    """
+    _shared = {}   # 字体描述 -> FontMetrics
+
+    @classmethod
+    def of(cls, font):
+        """
+        取得字体的度量缓存
+        :param font: tkfont.Font
+        """
+        spec = font.actual()
+        key = tuple(sorted(spec.items()))
+        metrics = cls._shared.get(key)
+        if metrics is None:
+            metrics = cls._shared[key] = cls(tkfont.Font(**spec))
+        return metrics
+
+    def __init__(self, font):
+        """
+        :param font: 专用的字体对象（不随其他字体的修改而变化）
+        """
+        self.font = font
+        self.linespace = font.metrics("linespace")
+        self.glyphs = {}            # 字符 -> 像素宽度
+        self.widths = OrderedDict() # 文本 -> 像素宽度（最近使用的）
+        self.zero = self.glyph("0") or 7
+
+    def glyph(self, char):
+        """
+        单个字符的像素宽度
+        """
+        width = self.glyphs.get(char)
+        if width is None:
+            width = self.glyphs[char] = self.font.measure(char)
+        return width
+
+    def text_width(self, text):
+        """
+        一行文本的像素宽度（各字符宽度之和）
+        """
+        width = self.widths.get(text)
+        if width is not None:
+            self.widths.move_to_end(text)
+            return width
+        glyphs = self.glyphs
+        width = 0
+        for char in text:
+            w = glyphs.get(char)
+            if w is None:
+                w = self.glyph(char)
+            width += w
+        self.widths[text] = width
+        if len(self.widths) > TEXT_WIDTH_CACHE_SIZE:
+            self.widths.popitem(last=False)
+        return width
+
+    def columns(self, pixel):
+        """
+        把像素宽度转换为 Text.width 的字符数：能容纳 pixel 像素的最少 '0' 的个数
+        """
+        if pixel <= 0:
+            return 1
+        return max(1, -(-pixel // self.zero))
+
+
+class RowSlot:
+    """
+    可复用的行控件（输入框 + 结果标签），只为可见行创建，滚动时重新绑定到其他行
+    """
+    __slots__ = ("frame", "text", "label", "node", "shown", "y")
 
-# 状态文件路径
-STATE_FILE = "state.json"
 
 class VariableCalculator:
     def __init__(self, root):
         """
-        初始化变量计算器
-        :param root: tkinter根窗口
+        初始化变量计算器
+        :param root: tkinter根窗口
+        """
+        self.root = root
+        self.root.title("VarCalc")
+        self.font_family = "Consolas"
+        self.font_size = DEFAULT_FONT_SIZE
+        self.update_font()
+        # 表达式引擎（各 sheet 共享编译缓存）
+        self.evaluator = ExpressionEvaluator(offload=True)
+        # 跨 sheet 引用索引
+        self.workbook_index = WorkbookIndex(open_sheet=self.open_sheet, touched=self.on_sheet_touched)
+        # 性能分析（默认关闭）
+        self.profiler = Profiler(self.workbook_index.titles)
+        # 后台计算进程池：较重的行交给它计算，界面保持响应
+        self.pool = EvalPool()
+        self.pool_job = None
+
+        # ================= 自定义可滚动 Sheets 栏 =================
+        # sheet 栏：各 sheet 标签直接画在画布上，只绘制可见的标签，画布元素的个数只与窗口宽度有关
+        self.sheet_bar = tk.Frame(root, bg="lightgray")
+        self.sheet_bar.pack(fill="x", side="top")
+        # 添加新sheet的按钮
+        self.add_sheet_button = tk.Button(self.sheet_bar, text="+", command=self.add_tab)
+        self.add_sheet_button.pack(side="left", padx=2, pady=2)
+        # 快速切换：按名称查找 sheet（Ctrl+P）
+        self.switch_button = tk.Button(self.sheet_bar, text="▾", command=self.show_switcher)
+        self.switch_button.pack(side="right", padx=2, pady=2)
+        self.sheet_canvas = tk.Canvas(self.sheet_bar, height=SHEET_BAR_HEIGHT, bg="lightgray", highlightthickness=0)
+        self.sheet_canvas.pack(side="left", fill="x", expand=True)
+        self.sheet_font = tkfont.Font(family=self.font_family, size=10)
+        self.sheet_metrics = FontMetrics.of(self.sheet_font)
+        # sheet 登记表：标签页的 sheet_id 是不变的编号，position 是它在 sheet_order 中的位置
+        self.sheet_tabs = {}          # sheet 编号 -> 标签页
+        self.sheet_order = []         # 各标签页，按 sheet 栏中的顺序
+        self.next_sheet_id = 1
+        self.sheet_offsets = [0]      # 各 sheet 标签左边缘的横坐标（前缀和），最后一项为总宽度
+        self.sheet_offsets_from = 0   # 从该位置起横坐标需要重新计算
+        self.sheet_scroll_x = 0       # 横向滚动位置（像素）
+        self.sheet_items = []         # 可复用的画布元素 (矩形, 文字)
+        self.sheet_bar_job = None
+        self.switch_panel = None      # 快速切换面板（首次打开时创建）
+        # 绑定事件处理函数
+        self.sheet_canvas.bind("<Configure>", lambda e: self.render_sheet_bar())
+        self.sheet_canvas.bind("<Button-1>", lambda e: self.on_sheet_click(e, self.select_sheet))
+        self.sheet_canvas.bind("<Double-Button-1>", lambda e: self.on_sheet_click(e, self.rename_sheet))
+        self.sheet_canvas.bind("<Button-3>", lambda e: self.on_sheet_click(e, self.delete_sheet))  # 右键删除
+        self.root.bind_all("<Control-p>", lambda e: self.show_switcher())
+        self.root.bind_all("<MouseWheel>", self.on_mouse_wheel)
+        self.root.bind_all("<Button-4>", self.on_mouse_wheel)
+        self.root.bind_all("<Button-5>", self.on_mouse_wheel)
+
+        # ================= 状态栏 =================
+        self.status = tk.Label(root, anchor="w", bg="lightgray", font=(self.font_family, 9))
+        self.status.pack(fill="x", side="bottom")
+        # 最近一次工作簿重算的统计
+        self.recompute = None
+        # 打开的二进制工作簿（各 sheet 的行尚未全部解码时保持打开）
+        self.workbook = None
+        # F9 重算整个工作簿
+        self.root.bind_all("<F9>", lambda e: self.recompute_workbook())
+        # 性能分析浮层：开启时显示在状态栏上方
+        self.profile_status = tk.Label(root, anchor="w", bg="lightyellow", font=(self.font_family, 9))
+        # F12 开关性能分析，Ctrl+F12 导出 trace 文件
+        self.root.bind_all("<F12>", lambda e: self.set_profiling(not self.profiler.enabled))
+        self.root.bind_all("<Control-F12>", lambda e: self.export_trace())
+        # Ctrl+= / Ctrl+- 缩放，Ctrl+0 恢复默认大小
+        self.root.bind_all("<Control-equal>", lambda e: self.zoom(1))
+        self.root.bind_all("<Control-plus>", lambda e: self.zoom(1))
+        self.root.bind_all("<Control-minus>", lambda e: self.zoom(-1))
+        self.root.bind_all("<Control-0>", lambda e: self.zoom(0))
+        # 符号面板（首次打开时创建）：Ctrl+Shift+F 打开，F3 跳到光标处变量的定义，Shift+F3 查找它的用法
+        self.symbol_panel = None
+        self.root.bind_all("<Control-F>", lambda e: self.show_symbols())
+        self.root.bind_all("<F3>", lambda e: self.jump_to_definition())
+        self.root.bind_all("<Shift-F3>", lambda e: self.find_usages())
+        # 结果的显示方式：Ctrl+[ / Ctrl+] 减少或增加有效数字位数，Ctrl+Shift+E 切换记数法
+        self.result_style = ResultStyle(RESULT_DIGITS, "auto")
+        self.root.bind_all("<Control-bracketleft>", lambda e: self.set_result_style(self.result_style.digits - 1))
+        self.root.bind_all("<Control-bracketright>", lambda e: self.set_result_style(self.result_style.digits + 1))
+        self.root.bind_all("<Control-E>", lambda e: self.cycle_notation())
+        # 撤销/重做：各 sheet 的行修改各有一份历史，sheet 的删除和改名记在工作簿的历史中
+        self.history_seq = 0           # 编辑序号，决定当前 sheet 的历史与工作簿的历史之间的先后
+        self.sheet_history = deque()   # 可撤销的 sheet 删除/改名
+        self.sheet_undone = []         # 可重做的 sheet 删除/改名
+        self.root.bind_all("<Control-z>", lambda e: self.undo())
+        self.root.bind_all("<Control-y>", lambda e: self.redo())
+        self.root.bind_all("<Control-Z>", lambda e: self.redo())
+
+        # ================= Notebook =================
+        # 创建主内容区域的notebook控件
+        self.notebook = ttk.Notebook(root)
+        self.notebook.pack(fill=tk.BOTH, expand=True)
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        # 未打开标签页的后台计算任务
+        self.warm_job = None
+        # 自动保存日志
+        self.journal_seq = 0       # 最后一条日志记录的序号
+        self.journal_buffer = []   # 尚未写入文件的记录
+        self.journal_job = None
+        self.journal_size = 0      # 日志文件当前大小（字节）
+        self.compaction = None     # 后台合并：(线程, 合并时的日志大小, 结果)
+        # 隐藏默认的tab栏
+        style = ttk.Style()
+        style.layout("TNotebook.Tab", [])  # 隐藏默认 tab 栏
+
+
+        # 设置了环境变量时从打开工作簿开始记录性能分析
+        if os.environ.get(PROFILE_ENV):
+            self.set_profiling(True)
+
+        # 状态文件恢复
+        # 绑定窗口关闭事件
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        # 如果存在状态文件，则加载状态，否则创建新标签页
+        if any(os.path.exists(path) for path in (STATE_FILE, LEGACY_STATE_FILE, JOURNAL_FILE)):
+            try:
+                self.load_state()
+            except Exception:
+                self.add_tab()
+        else:
+            self.add_tab()
+
+    # ================= Sheet 栏 =================
+    def register_sheet(self, tab, position):
+        """
+        把标签页登记到 sheet 栏的指定位置
+        :param tab: 标签页框架
+        :param position: 位置
+        """
+        self.sheet_tabs[tab.sheet_id] = tab
+        self.sheet_order.insert(position, tab)
+        self.renumber_sheets(position)
+
+    def unregister_sheet(self, tab):
+        """
+        从 sheet 栏中移除标签页
+        :param tab: 标签页框架
+        """
+        del self.sheet_tabs[tab.sheet_id]
+        del self.sheet_order[tab.position]
+        self.renumber_sheets(tab.position)
+
+    def sheet_alive(self, tab):
+        """
+        判断标签页是否仍在工作簿中（未被删除）
+        """
+        return self.sheet_tabs.get(tab.sheet_id) is tab
+
+    def renumber_sheets(self, start):
+        """
+        从 start 开始重新记录各标签页的位置，并安排重绘 sheet 栏
+        """
+        for position in range(start, len(self.sheet_order)):
+            self.sheet_order[position].position = position
+        self.sheet_offsets_from = min(self.sheet_offsets_from, start)
+        self.schedule_sheet_bar()
+
+    def new_sheet_title(self):
+        """
+        新 sheet 的默认名称：SheetN，跳过已有的名称
+        """
+        titles = {tab.title for tab in self.sheet_order}
+        number = len(self.sheet_order) + 1
+        while f"Sheet{number}" in titles:
+            number += 1
+        return f"Sheet{number}"
+
+    def ensure_sheet_offsets(self):
+        """
+        重新计算失效部分的 sheet 标签横坐标
+        """
+        order = self.sheet_order
+        start = min(self.sheet_offsets_from, len(order))
+        if start == len(order) and len(self.sheet_offsets) == len(order) + 1:
+            return
+        offsets = self.sheet_offsets
+        del offsets[start + 1:]
+        x = offsets[start]
+        text_width = self.sheet_metrics.text_width
+        for tab in order[start:]:
+            x += text_width(tab.title) + 2 * SHEET_TAB_PAD + SHEET_TAB_GAP
+            offsets.append(x)
+        self.sheet_offsets_from = len(order)
+
+    def schedule_sheet_bar(self):
+        """
+        安排在空闲时重绘 sheet 栏，连续的修改（如打开工作簿时逐个添加 sheet）只重绘一次
+        """
+        if self.sheet_bar_job is None:
+            self.sheet_bar_job = self.root.after_idle(self.render_sheet_bar)
+
+    def render_sheet_bar(self):
+        """
+        绘制 sheet 栏：把池中的画布元素摆放到可见的 sheet 标签上，其余的隐藏
+        """
+        if self.sheet_bar_job is not None:
+            self.root.after_cancel(self.sheet_bar_job)
+            self.sheet_bar_job = None
+        self.ensure_sheet_offsets()
+        canvas = self.sheet_canvas
+        offsets = self.sheet_offsets
+        width = max(1, canvas.winfo_width())
+        self.sheet_scroll_x = max(0, min(self.sheet_scroll_x, offsets[-1] - width))
+        first = max(0, bisect.bisect_right(offsets, self.sheet_scroll_x) - 1)
+        last = min(len(self.sheet_order), bisect.bisect_left(offsets, self.sheet_scroll_x + width))
+        current = self.current_tab()
+        for slot, position in enumerate(range(first, last)):
+            if slot == len(self.sheet_items):
+                self.sheet_items.append((canvas.create_rectangle(0, 0, 0, 0, outline="gray"),
+                                         canvas.create_text(0, 0, anchor="w", font=self.sheet_font)))
+            rect, text = self.sheet_items[slot]
+            tab = self.sheet_order[position]
+            x = offsets[position] - self.sheet_scroll_x
+            canvas.coords(rect, x, 3, x + offsets[position + 1] - offsets[position] - SHEET_TAB_GAP, SHEET_BAR_HEIGHT - 3)
+            canvas.itemconfigure(rect, fill="white" if tab is current else "gainsboro", state="normal")
+            canvas.coords(text, x + SHEET_TAB_PAD, SHEET_BAR_HEIGHT // 2)
+            canvas.itemconfigure(text, text=tab.title, state="normal")
+        for rect, text in self.sheet_items[last - first:]:
+            canvas.itemconfigure(rect, state="hidden")
+            canvas.itemconfigure(text, state="hidden")
+
+    def sheet_at(self, x):
+        """
+        返回 sheet 栏中横坐标 x 处的标签页，没有时为 None
+        :param x: 画布上的横坐标
+        """
+        self.ensure_sheet_offsets()
+        x += self.sheet_scroll_x
+        offsets = self.sheet_offsets
+        position = bisect.bisect_right(offsets, x) - 1
+        if 0 <= position < len(self.sheet_order) and x < offsets[position + 1] - SHEET_TAB_GAP:
+            return self.sheet_order[position]
+        return None
+
+    def on_sheet_click(self, event, action):
+        """
+        sheet 栏上的点击：单击选择、双击重命名、右键删除点中的 sheet
+        :param event: 鼠标事件
+        :param action: 对点中的标签页执行的操作
+        """
+        tab = self.sheet_at(event.x)
+        if tab is not None:
+            action(tab)
+
+    def select_sheet(self, tab):
+        """
+        切换到标签页，并滚动 sheet 栏使它的标签可见
+        :param tab: 标签页框架
+        """
+        if self.current_tab() is not tab:
+            self.notebook.select(tab)
+        self.ensure_sheet_offsets()
+        left = self.sheet_offsets[tab.position]
+        right = self.sheet_offsets[tab.position + 1] - SHEET_TAB_GAP
+        width = max(1, self.sheet_canvas.winfo_width())
+        if left < self.sheet_scroll_x:
+            self.sheet_scroll_x = left
+        elif right > self.sheet_scroll_x + width:
+            self.sheet_scroll_x = right - width
+        self.render_sheet_bar()
+
+    def scroll_sheets(self, event):
+        """
+        处理鼠标滚轮事件，滚动sheet栏
+        :param event: 鼠标事件
+        """
+        if event.delta:
+            # Windows系统滚动
+            steps = -1*(event.delta//120)
+        else:
+            # Linux系统滚动
+            steps = -1 if event.num == 4 else 1
+        self.sheet_scroll_x += steps * SHEET_SCROLL_STEP
+        self.render_sheet_bar()
+
+    # ---------- 快速切换 ----------
+    def build_switcher(self):
+        """
+        创建快速切换面板：名称过滤框和 sheet 列表
+        """
+        panel = self.switch_panel = tk.Frame(self.root, bd=1, relief="groove")
+        tk.Label(panel, text="切换 sheet（Esc 关闭）", anchor="w", font=(self.font_family, 9)).pack(fill="x", padx=4, pady=(4, 0))
+        self.switch_filter = tk.Entry(panel, font=(self.font_family, 10))
+        self.switch_filter.pack(fill="x", padx=4, pady=2)
+        self.switch_filter.bind("<KeyRelease>", lambda e: self.refresh_switcher())
+        self.switch_filter.bind("<Return>", lambda e: self.open_switched(0))
+        self.switch_filter.bind("<Escape>", lambda e: self.hide_switcher())
+        self.switch_list = tk.Listbox(panel, width=30, exportselection=False, font=(self.font_family, 10))
+        self.switch_list.pack(fill="both", expand=True, padx=4, pady=4)
+        self.switch_list.bind("<Double-Button-1>", lambda e: self.open_switched())
+        self.switch_list.bind("<Return>", lambda e: self.open_switched())
+        self.switch_list.bind("<Escape>", lambda e: self.hide_switcher())
+        self.switch_ids = []   # 列表中各项对应的 sheet 编号
+
+    def show_switcher(self):
+        """
+        Ctrl+P：打开快速切换面板
+        """
+        if self.switch_panel is None:
+            self.build_switcher()
+        self.switch_panel.pack(side="right", fill="y", before=self.notebook)
+        self.switch_filter.delete(0, "end")
+        self.refresh_switcher()
+        self.switch_filter.focus_set()
+        return "break"
+
+    def hide_switcher(self):
+        """
+        关闭快速切换面板，焦点回到当前行
+        """
+        self.switch_panel.pack_forget()
+        tab = self.current_tab()
+        if tab is not None and tab.built and tab.focus_node is not None and tab.graph.alive(tab.focus_node):
+            self.focus_row(tab, tab.focus_node)
+        return "break"
+
+    def refresh_switcher(self):
+        """
+        按过滤框的内容刷新 sheet 列表：名称以输入开头的排在前面，其次是包含输入的，不区分大小写
+        """
+        pattern = self.switch_filter.get().strip().casefold()
+        prefix, inner = [], []
+        for tab in self.sheet_order:
+            found = tab.title.casefold().find(pattern)
+            if found == 0:
+                prefix.append(tab)
+            elif found > 0:
+                inner.append(tab)
+        matches = (prefix + inner)[:SHEET_SWITCH_LIMIT]
+        self.switch_ids = [tab.sheet_id for tab in matches]
+        self.switch_list.delete(0, "end")
+        if matches:
+            self.switch_list.insert("end", *(tab.title for tab in matches))
+
+    def open_switched(self, position=None):
+        """
+        切换到 sheet 列表中选中的 sheet
+        :param position: 列表中的位置，默认为当前选中的项
+        """
+        if position is None:
+            selection = self.switch_list.curselection()
+            position = selection[0] if selection else None
+        if position is None or position >= len(self.switch_ids):
+            return "break"
+        tab = self.sheet_tabs.get(self.switch_ids[position])
+        if tab is None:
+            self.status.config(text="该 sheet 已被删除")
+            return "break"
+        self.switch_panel.pack_forget()
+        self.select_sheet(tab)
+        if tab.focus_node is not None and tab.graph.alive(tab.focus_node):
+            self.focus_row(tab, tab.focus_node)
+        return "break"
+
+    # ================= 添加新 Sheet =================
+    def add_tab(self, title=None, contents=None, lazy=False, results=None):
+        """
+        添加新的标签页
+        :param title: 标签页标题
+        :param contents: 标签页内容
+        :param lazy: 是否延迟创建：只保留行文本，首次选中时才建立控件
+        :param results: 保存的结果缓存（与 contents 对应）
+        """
+        # 创建新的标签页框架
+        tab = tk.Frame(self.notebook, bg="white")
+        tab.built = False                                # 控件是否已创建
+        tab.graph = None                                 # 依赖图，首次需要时才建立
+        tab.contents = contents if contents else []      # 尚未载入依赖图的行文本（可能尚未解码）
+        tab.results = results                            # 尚未载入依赖图的结果缓存
+        tab.remote = None                                # 整表后台计算的任务号
+        tab.history = EditHistory()                      # 行修改的撤销/重做历史
+        tab.sheet_id = self.next_sheet_id                # 不变的 sheet 编号
+        self.next_sheet_id += 1
+        tab.title = title if title else self.new_sheet_title()
+        if not lazy:
+            self.journal_append("add_sheet", title=tab.title)
+        self.register_sheet(tab, len(self.sheet_order))
+        self.notebook.add(tab)
+
+        if not lazy:
+            self.build_tab(tab)
+
+    def ensure_model(self, tab):
+        """
+        为标签页建立依赖图（不创建任何控件）
+        :param tab: 标签页框架
+        """
+        if tab.graph is None:
+            tab.graph = SheetGraph(self.evaluator.evaluate, cancel=self.pool.cancel, index=self.workbook_index,
+                                   submit=lambda node, expr, variables, t=tab: self.submit_row(t, node, expr, variables))
+            tab.graph.insert_many(0, tab.contents)
+            if tab.results:
+                tab.graph.load_cache(tab.results)
+            tab.contents = tab.results = None
+            self.workbook_index.add(tab.title, tab.graph)
+            self.profile_graph(tab.graph)
+
+    def open_sheet(self, title):
+        """
+        跨 sheet 引用到尚未建立依赖图的 sheet 时，为它建立依赖图
+        :param title: sheet 名
+        :return: 依赖图，没有该 sheet 时为 None
+        """
+        for tab in self.sheet_order:
+            if tab.graph is None and tab.title == title:
+                self.ensure_model(tab)
+                return tab.graph
+        return None
+
+    def on_sheet_touched(self, graph):
+        """
+        其他 sheet 的变化使该 sheet 有行待重算（或已被重算）：安排刷新
+        :param graph: 依赖图
+        """
+        for tab in self.sheet_order:
+            if tab.graph is graph:
+                if tab.built:
+                    self.schedule_update(tab)
+                else:
+                    self.schedule_warm()
+                return
+
+    def build_tab(self, tab):
+        """
+        创建标签页的控件并显示内容；已创建过的标签页直接返回
+        :param tab: 标签页框架
+        """
+        if tab is None or tab.built:
+            return
+        tab.built = True
+        self.ensure_model(tab)
+        # 行控件池：只为可见行创建控件，滚动时回收复用
+        tab.bound = {}            # 行 -> 正在显示该行的控件
+        tab.free_slots = []       # 空闲的行控件
+        tab.focus_node = None     # 当前焦点所在的行
+        tab.scroll_y = 0          # 可见区域顶部的纵向偏移（像素）
+        tab.offsets = [0]         # 每行顶部的纵向偏移，末项为所有行的总高度
+        tab.offsets_from = 0      # 从该行起的偏移需要重新计算
+        # 重算调度状态
+        tab.update_job = None
+        tab.background_job = None
+        tab.pending_since = 0.0
+        tab.pending_rows = set()  # 内容尚未同步到数据模型的行控件
+        # 布局状态
+        tab.layout_dirty = set()  # 需要重新测量的屏幕外行
+        tab.layout_sweep = None   # 整表重新测量的进度（行号）
+        tab.resize_job = None
+        tab.layout_width = 0
+        # 创建纵向滚动条和内容画布
+        tab.scrollbar = ttk.Scrollbar(tab, orient="vertical",
+                                      command=lambda *args, t=tab: self.on_scrollbar(t, *args))
+        tab.scrollbar.pack(side="right", fill="y")
+        tab.canvas = tk.Canvas(tab, bg="white", highlightthickness=0)
+        tab.canvas.pack(fill=tk.BOTH, expand=True)
+        # 绑定画布配置事件
+        tab.canvas.bind("<Configure>", lambda e, t=tab: self.on_canvas_configure(t))
+        # 添加新行按钮
+        tab.add_button = tk.Button(tab.canvas, text="+", command=lambda t=tab: self.add_input_row(t))
+
+        # 显示内容行（后台可能已经算好了一部分）
+        if tab.graph.rows:
+            tab.focus_node = tab.graph.rows[-1]
+            self.run_scheduled_update(tab)
+        else:
+            self.add_input_row(tab, record=False)
+
+    def on_tab_changed(self, event=None):
+        """
+        切换标签页时，首次显示的标签页才创建控件
+        """
+        self.build_tab(self.current_tab())
+        self.schedule_sheet_bar()
+
+    def schedule_warm(self):
+        """
+        还有未打开且未算完的标签页时，安排在空闲时继续计算
+        """
+        if self.warm_job is not None:
+            return
+        for tab in self.sheet_order:
+            if not tab.built and tab.remote is None and (tab.graph is None or tab.graph.dirty):
+                self.warm_job = self.root.after_idle(self.run_warm_update)
+                return
+
+    def run_warm_update(self):
+        """
+        空闲时为未打开的标签页建立依赖图并分片重算，不创建控件
+        """
+        self.warm_job = None
+        deadline = time.perf_counter() + FRAME_BUDGET
+        for tab in self.sheet_order:
+            if tab.built or tab.remote is not None:
+                continue
+            self.ensure_model(tab)
+            if tab.graph.dirty:
+                tab.graph.recalculate(deadline=deadline)
+            if time.perf_counter() > deadline:
+                break
+        self.schedule_warm()
+
+    def delete_sheet(self, tab, record=True):
+        """
+        删除标签页；标签页（连同依赖图和控件）保留在撤销历史中，撤销时原样放回
+        :param tab: 标签页框架
+        :param record: 是否记入撤销历史（重做删除时为 False）
+        """
+        # 至少保留一个标签页
+        if len(self.sheet_order) <= 1:
+            return
+        idx = tab.position
+        if tab.built:
+            self.sync_pending(tab)
+        elif tab.graph is None:
+            # 尚未载入的行可能还在状态文件的映射中，文件关闭前先解码
+            tab.contents = list(tab.contents)
+            tab.results = list(tab.results) if tab.results else tab.results
+        if record:
+            self.record_sheet_step("delete", tab, idx, tab.title)
+        self.journal_append("delete_sheet", sheet=idx)
+        # 取消该标签页尚未执行的重算、布局和后台计算任务，引用它的其他 sheet 随后重算
+        if tab.graph is not None:
+            tab.graph.cancel_all()
+            self.workbook_index.remove(tab.graph)
+        if tab.remote is not None:
+            self.pool.cancel(tab.remote)
+            tab.remote = None
+            self.sheet_job_done()
+        if tab.built:
+            for job in (tab.update_job, tab.background_job, tab.resize_job):
+                if job is not None:
+                    self.root.after_cancel(job)
+            tab.update_job = tab.background_job = tab.resize_job = None
+            tab.pending_rows.clear()
+        self.notebook.forget(tab)
+        self.unregister_sheet(tab)
+        # 选择最后一个标签页
+        self.select_sheet(self.sheet_order[-1])
+
+    def rename_sheet(self, tab):
+        """
+        重命名标签页
+        :param tab: 标签页框架
+        """
+        old_name = tab.title
+        # 创建输入框用于重命名
+        entry = tk.Entry(self.sheet_canvas)
+        entry.insert(0, old_name)
+        entry.select_range(0, tk.END)
+        entry.focus()
+        # 定位输入框位置和大小：覆盖在 sheet 标签上
+        self.select_sheet(tab)
+        left = self.sheet_offsets[tab.position] - self.sheet_scroll_x
+        width = self.sheet_offsets[tab.position + 1] - self.sheet_offsets[tab.position] - SHEET_TAB_GAP
+        entry.place(x=left, y=3, width=max(width, 80), height=SHEET_BAR_HEIGHT - 6)
+
+        def save_name(event=None):
+            """
+            保存新的标签页名称
+            """
+            new_name = entry.get().strip() or old_name
+            entry.destroy()
+            if new_name != tab.title and self.sheet_alive(tab):
+                title = tab.title
+                rewrites = self.retitle_sheet(tab, new_name)
+                self.record_sheet_step("rename", tab, title, new_name, rewrites)
+
+        # 绑定回车和失去焦点事件保存名称
+        entry.bind("<Return>", save_name)
+        entry.bind("<FocusOut>", save_name)
+
+    def retitle_sheet(self, tab, title, rewrites=None, undo=False):
+        """
+        修改 sheet 名称，并把所有 sheet 中引用旧名称的行改为引用新名称
+        :param tab: 标签页框架
+        :param title: 新名称
+        :param rewrites: 撤销/重做改名时为改名时改写的行（见 find_references），只恢复这些行；
+                         为 None 时查找并改写所有引用旧名称的行
+        :param undo: 是否为撤销改名（把 rewrites 中的行改回改写前的文本）
+        :return: 被改写的行
         """
-        self.root = root
-        self.root.title("VarCalc")
-        self.font_family = "Consolas"
-        self.font_size = 12
-        self.default_font = (self.font_family, self.font_size)
+        old = tab.title
+        self.journal_append("rename_sheet", sheet=tab.position, title=title)
+        tab.title = title
+        self.renumber_sheets(tab.position)
+        if tab.graph is not None:
+            self.workbook_index.rename(tab.graph, title)
+        if rewrites is None:
+            rewrites = self.find_references(old, title)
+        self.rewrite_rows(rewrites, undo)
+        return rewrites
 
-        # ================= 自定义可滚动 Sheets 栏 =================
-        # 创建用于显示sheet标签的画布
-        self.sheet_canvas = tk.Canvas(root, height=30, bg="lightgray", highlightthickness=0)
-        self.sheet_canvas.pack(fill="x", side="top")
-        # 创建包含sheet按钮的框架
-        self.sheet_frame = tk.Frame(self.sheet_canvas, bg="lightgray")
-        self.sheet_window = self.sheet_canvas.create_window((0,0), window=self.sheet_frame, anchor="nw")
-        # 绑定事件处理函数
-        self.sheet_canvas.bind("<Configure>", self.update_sheet_scrollregion)
-        self.sheet_canvas.bind_all("<MouseWheel>", self.scroll_sheets)
+    def find_references(self, old, new):
+        """
+        查找所有 sheet 中引用旧名称的行
+        :param old: 旧名称
+        :param new: 新名称
+        :return: [(标签页, 行号, 改写前文本, 改写后文本)]
+        """
+        rewrites = []
+        for tab in self.sheet_order:
+            if tab.graph is None:
+                texts = tab.contents  # 尚未打开的 sheet 直接修改行文本
+            else:
+                if tab.built:
+                    self.sync_pending(tab)
+                texts = (node.text for node in tab.graph.rows)
+            for row, text in enumerate(texts):
+                if old in text and (new_text := rename_sheet_refs(text, old, new)) != text:
+                    rewrites.append((tab, row, text, new_text))
+        return rewrites
 
-        # ================= Notebook =================
-        # 创建主内容区域的notebook控件
-        self.notebook = ttk.Notebook(root)
-        self.notebook.pack(fill=tk.BOTH, expand=True)
-        # 隐藏默认的tab栏
-        style = ttk.Style()
-        style.layout("TNotebook.Tab", [])  # 隐藏默认 tab 栏
+    def rewrite_rows(self, rewrites, undo=False):
+        """
+        改写 sheet 改名涉及的行；行的内容已不是预期的文本时（之后被修改过）保持不变
+        :param rewrites: find_references 的结果
+        :param undo: True 时把行改回改写前的文本
+        """
+        touched = []
+        for tab, row, before, after in rewrites:
+            if undo:
+                before, after = after, before
+            if not self.sheet_alive(tab):
+                continue
+            sheet = tab.position
+            if tab.graph is None:
+                if row < len(tab.contents) and tab.contents[row] == before:
+                    if tab not in touched:
+                        tab.contents = list(tab.contents)
+                        touched.append(tab)
+                    tab.contents[row] = after
+                    self.journal_append("set", sheet=sheet, row=row, text=after)
+                continue
+            if tab.built:
+                self.sync_pending(tab)
+            rows = tab.graph.rows
+            if row < len(rows) and rows[row].text == before:
+                tab.graph.set_text(row, after)
+                self.journal_append("set", sheet=sheet, row=row, text=after)
+                slot = tab.bound.get(rows[row]) if tab.built else None
+                if slot is not None:
+                    slot.text.delete("1.0", "end")
+                    slot.text.insert("1.0", after)
+                    self.highlight_row(slot.text, after)
+                if tab not in touched:
+                    touched.append(tab)
+        for tab in touched:
+            if tab.graph is not None:
+                self.on_sheet_touched(tab.graph)
 
-        # 存储sheet按钮的列表
-        self.sheets = []  # 保存 Sheet 按钮
-        # 添加新sheet的按钮
-        self.add_sheet_button = tk.Button(self.sheet_frame, text="+", command=self.add_tab)
-        self.add_sheet_button.pack(side="left", padx=2, pady=2)
+    # ================= 输入框逻辑 =================
+    def add_input_row(self, tab, initial_text="", insert_after_current=True, record=True):
+        """
+        添加输入行
+        :param tab: 标签页框架
+        :param initial_text: 初始文本
+        :param insert_after_current: 是否在当前选中行后插入
+        :param record: 是否记入撤销历史（空 sheet 自动添加的行不记录）
+        """
+        # 确定插入位置：当前焦点所在行之后
+        insert_index = len(tab.graph.rows)
+        if insert_after_current and tab.focus_node is not None and tab.graph.alive(tab.focus_node):
+            insert_index = tab.focus_node.index + 1
+
+        node = tab.graph.insert(insert_index, initial_text)
+        self.journal_append("insert", sheet=tab.position, row=insert_index, texts=[initial_text])
+        if record:
+            self.record_edit(tab, insert_index, (), (initial_text,))
+        self.invalidate_offsets(tab, insert_index)
+
+        # 设置焦点并更新计算结果
+        tab.focus_node = node
+        self.update_all(tab)
+        self.focus_row(tab, node)
+
+    def add_input_rows(self, tab, lines, index=None):
+        """
+        批量添加输入行：一次性建立数据模型，只渲染可见行，重算和屏幕外布局分片在空闲时完成
+        :param tab: 标签页框架
+        :param lines: 各行文本
+        :param index: 插入位置，默认追加到末尾
+        """
+        if not lines:
+            return
+        if index is None:
+            index = len(tab.graph.rows)
+        nodes = tab.graph.insert_many(index, lines)
+        self.journal_append("insert", sheet=tab.position, row=index, texts=list(lines))
+        self.record_edit(tab, index, (), lines)
+        self.invalidate_offsets(tab, index)
+        tab.focus_node = nodes[-1]
+        self.sync_pending(tab)
+        touched = tab.graph.recalculate(deadline=time.perf_counter() + FRAME_BUDGET)
+        tab.layout_dirty.update(tab.graph.rows[i] for i in touched)
+        self.render_rows(tab)
+        self.schedule_background(tab)
+
+    def create_slot(self, tab):
+        """
+        创建一个可复用的行控件（输入框 + 结果标签），事件只在创建时绑定一次
+        :param tab: 标签页框架
+        """
+        slot = RowSlot()
+        slot.frame = tk.Frame(tab.canvas, bg="white")
+
+        # 创建文本输入框
+        text = tk.Text(slot.frame, height=1, wrap="word", font=self.default_font,
+                       bd=1, relief="solid", padx=2, pady=2)
+        text.pack(side="left", padx=(6,4))
+        # 配置注释样式
+        text.tag_configure("comment", foreground="green")
+
+        # 创建结果显示标签
+        result_label = tk.Label(slot.frame, text="= ?", bg="white", fg="blue", font=self.default_font, anchor="w")
+        result_label.pack(side="left", padx=(4,10))
+        # 添加双击复制功能
+        result_label.bind("<Double-Button-1>", lambda e, s=slot: self.copy_result(s))
+
+        slot.text, slot.label = text, result_label
+        slot.node = slot.shown = slot.y = None
+
+        # 绑定粘贴事件
+        text.bind("<<Paste>>", lambda e, t=tab, s=slot: self.clean_paste(t, s))
+        # Ctrl+Shift+V 把一列数值粘贴为数组
+        text.bind("<Control-V>", lambda e, t=tab, s=slot: self.paste_array(t, s))
+        # 绑定双击事件
+        text.bind("<Double-Button-1>", lambda e, tw=text: self.on_double_click(e, tw))
+        # 绑定按键释放事件，合并连续输入后调整大小并更新计算结果
+        text.bind("<KeyRelease>", lambda e, t=tab, s=slot: self.schedule_update(t, s))
+        # 绑定退格键事件
+        text.bind("<KeyPress-BackSpace>", lambda e, t=tab, s=slot: self.on_backspace(t, s))
+        # 绑定回车键事件
+        text.bind("<Return>", lambda e, t=tab, s=slot: self.on_return(t, s))
+        # 记录焦点所在的行
+        text.bind("<FocusIn>", lambda e, t=tab, s=slot: self.on_row_focus(t, s))
+        return slot
+
+    def acquire_slot(self, tab, node):
+        """
+        取一个空闲的行控件（没有则新建）并绑定到指定行
+        :param tab: 标签页框架
+        :param node: 行
+        """
+        slot = tab.free_slots.pop() if tab.free_slots else self.create_slot(tab)
+        slot.node = node
+        slot.shown = None
+        tab.bound[node] = slot
+        # 载入行文本
+        slot.text.delete("1.0", "end")
+        slot.text.insert("1.0", node.text)
+        self.highlight_row(slot.text, node.text)
+        return slot
+
+    def release_slot(self, tab, node):
+        """
+        回收行控件：先把未同步的输入写回数据模型
+        :param tab: 标签页框架
+        :param node: 行
+        """
+        slot = tab.bound.pop(node)
+        if slot in tab.pending_rows:
+            self.sync_row(tab, slot)
+            tab.pending_rows.discard(slot)
+        try:
+            if self.root.focus_get() is slot.text:
+                tab.canvas.focus_set()
+        except KeyError:
+            pass
+        slot.frame.place_forget()
+        slot.node = slot.shown = slot.y = None
+        tab.free_slots.append(slot)
+
+    def on_row_focus(self, tab, slot):
+        """
+        记录焦点所在的行，新行将插入在它之后
+        """
+        if slot.node is not None:
+            tab.focus_node = slot.node
+
+    def focus_row(self, tab, node, cursor="end"):
+        """
+        把焦点移到指定行，必要时先滚动使其可见
+        :param tab: 标签页框架
+        :param node: 行
+        :param cursor: 光标位置
+        """
+        tab.focus_node = node
+        self.scroll_into_view(tab, node.index)
+        self.render_rows(tab)
+        slot = tab.bound.get(node)
+        if slot is not None:
+            slot.text.focus_set()
+            slot.text.mark_set("insert", cursor)
+
+    # ====== 自定义粘贴逻辑，去掉 Excel 自带换行 ======
+    def clean_paste(self, tab, slot):
+        """
+        自定义粘贴逻辑，去除Excel自带换行和多余空格；
+        多行或含制表符的内容（如从表格中复制的一列）在当前行之后批量插入为多行
+        """
+        tw = slot.text
+        try:
+            pasted = tw.selection_get(selection='CLIPBOARD')
+        except tk.TclError:
+            return "break"  # 没有剪贴板内容
+
+        # 去掉 Excel 自带的结尾换行
+        pasted = pasted.rstrip("\r\n")
+        if "\n" in pasted or "\r" in pasted or "\t" in pasted:
+            self.paste_rows(tab, slot, pasted_rows(pasted))
+            return "break"
+
+        # 去除前后空格
+        pasted = pasted.strip()
+
+        # 如果有选中内容，先删除
+        if tw.tag_ranges("sel"):
+            tw.delete("sel.first", "sel.last")
+
+        # 插入清理过的文本
+        tw.insert("insert", pasted)
+
+        # 更新显示
+        self.schedule_update(tab, slot)
+
+        return "break"  # 阻止默认粘贴
+
+    def paste_rows(self, tab, slot, rows):
+        """
+        批量粘贴多行：当前行为空时第一行填入当前行，其余的行一次插入到当前行之后，只重算、布局一次
+        :param tab: 标签页框架
+        :param slot: 粘贴所在的行控件
+        :param rows: 各行文本
+        """
+        tw = slot.text
+        # 此前的输入单独成为一步，粘贴（填入当前行并插入其余的行）作为一步撤销
+        self.sync_pending(tab)
+        tab.history.begin()
+        if tw.tag_ranges("sel"):
+            tw.delete("sel.first", "sel.last")
+        if not tw.get("1.0", "end-1c").strip():
+            tw.delete("1.0", "end")
+            tw.insert("1.0", rows[0])
+            self.sync_row(tab, slot)
+            rows = rows[1:]
+        if rows:
+            self.add_input_rows(tab, rows, slot.node.index + 1)
+        tab.history.end()
+        if not rows:
+            self.schedule_update(tab)
+            return
+        self.focus_row(tab, tab.focus_node)
+
+    def paste_array(self, tab, slot):
+        """
+        把剪贴板中的一列数值作为一个数组粘贴（Ctrl+Shift+V）：
+        当前行为空且有表头时生成 "表头 = [...]"，否则在光标处插入数组
+        """
+        tw = slot.text
+        try:
+            pasted = tw.selection_get(selection='CLIPBOARD')
+        except tk.TclError:
+            return "break"
+        array = pasted_array(pasted)
+        if array is None:
+            self.status.config(text="剪贴板中不是一列数值，无法作为数组粘贴")
+            return "break"
+        name, literal = array
+        if tw.tag_ranges("sel"):
+            tw.delete("sel.first", "sel.last")
+        if name is not None and not tw.get("1.0", "end-1c").strip():
+            literal = f"{name} = {literal}"
+        tw.insert("insert", literal)
+        self.schedule_update(tab, slot)
+        return "break"
+
+    def on_double_click(self, event, text_widget):
+        """
+        处理双击事件，智能选择文本
+        :param event: 鼠标事件
+        :param text_widget: 文本控件
+        """
+        # 获取点击索引
+        index = text_widget.index(f"@{event.x},{event.y}")
+        line, char = map(int, index.split('.'))
+        # 获取当前行内容
+        line_text = text_widget.get(f"{line}.0", f"{line}.end")
+        # 计算点击位置在行文本中的偏移
+        offset = char
+
+        # 先尝试处理引号内内容的选择
+        quote_left = -1
+        quote_right = -1
+
+        # 检查是否在双引号内
+        if offset < len(line_text) and line_text[offset] == '"':
+            # 点击位置就是引号，查找匹配的引号
+            quote_left = offset
+            # 从当前位置向后查找下一个引号
+            quote_right = line_text.find('"', offset + 1)
+        elif offset > 0 and offset <= len(line_text):
+            # 检查是否在两个引号之间
+            # 查找左边最近的引号
+            quote_left = line_text.rfind('"', 0, offset)
+            if quote_left != -1:
+                # 查找右边对应的引号
+                quote_right = line_text.find('"', quote_left + 1)
+                # 确保点击位置在两个引号之间
+                if quote_right != -1 and quote_left < offset < quote_right:
+                    pass  # 已经找到有效的引号对
+                else:
+                    quote_left = -1
+                    quote_right = -1
+
+        # 如果找到有效的引号对，则选中引号内的内容
+        if quote_left != -1 and quote_right != -1:
+            text_widget.tag_remove("sel", f"{line}.0", f"{line}.end")
+            # 选中引号之间的内容（不包括引号本身）
+            text_widget.tag_add("sel", f"{line}.{quote_left + 1}", f"{line}.{quote_right}")
+            return "break"  # 阻止默认双击行为
+
+        # 否则执行原有的数字选择功能
+        left = offset
+        right = offset
+        while left > 0 and (line_text[left - 1].isdigit() or line_text[left - 1] == "."):
+            left -= 1
+        while right < len(line_text) and (line_text[right].isdigit() or line_text[right] == "."):
+            right += 1
+        # 选中数字
+        text_widget.tag_remove("sel", f"{line}.0", f"{line}.end")
+        if left != right:
+            text_widget.tag_add("sel", f"{line}.{left}", f"{line}.{right}")
+        return "break"  # 阻止默认双击行为
+
+    def on_backspace(self, tab, slot):
+        """
+        处理退格键事件，当文本框为空时删除行
+        """
+        content = slot.text.get("1.0", "end-1c")
+        if content != "":
+            return None
+        node = slot.node
+        if node is not None and tab.graph.alive(node):
+            # 先同步尚未同步的输入，撤销删除时恢复的是删除前的（空）内容
+            self.sync_row(tab, slot)
+            idx = node.index
+            tab.pending_rows.discard(slot)
+            self.release_slot(tab, node)
+            tab.graph.delete(idx)
+            self.journal_append("delete", sheet=tab.position, row=idx)
+            # 删除最后一行时自动添加的空行与删除合为一步
+            tab.history.begin()
+            self.record_edit(tab, idx, (node.text,), ())
+            self.invalidate_offsets(tab, idx)
+            if idx-1 >= 0:
+                self.update_all(tab)
+                self.focus_row(tab, tab.graph.rows[idx-1])
+            elif not tab.graph.rows:
+                self.add_input_row(tab)
+            else:
+                self.update_all(tab)
+            tab.history.end()
+        return "break"
+
+    def on_return(self, tab, slot):
+        """
+        处理回车键事件，在当前行之后添加新行并设置焦点
+        """
+        self.on_row_focus(tab, slot)
+        self.add_input_row(tab)
+        return "break"
+
+    def copy_result(self, slot):
+        """
+        双击复制结果到剪贴板：计算成功时复制完整的值（不受显示的有效数字和截断影响）
+        :param slot: 行控件
+        """
+        node = slot.node
+        if node is not None and node.ok and node.kind != "empty" and node.job is None:
+            result_text = full_value_text(node.value)
+        else:
+            # 获取标签文本并去除前缀"= "
+            result_text = slot.label.cget("text")
+            if result_text.startswith("= "):
+                result_text = result_text[2:]
+
+        # 复制到剪贴板
+        self.root.clipboard_clear()
+        self.root.clipboard_append(result_text)
+        self.root.update()
+
+    # ================= 撤销/重做 =================
+    def record_edit(self, tab, row, before, after, typing=False):
+        """
+        把一处行替换记入标签页的撤销历史
+        :param tab: 标签页框架
+        :param row: 起始行号
+        :param before: 替换前的各行文本
+        :param after: 替换后的各行文本
+        :param typing: 是否为输入引起的单行修改
+        """
+        self.history_seq += 1
+        self.sheet_undone.clear()
+        tab.history.record(self.history_seq, row, tuple(before), tuple(after), typing)
+
+    def record_sheet_step(self, *edit):
+        """
+        把 sheet 的删除 ("delete", 标签页, 位置, 名称) 或改名 ("rename", 标签页, 旧名称, 新名称, 改写的行) 记入工作簿的撤销历史；
+        超过 UNDO_SHEET_STEPS 步时丢弃最早的一步，被删除的标签页这时才真正销毁
+        """
+        self.history_seq += 1
+        self.sheet_undone.clear()
+        self.sheet_history.append(HistoryStep(self.history_seq, edit))
+        while len(self.sheet_history) > UNDO_SHEET_STEPS:
+            dropped = self.sheet_history.popleft().edits
+            if dropped[0] == "delete":
+                dropped[1].destroy()
+
+    def undo(self):
+        """
+        Ctrl+Z：撤销当前 sheet 中最近的修改，或最近一次 sheet 删除/改名（以较晚的为准）
+        """
+        tab = self.current_tab()
+        if tab is not None and tab.built:
+            self.sync_pending(tab)
+        step = tab.history.done[-1] if tab is not None and tab.history.done else None
+        if self.sheet_history and (step is None or self.sheet_history[-1].seq > step.seq):
+            self.history_seq += 1
+            step = self.sheet_history.pop()
+            step.seq = self.history_seq
+            self.sheet_undone.append(step)
+            self.apply_sheet_step(step.edits, undo=True)
+        elif step is not None:
+            self.history_seq += 1
+            self.apply_row_step(tab, tab.history.undo(self.history_seq), undo=True)
+        else:
+            self.status.config(text="没有可以撤销的修改")
+        return "break"
+
+    def redo(self):
+        """
+        Ctrl+Y / Ctrl+Shift+Z：重做最近撤销的修改
+        """
+        tab = self.current_tab()
+        if tab is not None and tab.built:
+            self.sync_pending(tab)
+        step = tab.history.undone[-1] if tab is not None and tab.history.undone else None
+        if self.sheet_undone and (step is None or self.sheet_undone[-1].seq > step.seq):
+            self.history_seq += 1
+            step = self.sheet_undone.pop()
+            step.seq = self.history_seq
+            self.sheet_history.append(step)
+            self.apply_sheet_step(step.edits, undo=False)
+        elif step is not None:
+            self.history_seq += 1
+            self.apply_row_step(tab, tab.history.redo(self.history_seq), undo=False)
+        else:
+            self.status.config(text="没有可以重做的修改")
+        return "break"
+
+    def apply_row_step(self, tab, step, undo):
+        """
+        撤销或重做一步行修改：只替换记录中的行，依赖图只重算这些行及其下游行
+        :param tab: 标签页框架
+        :param step: 撤销历史中的一步
+        :param undo: True 为撤销，False 为重做
+        """
+        self.build_tab(tab)
+        if undo:
+            for row, before, after in reversed(step.edits):
+                self.splice_rows(tab, row, len(after), before)
+        else:
+            for row, before, after in step.edits:
+                self.splice_rows(tab, row, len(before), after)
+        rows = tab.graph.rows
+        if not rows:
+            self.add_input_row(tab, record=False)
+            return
+        touched = tab.graph.recalculate(deadline=time.perf_counter() + FRAME_BUDGET)
+        tab.layout_dirty.update(rows[i] for i in touched)
+        self.focus_row(tab, rows[min(step.edits[0][0], len(rows) - 1)])
+        self.schedule_background(tab)
+
+    def splice_rows(self, tab, row, count, texts):
+        """
+        把从 row 开始的 count 行替换为 texts，并写入自动保存日志
+        :param tab: 标签页框架
+        :param row: 起始行号
+        :param count: 被替换的行数
+        :param texts: 替换后的各行文本
+        """
+        graph = tab.graph
+        sheet = tab.position
+        common = min(count, len(texts))
+        for i in range(common):
+            if graph.set_text(row + i, texts[i]):
+                self.journal_append("set", sheet=sheet, row=row + i, text=texts[i])
+                slot = tab.bound.get(graph.rows[row + i])
+                if slot is not None:
+                    tab.pending_rows.discard(slot)
+                    slot.text.delete("1.0", "end")
+                    slot.text.insert("1.0", texts[i])
+                    self.highlight_row(slot.text, texts[i])
+        if len(texts) > common:
+            graph.insert_many(row + common, texts[common:])
+            self.journal_append("insert", sheet=sheet, row=row + common, texts=list(texts[common:]))
+        if count > common:
+            removed = graph.rows[row + common:row + count]
+            for node in removed:
+                if node in tab.bound:
+                    tab.pending_rows.discard(tab.bound[node])
+                    self.release_slot(tab, node)
+            graph.delete_many(row + common, len(removed))
+            self.journal_append("delete", sheet=sheet, row=row + common, count=len(removed))
+        self.invalidate_offsets(tab, row)
+
+    def apply_sheet_step(self, edit, undo):
+        """
+        撤销或重做一次 sheet 删除/改名
+        :param edit: 记录的修改，见 record_sheet_step
+        :param undo: True 为撤销，False 为重做
+        """
+        kind, tab = edit[0], edit[1]
+        if kind == "delete":
+            if undo:
+                self.restore_sheet(tab, edit[2], edit[3])
+            else:
+                self.delete_sheet(tab, record=False)
+        else:
+            self.retitle_sheet(tab, edit[2] if undo else edit[3], edit[4], undo)
+            self.select_sheet(tab)
+
+    def restore_sheet(self, tab, index, title):
+        """
+        撤销删除：把保留的标签页放回原位置，引用它的行和它自己的跨 sheet 引用随后重算
+        :param tab: 标签页框架
+        :param index: 原位置
+        :param title: 名称
+        """
+        contents = [node.text for node in tab.graph.rows] if tab.graph is not None else list(tab.contents)
+        self.journal_append("add_sheet", sheet=index, title=title, contents=contents)
+        self.notebook.insert(index if index < len(self.sheet_order) else "end", tab)
+        self.register_sheet(tab, index)
+        if tab.graph is not None:
+            self.workbook_index.add(title, tab.graph)
+            self.workbook_index.rewatch(tab.graph)
+            # 删除期间被引用的 sheet 可能已经变化
+            for key in list(tab.graph.readers):
+                if XREF_MARK in key:
+                    tab.graph.mark_readers(key)
+        self.select_sheet(tab)
+        if tab.built:
+            self.schedule_update(tab)
+        else:
+            self.schedule_warm()
+
+    # ================= 符号 =================
+    def tab_of(self, graph):
+        """
+        返回依赖图所属的标签页，没有时为 None
+        """
+        for tab in self.sheet_order:
+            if tab.graph is graph:
+                return tab
+        return None
+
+    def settle_sheet(self, tab):
+        """
+        跳转或查找之前，把标签页中尚未同步和尚未重算的行算完，使定义和引用关系是最新的
+        :param tab: 标签页框架
+        """
+        if tab.built:
+            self.sync_pending(tab)
+        if tab.graph is not None and tab.graph.dirty:
+            touched = tab.graph.recalculate()
+            if tab.built:
+                tab.layout_dirty.update(tab.graph.rows[i] for i in touched)
+                self.schedule_background(tab)
+
+    def symbol_at_cursor(self):
+        """
+        返回当前行光标处的变量引用
+        :return: (标签页, 行, 引用名)，光标不在变量名上时为 None
+        """
+        tab = self.current_tab()
+        if tab is None or not tab.built or tab.focus_node is None:
+            return None
+        node = tab.focus_node
+        slot = tab.bound.get(node)
+        if slot is None or not tab.graph.alive(node):
+            return None
+        self.settle_sheet(tab)
+        offset = int(slot.text.index("insert").split(".")[1])
+        for token in tokenize_row(node.text):
+            if token.kind in ("name", "xref") and token.start <= offset <= token.end:
+                return tab, node, token.text if token.kind == "name" else xref_key(token.text)
+        return None
+
+    def goto_row(self, tab, node, name=None):
+        """
+        切换到标签页并把焦点移到指定行
+        :param tab: 标签页框架
+        :param node: 行
+        :param name: 变量名，给定时光标放在该行中它第一次出现的位置
+        """
+        self.select_sheet(tab)
+        self.build_tab(tab)
+        cursor = "end"
+        if name is not None:
+            for token in tokenize_row(node.text):
+                if (token.kind == "name" and token.text == name or
+                        token.kind == "xref" and split_ref(xref_key(token.text))[1] == name):
+                    cursor = f"1.{token.start}"
+                    break
+        self.focus_row(tab, node, cursor)
+
+    def jump_to_definition(self):
+        """
+        F3：跳到光标处变量的定义，即这一行计算时实际用到的那一行
+        """
+        found = self.symbol_at_cursor()
+        if found is None:
+            return "break"
+        tab, node, ref = found
+        if XREF_MARK in ref:
+            title = split_ref(ref)[0]
+            target = self.workbook_index.sheets.get(title) or self.open_sheet(title)
+            target_tab = self.tab_of(target) if target is not None else None
+            if target_tab is not None:
+                self.settle_sheet(target_tab)
+        definition = tab.graph.definition(ref, node.index)
+        if definition is None:
+            self.status.config(text=f"未找到 {ref} 的定义")
+            return "break"
+        graph, definer = definition
+        target_tab = self.tab_of(graph)
+        if target_tab is not None:
+            self.goto_row(target_tab, definer, definer.name)
+        return "break"
+
+    def find_usages(self):
+        """
+        Shift+F3：在符号面板中列出光标处变量在整个工作簿中的定义和用法
+        """
+        found = self.symbol_at_cursor()
+        if found is not None:
+            self.show_symbols(split_ref(found[2])[1] if XREF_MARK in found[2] else found[2])
+        return "break"
+
+    def build_symbol_panel(self):
+        """
+        创建符号面板：变量名过滤框、符号列表，以及选中变量的定义和用法列表
+        """
+        panel = self.symbol_panel = tk.Frame(self.root, bd=1, relief="groove")
+        tk.Label(panel, text="查找变量（Esc 关闭）", anchor="w", font=(self.font_family, 9)).pack(fill="x", padx=4, pady=(4, 0))
+        self.symbol_filter = tk.Entry(panel, font=(self.font_family, 10))
+        self.symbol_filter.pack(fill="x", padx=4, pady=2)
+        self.symbol_filter.bind("<KeyRelease>", lambda e: self.refresh_symbols())
+        self.symbol_filter.bind("<Return>", lambda e: self.select_symbol(0))
+        self.symbol_filter.bind("<Escape>", lambda e: self.hide_symbols())
+        self.symbol_list = tk.Listbox(panel, height=12, width=30, exportselection=False, font=(self.font_family, 10))
+        self.symbol_list.pack(fill="x", padx=4)
+        self.symbol_list.bind("<<ListboxSelect>>", lambda e: self.select_symbol())
+        self.usage_list = tk.Listbox(panel, width=30, exportselection=False, font=(self.font_family, 10))
+        self.usage_list.pack(fill="both", expand=True, padx=4, pady=4)
+        self.usage_list.bind("<Double-Button-1>", lambda e: self.open_usage())
+        self.usage_list.bind("<Return>", lambda e: self.open_usage())
+        self.usage_list.bind("<Escape>", lambda e: self.hide_symbols())
+        self.symbol_names = []    # 符号列表中显示的变量名
+        self.usage_rows = []      # 用法列表中显示的 (标签页, 行)
+        self.symbol_name = None   # 用法列表对应的变量名
+
+    def show_symbols(self, name=None):
+        """
+        Ctrl+Shift+F：打开符号面板
+        :param name: 变量名，给定时直接列出它的定义和用法
+        """
+        if self.symbol_panel is None:
+            self.build_symbol_panel()
+        self.symbol_panel.pack(side="right", fill="y", before=self.notebook)
+        # 尚未打开的标签页也建立依赖图，其中的变量才能被找到；未算完的行在空闲时继续计算
+        for tab in self.sheet_order:
+            self.ensure_model(tab)
+        self.schedule_warm()
+        if name is not None:
+            self.symbol_filter.delete(0, "end")
+            self.symbol_filter.insert(0, name)
+        self.refresh_symbols()
+        if name is not None:
+            self.select_symbol(self.symbol_names.index(name) if name in self.symbol_names else None)
+        self.symbol_filter.focus_set()
+        return "break"
+
+    def hide_symbols(self):
+        """
+        关闭符号面板，焦点回到当前行
+        """
+        self.symbol_panel.pack_forget()
+        tab = self.current_tab()
+        if tab is not None and tab.built and tab.focus_node is not None and tab.graph.alive(tab.focus_node):
+            self.focus_row(tab, tab.focus_node)
+        return "break"
+
+    def refresh_symbols(self):
+        """
+        按过滤框的内容刷新符号列表
+        """
+        self.symbol_names = self.workbook_index.find_symbols(self.symbol_filter.get())
+        self.symbol_list.delete(0, "end")
+        if self.symbol_names:
+            self.symbol_list.insert("end", *self.symbol_names)
+
+    def select_symbol(self, position=None):
+        """
+        在用法列表中列出符号列表中选中的变量的定义和用法
+        :param position: 符号列表中的位置，默认为当前选中的项
+        """
+        if position is None:
+            selection = self.symbol_list.curselection()
+            position = selection[0] if selection else None
+        if position is None or position >= len(self.symbol_names):
+            return "break"
+        self.symbol_list.selection_clear(0, "end")
+        self.symbol_list.selection_set(position)
+        self.symbol_list.see(position)
+        name = self.symbol_name = self.symbol_names[position]
+        occurrences = self.workbook_index.occurrences(name)
+        self.usage_rows = []
+        lines = []
+        defined = used = 0
+        for tab in self.sheet_order:
+            title = tab.title
+            for node, defines in occurrences.get(tab.graph, ()):
+                if defines:
+                    defined += 1
+                else:
+                    used += 1
+                if len(lines) < SYMBOL_USAGE_LIMIT:
+                    lines.append(f"{title}:{node.index + 1}  {'定义' if defines else '引用'}  {node.text.strip()}")
+                    self.usage_rows.append((tab, node))
+        self.usage_list.delete(0, "end")
+        if lines:
+            self.usage_list.insert("end", *lines)
+        more = f"（只列出前 {SYMBOL_USAGE_LIMIT} 处）" if defined + used > SYMBOL_USAGE_LIMIT else ""
+        self.status.config(text=f"{name}：{defined} 处定义，{used} 处引用{more}")
+        return "break"
+
+    def open_usage(self):
+        """
+        跳到用法列表中选中的行
+        """
+        selection = self.usage_list.curselection()
+        if not selection:
+            return "break"
+        tab, node = self.usage_rows[selection[0]]
+        if not self.sheet_alive(tab) or not tab.graph.alive(node):
+            self.status.config(text="该行已被删除")
+            return "break"
+        self.goto_row(tab, node, self.symbol_name)
+        return "break"
+
+    # ================= 虚拟化渲染 =================
+    def render_rows(self, tab):
+        """
+        渲染可见区域：把池中的行控件绑定到可见行并摆放到对应位置，
+        离开可见区域的行控件回收复用，控件数量只与窗口高度有关
+        :param tab: 标签页框架
+        """
+        started = self.profiler.start()
+        canvas_w = self.canvas_width(tab)
+        rows = tab.graph.rows
+        # 内容变少或窗口变高后，滚动位置不能超过内容末尾
+        tab.scroll_y = max(0, min(tab.scroll_y, self.content_height(tab) - self.canvas_height(tab)))
+        # 先测量可见行，高度变化会改变可见范围，直到范围稳定
+        for _ in range(3):
+            first, last = self.visible_rows(tab)
+            for node in rows[first:last]:
+                self.measure_row(tab, node, canvas_w)
+            if tab.offsets_from >= len(rows):
+                break
+        first, last = self.visible_rows(tab)
+        visible = rows[first:last]
+
+        keep = set(visible)
+        for node in [n for n in tab.bound if n not in keep]:
+            self.release_slot(tab, node)
+
+        for node in visible:
+            slot = tab.bound.get(node)
+            if slot is None:
+                slot = self.acquire_slot(tab, node)
+            shown = (self.result_text(node), node.width, node.lines)
+            if slot.shown != shown:
+                slot.label.config(text=shown[0])
+                slot.text.config(width=shown[1], height=shown[2])
+                slot.shown = shown
+            y = tab.offsets[node.index] - tab.scroll_y + ROW_PAD_Y
+            if slot.y != y:
+                slot.frame.place(x=0, y=y, relwidth=1)
+                slot.y = y
+
+        # 添加按钮放在最后一行之后
+        tab.add_button.place(relx=0.5, y=tab.offsets[len(rows)] - tab.scroll_y + 5, anchor="n")
+        self.update_scrollbar(tab)
+        self.profiler.stop("刷新", started, len(visible))
+
+    def visible_rows(self, tab):
+        """
+        计算可见行的范围
+        :param tab: 标签页框架
+        :return: (第一行, 最后一行之后)
+        """
+        self.ensure_offsets(tab)
+        top = tab.scroll_y
+        bottom = top + self.canvas_height(tab)
+        first = max(0, bisect.bisect_right(tab.offsets, top) - 1)
+        last = min(len(tab.graph.rows), bisect.bisect_left(tab.offsets, bottom))
+        return first, last
+
+    def row_height(self, lines):
+        """
+        行高（像素），包括行间距
+        :param lines: 输入框的行数
+        """
+        return self.row_base_height + (lines - 1) * self.line_height
+
+    def invalidate_offsets(self, tab, index):
+        """
+        标记从 index 行起的纵向偏移需要重新计算
+        """
+        tab.offsets_from = min(tab.offsets_from, index)
+
+    def ensure_offsets(self, tab):
+        """
+        重新计算失效部分的纵向偏移
+        :param tab: 标签页框架
+        """
+        rows = tab.graph.rows
+        start = tab.offsets_from
+        if start >= len(rows) and len(tab.offsets) == len(rows) + 1:
+            return
+        offsets = tab.offsets
+        del offsets[start + 1:]
+        y = offsets[start]
+        for node in rows[start:]:
+            y += self.row_height(node.lines)
+            offsets.append(y)
+        tab.offsets_from = len(rows)
+
+    def content_height(self, tab):
+        """
+        内容总高度（含添加按钮）
+        """
+        self.ensure_offsets(tab)
+        return tab.offsets[-1] + ADD_BUTTON_SPACE
+
+    # ================= 滚动 =================
+    def scroll_to(self, tab, y):
+        """
+        滚动到指定的纵向偏移
+        :param tab: 标签页框架
+        :param y: 可见区域顶部的偏移（像素）
+        """
+        max_y = max(0, self.content_height(tab) - self.canvas_height(tab))
+        y = int(min(max(0, y), max_y))
+        if y != tab.scroll_y:
+            tab.scroll_y = y
+            self.render_rows(tab)
+
+    def scroll_into_view(self, tab, index):
+        """
+        滚动使指定行完整可见
+        :param tab: 标签页框架
+        :param index: 行号
+        """
+        self.ensure_offsets(tab)
+        top, bottom = tab.offsets[index], tab.offsets[index + 1]
+        view_h = self.canvas_height(tab)
+        if top < tab.scroll_y:
+            self.scroll_to(tab, top)
+        elif bottom > tab.scroll_y + view_h:
+            self.scroll_to(tab, bottom - view_h + ADD_BUTTON_SPACE)
 
-        # 状态文件恢复
-        # 绑定窗口关闭事件
-        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
-        # 如果存在状态文件，则加载状态，否则创建新标签页
-        if os.path.exists(STATE_FILE):
-            try:
-                self.load_state()
-            except Exception:
-                self.add_tab()
-        else:
-            self.add_tab()
+    def on_scrollbar(self, tab, action, *args):
+        """
+        处理滚动条拖动和点击
+        :param tab: 标签页框架
+        :param action: moveto / scroll
+        """
+        if action == "moveto":
+            self.scroll_to(tab, float(args[0]) * self.content_height(tab))
+        elif action == "scroll":
+            amount, unit = int(args[0]), args[1]
+            step = self.canvas_height(tab) * 0.9 if unit == "pages" else self.row_base_height
+            self.scroll_to(tab, tab.scroll_y + amount * step)
 
-    # ================= Sheet 滚动逻辑 =================
-    def update_sheet_scrollregion(self, event=None):
+    def update_scrollbar(self, tab):
         """
-        更新sheet栏的滚动区域
+        按可见区域更新滚动条位置
+        :param tab: 标签页框架
         """
-        self.sheet_canvas.configure(scrollregion=self.sheet_canvas.bbox("all"))
+        total = max(1, self.content_height(tab))
+        first = tab.scroll_y / total
+        last = min(1.0, (tab.scroll_y + self.canvas_height(tab)) / total)
+        tab.scrollbar.set(first, last)
 
-    def scroll_sheets(self, event):
+    def on_mouse_wheel(self, event):
         """
-        处理鼠标滚轮事件，滚动sheet栏
+        处理鼠标滚轮：在 sheet 栏上时横向滚动 sheet 栏，否则纵向滚动当前 sheet
         :param event: 鼠标事件
         """
+        if str(event.widget).startswith(str(self.sheet_canvas)):
+            self.scroll_sheets(event)
+            return
+        tab = self.current_tab()
+        if tab is None or not tab.built:
+            return
         if event.delta:
             # Windows系统滚动
-            self.sheet_canvas.xview_scroll(-1*(event.delta//120), "units")
+            steps = -1*(event.delta//120)
         else:
             # Linux系统滚动
-            if event.num == 4:
-                self.sheet_canvas.xview_scroll(-1, "units")
-            elif event.num == 5:
-                self.sheet_canvas.xview_scroll(1, "units")
+            steps = -1 if event.num == 4 else 1
+        self.scroll_to(tab, tab.scroll_y + steps * 3 * self.line_height)
 
-    # ================= 添加新 Sheet =================
-    def add_tab(self, title=None, contents=None):
+    def current_tab(self):
         """
-        添加新的标签页
-        :param title: 标签页标题
-        :param contents: 标签页内容
+        返回当前选中的标签页
         """
-        # 创建新的标签页框架
-        tab = tk.Frame(self.notebook, bg="white")
-        tab_name = title if title else f"Sheet{len(self.notebook.tabs())+1}"
-        self.notebook.add(tab, text=tab_name)
-
-        # 创建sheet栏按钮
-        btn = tk.Button(self.sheet_frame, text=tab_name, relief="raised")
-        btn.pack(side="left", padx=2, pady=2)
-        # 绑定点击事件选择标签页
-        btn.bind("<Button-1>", lambda e, t=tab: self.notebook.select(t))
-        # 绑定双击事件重命名标签页
-        btn.bind("<Double-1>", lambda e, b=btn: self.rename_sheet(b))
-        # 绑定右键事件删除标签页
-        btn.bind("<Button-3>", lambda e, b=btn, t=tab: self.delete_sheet(b, t))  # 右键删除
-
-        self.sheets.append(btn)
-        self.update_sheet_scrollregion()
-
-        # ====== Tab 内容初始化 ======
-        # 初始化标签页变量和条目
-        tab.variables = {}
-        tab.entries = []
-        # 创建内容画布
-        tab.canvas = tk.Canvas(tab, bg="white", highlightthickness=0)
-        tab.canvas.pack(fill=tk.BOTH, expand=True)
-        # 创建内容框架
-        tab.frame = tk.Frame(tab.canvas, bg="white")
-        tab.canvas.create_window((0,0), window=tab.frame, anchor="nw")
-        # 绑定画布配置事件
-        tab.canvas.bind("<Configure>", lambda e, t=tab: self.on_canvas_configure(t))
-        # 添加新行按钮
-        tab.add_button = tk.Button(tab.frame, text="+", command=lambda t=tab: self.add_input_row(t))
-        tab.add_button.pack(pady=5)
-
-        # 添加内容行
-        if contents:
-            for expr in contents:
-                self.add_input_row(tab, expr)
-        else:
-            self.add_input_row(tab)
+        selected = self.notebook.select()
+        return self.notebook.nametowidget(selected) if selected else None
 
-    def delete_sheet(self, button, tab):
+    # ================= 布局 =================
+    def measure_row(self, tab, node, canvas_w):
         """
-        删除标签页
-        :param button: 标签页按钮
+        计算一行输入框的宽度（字符数）和行数；文本、结果和画布宽度都未变化时直接返回
         :param tab: 标签页框架
+        :param node: 行
+        :param canvas_w: 画布宽度
         """
-        # 至少保留一个标签页
-        if len(self.sheets) <= 1:
+        result = self.result_text(node)
+        layout_key = (node.text, result, canvas_w)
+        if node.layout_key == layout_key:
             return
-        idx = self.sheets.index(button)
-        self.notebook.forget(tab)
-        button.destroy()
-        self.sheets.pop(idx)
-        # 如果还有标签页，选择最后一个
-        if self.notebook.tabs():
-            self.notebook.select(self.notebook.tabs()[-1])
+        node.layout_key = layout_key
+        tab.layout_dirty.discard(node)
+        width, lines = self.row_geometry(node.text, result, canvas_w)
+        node.width = width
+        if lines != node.lines:
+            node.lines = lines
+            self.invalidate_offsets(tab, node.index)
 
-    def rename_sheet(self, button):
+    def update_font(self):
         """
-        重命名标签页
-        :param button: 标签页按钮
+        按当前字体大小更新字体、字体度量缓存和行高
         """
-        old_name = button['text']
-        # 创建输入框用于重命名
-        entry = tk.Entry(self.sheet_frame)
-        entry.insert(0, old_name)
-        entry.select_range(0, tk.END)
-        entry.focus()
-        # 定位输入框位置和大小
-        entry.place(x=button.winfo_x(), y=button.winfo_y(), width=button.winfo_width(), height=button.winfo_height())
-
-        def save_name(event=None):
-            """
-            保存新的标签页名称
-            """
-            new_name = entry.get().strip() or old_name
-            idx = self.sheets.index(button)
-            self.notebook.tab(idx, text=new_name)
-            button.config(text=new_name)
-            entry.destroy()
-
-        # 绑定回车和失去焦点事件保存名称
-        entry.bind("<Return>", save_name)
-        entry.bind("<FocusOut>", save_name)
+        self.default_font = (self.font_family, self.font_size)
+        self.metrics = FontMetrics.of(tkfont.Font(font=self.default_font))
+        # 行高：单行输入框的高度加上下间距，每多一行增加一个行距
+        self.line_height = self.metrics.linespace
+        probe = tk.Text(self.root, height=1, font=self.default_font, bd=1, relief="solid", padx=2, pady=2)
+        self.row_base_height = probe.winfo_reqheight() + 2 * ROW_PAD_Y
+        probe.destroy()
 
-    # ================= 输入框逻辑 =================
-    def add_input_row(self, tab, initial_text="", insert_after_current=True):
+    def zoom(self, step):
         """
-        添加输入行
-        :param tab: 标签页框架
-        :param initial_text: 初始文本
-        :param insert_after_current: 是否在当前选中行后插入
+        缩放：改变字体大小，已创建的行控件改用新字体，所有行按新的字体度量重新测量
+        :param step: 字体大小的变化量，0 为恢复默认大小
         """
-        # 创建行框架
-        row_frame = tk.Frame(tab.frame, bg="white")
-
-        # 确定插入位置
-        insert_index = len(tab.entries)
-        if insert_after_current:
-            # 查找当前焦点所在的行
-            for i, (text_widget, _, _) in enumerate(tab.entries):
-                if text_widget.focus_get() == text_widget:
-                    insert_index = i + 1
-                    break
-
-        # 创建文本输入框
-        text = tk.Text(row_frame, height=1, wrap="word", font=self.default_font,
-                       bd=1, relief="solid", padx=2, pady=2)
-        text.insert("1.0", initial_text)
-        text.pack(side="left", padx=(6,4))
-        # 配置注释样式
-        text.tag_configure("comment", foreground="green")
-
-        # 创建结果显示标签
-        result_label = tk.Label(row_frame, text="= ?", bg="white", fg="blue", font=self.default_font, anchor="w")
-        result_label.pack(side="left", padx=(4,10))
-
-        # 添加双击复制功能
-        result_label.bind("<Double-Button-1>", lambda e, rl=result_label: self.copy_result(rl))
-
-        # 将输入框、结果标签和行框架插入到指定位置
-        tab.entries.insert(insert_index, (text, result_label, row_frame))
-
-        # 打包行框架到指定位置
-        if insert_index == len(tab.entries) - 1:
-            # 如果是最后一行，直接打包
-            row_frame.pack(fill="x", pady=3, anchor="w")
-        else:
-            # 否则插入到指定位置
-            row_frame.pack_forget()
-            row_frame.pack(fill="x", pady=3, anchor="w",
-                           before=tab.entries[insert_index + 1][2] if insert_index + 1 < len(tab.entries) else None)
-
-
-        # 重新放置添加按钮
-        tab.add_button.pack_forget()
-        tab.add_button.pack(pady=5)
-
-        # ====== 新增：自定义粘贴逻辑，去掉 Excel 自带换行 ======
-        def clean_paste(event, t=tab, tw=text, rl=result_label):
-            """
-            自定义粘贴逻辑，去除Excel自带换行和多余空格
-            """
-            try:
-                pasted = tw.selection_get(selection='CLIPBOARD')
-            except tk.TclError:
-                return "break"  # 没有剪贴板内容
+        size = DEFAULT_FONT_SIZE if step == 0 else max(MIN_FONT_SIZE, min(MAX_FONT_SIZE, self.font_size + step))
+        if size == self.font_size:
+            return
+        self.font_size = size
+        self.update_font()
+        for tab in self.sheet_order:
+            if not tab.built:
+                continue
+            for slot in list(tab.bound.values()) + tab.free_slots:
+                slot.text.config(font=self.default_font)
+                slot.label.config(font=self.default_font)
+                slot.shown = None
+            for node in tab.graph.rows:
+                node.layout_key = None
+            # 可见行立即重新测量，其余的行空闲时逐批测量
+            tab.layout_dirty.clear()
+            tab.layout_sweep = 0
+            self.invalidate_offsets(tab, 0)
+            self.render_rows(tab)
+            self.schedule_background(tab)
 
-            # 去掉 Excel 自带的结尾换行
-            pasted = pasted.rstrip("\r\n")
+    def row_geometry(self, content, result, canvas_w):
+        """
+        根据内容计算输入框大小（使用字体度量缓存，不调用 Tk 测量）
+        :param content: 行文本
+        :param result: 结果标签文本
+        :param canvas_w: 画布宽度
+        :return: (宽度字符数, 行数)
+        """
+        metrics = self.metrics
+        lines = content.split("\n") if content else [""]
+        # 计算最长行的像素宽度，空行设为一个最小宽度
+        longest_pixel = max((metrics.text_width(line) if line else metrics.zero for line in lines), default=0)
 
-            # 去除前后空格
-            pasted = pasted.strip()
+        # 计算可用像素宽度 = 画布宽 - 结果标签宽 - padding
+        result_req = metrics.text_width(result) + RESULT_LABEL_PAD
+        padding = 30
+        available_pixel = max(60, canvas_w - result_req - padding)
 
-            # 如果有选中内容，先删除
-            if tw.tag_ranges("sel"):
-                tw.delete("sel.first", "sel.last")
+        # 给一点额外 margin 防止紧贴
+        margin_pixel = 6
+        needed_pixel = longest_pixel + margin_pixel
 
-            # 插入清理过的文本
-            tw.insert("insert", pasted)
+        # 根据内容长度决定是否换行
+        if needed_pixel <= available_pixel:
+            # 一行能完整显示，不需要换行
+            return metrics.columns(needed_pixel), max(1, len(lines))
+        # 宽度受限，需要换行：以 available_pixel 为列宽换算列数，并估算需要的行数
+        width_chars = metrics.columns(available_pixel - 2)  # 留一点余量
+        # 需要的视觉行数 = ceil(最长行像素 / available_pixel)
+        return width_chars, max(1, math.ceil(longest_pixel / max(1, available_pixel)))
 
-            # 更新显示
-            self.adjust_row_size(t, tw, rl)
-            self.update_all(t)
+    def canvas_width(self, tab):
+        """
+        获取画布宽度，画布尚未显示时使用窗口宽度
+        :param tab: 标签页框架
+        """
+        canvas_w = tab.canvas.winfo_width()
+        if canvas_w <= 1:
+            canvas_w = max(self.root.winfo_width(), 300)
+        return canvas_w
 
-            return "break"  # 阻止默认粘贴
+    def canvas_height(self, tab):
+        """
+        获取画布高度，画布尚未显示时使用窗口高度
+        :param tab: 标签页框架
+        """
+        canvas_h = tab.canvas.winfo_height()
+        if canvas_h <= 1:
+            canvas_h = max(self.root.winfo_height(), 300)
+        return canvas_h
 
+    def flush_layout(self, tab, deadline):
+        """
+        在时间预算内测量屏幕外被标记的行；画布宽度变化后逐批重新测量整表
+        :param tab: 标签页框架
+        :param deadline: 截止时间（time.perf_counter）
+        """
+        started = self.profiler.start()
+        canvas_w = self.canvas_width(tab)
+        while tab.layout_dirty and time.perf_counter() < deadline:
+            node = tab.layout_dirty.pop()
+            if tab.graph.alive(node):
+                self.measure_row(tab, node, canvas_w)
+        if tab.layout_sweep is not None:
+            rows = tab.graph.rows
+            i = tab.layout_sweep
+            while i < len(rows) and time.perf_counter() < deadline:
+                self.measure_row(tab, rows[i], canvas_w)
+                i += 1
+            tab.layout_sweep = i if i < len(rows) else None
+        self.profiler.stop("布局", started)
 
-        # 绑定粘贴事件
-        text.bind("<<Paste>>", clean_paste)
+    def on_canvas_configure(self, tab):
+        """
+        处理画布配置事件：高度变化时重新渲染，宽度变化时节流地重新布局
+        :param tab: 标签页框架
+        """
+        if tab.canvas.winfo_width() != tab.layout_width:
+            if tab.resize_job is None:
+                tab.resize_job = self.root.after(RESIZE_THROTTLE_MS, lambda t=tab: self.on_canvas_resized(t))
+        else:
+            self.render_rows(tab)
 
-        def on_double_click(event, text_widget):
-            """
-            处理双击事件，智能选择文本
-            :param event: 鼠标事件
-            :param text_widget: 文本控件
-            """
-            # 获取点击索引
-            index = text_widget.index(f"@{event.x},{event.y}")
-            line, char = map(int, index.split('.'))
-            # 获取当前行内容
-            line_text = text_widget.get(f"{line}.0", f"{line}.end")
-            # 计算点击位置在行文本中的偏移
-            offset = char
-
-            # 先尝试处理引号内内容的选择
-            quote_left = -1
-            quote_right = -1
-
-            # 检查是否在双引号内
-            if offset < len(line_text) and line_text[offset] == '"':
-                # 点击位置就是引号，查找匹配的引号
-                quote_left = offset
-                # 从当前位置向后查找下一个引号
-                quote_right = line_text.find('"', offset + 1)
-            elif offset > 0 and offset <= len(line_text):
-                # 检查是否在两个引号之间
-                # 查找左边最近的引号
-                quote_left = line_text.rfind('"', 0, offset)
-                if quote_left != -1:
-                    # 查找右边对应的引号
-                    quote_right = line_text.find('"', quote_left + 1)
-                    # 确保点击位置在两个引号之间
-                    if quote_right != -1 and quote_left < offset < quote_right:
-                        pass  # 已经找到有效的引号对
-                    else:
-                        quote_left = -1
-                        quote_right = -1
-
-            # 如果找到有效的引号对，则选中引号内的内容
-            if quote_left != -1 and quote_right != -1:
-                text_widget.tag_remove("sel", f"{line}.0", f"{line}.end")
-                # 选中引号之间的内容（不包括引号本身）
-                text_widget.tag_add("sel", f"{line}.{quote_left + 1}", f"{line}.{quote_right}")
-                return "break"  # 阻止默认双击行为
-
-            # 否则执行原有的数字选择功能
-            left = offset
-            right = offset
-            while left > 0 and (line_text[left - 1].isdigit() or line_text[left - 1] == "."):
-                left -= 1
-            while right < len(line_text) and (line_text[right].isdigit() or line_text[right] == "."):
-                right += 1
-            # 选中数字
-            text_widget.tag_remove("sel", f"{line}.0", f"{line}.end")
-            if left != right:
-                text_widget.tag_add("sel", f"{line}.{left}", f"{line}.{right}")
-            return "break"  # 阻止默认双击行为
+    def on_canvas_resized(self, tab):
+        """
+        画布宽度变化后重新布局：可见行立即处理，屏幕外的行空闲时处理
+        :param tab: 标签页框架
+        """
+        tab.resize_job = None
+        tab.layout_width = tab.canvas.winfo_width()
+        tab.layout_sweep = 0
+        self.render_rows(tab)
+        self.schedule_background(tab)
 
-        # 绑定双击事件
-        text.bind("<Double-Button-1>", lambda e, tw=text: on_double_click(e, tw))
+    # ================= 重算调度 =================
+    def schedule_update(self, tab, slot=None):
+        """
+        安排一次合并后的重算：连续输入时取消尚未执行的重算并重新计时，
+        但最多推迟 MAX_COALESCE_MS，保证按住按键时结果仍会刷新
+        :param tab: 标签页框架
+        :param slot: 被编辑的行控件
+        """
+        now = time.perf_counter()
+        if slot is not None:
+            tab.pending_rows.add(slot)
+        # 新的输入优先：空闲时的后台任务由下一帧重新安排
+        if tab.background_job is not None:
+            self.root.after_cancel(tab.background_job)
+            tab.background_job = None
+        if tab.update_job is not None:
+            if (now - tab.pending_since) * 1000 >= MAX_COALESCE_MS:
+                return  # 已推迟太久，等待已安排的重算执行
+            self.root.after_cancel(tab.update_job)
+        else:
+            tab.pending_since = now
+            if slot is not None:
+                self.profiler.begin()  # 新的编辑：性能分析浮层改为统计这次重算
+        tab.update_job = self.root.after(FRAME_MS, lambda t=tab: self.run_scheduled_update(t))
 
-        # 绑定按键释放事件，调整大小并更新计算结果
-        text.bind("<KeyRelease>", lambda e, t=tab: (self.adjust_row_size(t, text, result_label), self.update_all(t)))
+    def run_scheduled_update(self, tab):
+        """
+        执行一帧的重算：先同步正在编辑的行，在时间预算内先重算正在编辑的行、可见行和它们的上游，
+        再按拓扑序重算其余的行；可见行立即刷新，剩余的行留到空闲时继续
+        :param tab: 标签页框架
+        """
+        tab.update_job = None
+        edited = [slot.node for slot in tab.pending_rows if slot.node is not None]
+        self.sync_pending(tab)
+        first, last = self.visible_rows(tab)
+        touched = tab.graph.recalculate(deadline=time.perf_counter() + FRAME_BUDGET,
+                                        targets=edited + tab.graph.rows[first:last])
+        tab.layout_dirty.update(tab.graph.rows[i] for i in touched)
+        self.render_rows(tab)
+        self.schedule_background(tab)
+        self.show_profile()
 
-        def on_backspace(event, t=tab, tw=text, rf=row_frame):
-            """
-            处理退格键事件，当文本框为空时删除行
-            """
-            content = tw.get("1.0", "end-1c")
-            if content == "":
-                idx = next((i for i, (tt, _, _) in enumerate(t.entries) if tt == tw), None)
-                if idx is not None:
-                    rf.destroy()
-                    del t.entries[idx]
-                    if idx-1 >= 0:
-                        t.entries[idx-1][0].focus_set()
-                    else:
-                        if not t.entries:
-                            self.add_input_row(t)
-                return "break"
-            return None
+    def schedule_background(self, tab):
+        """
+        还有未完成的重算或布局时，安排在空闲时继续
+        :param tab: 标签页框架
+        """
+        if tab.background_job is None and (tab.graph.dirty or tab.layout_dirty or tab.layout_sweep is not None):
+            tab.background_job = self.root.after_idle(lambda t=tab: self.run_background_update(t))
 
-        # 绑定退格键事件
-        text.bind("<KeyPress-BackSpace>", on_backspace)
+    def run_background_update(self, tab):
+        """
+        空闲时继续重算剩余的行，并测量屏幕外的行
+        :param tab: 标签页框架
+        """
+        tab.background_job = None
+        deadline = time.perf_counter() + FRAME_BUDGET
+        if tab.graph.dirty:
+            touched = tab.graph.recalculate(deadline=deadline)
+            tab.layout_dirty.update(tab.graph.rows[i] for i in touched)
+        self.flush_layout(tab, deadline)
+        self.render_rows(tab)
+        self.schedule_background(tab)
+        self.show_profile()
 
-        def on_return(event, t=tab, tw=text):
-            """
-            处理回车键事件，添加新行
-            """
-            self.add_input_row(t)
-            # 设置焦点到新添加的行
-            for i, (text_widget, _, _) in enumerate(t.entries):
-                if text_widget == tw and i + 1 < len(t.entries):
-                    t.entries[i + 1][0].focus_set()
-                    break
-            return "break"
+    # ================= 计算逻辑 =================
+    def sync_row(self, tab, slot):
+        """
+        把行控件的当前内容同步到数据模型，内容变化的行会被标记为待重算
+        :param tab: 标签页框架
+        :param slot: 行控件
+        """
+        node = slot.node
+        if node is None or not tab.graph.alive(node):
+            return
+        content = slot.text.get("1.0", "end-1c")
+        old = node.text
+        if tab.graph.set_text(node.index, content):
+            self.journal_append("set", sheet=tab.position, row=node.index, text=content)
+            self.record_edit(tab, node.index, (old,), (content,), typing=True)
+            self.highlight_row(slot.text, content)
 
-        # 绑定回车键事件
-        text.bind("<Return>", on_return)
+    def sync_pending(self, tab):
+        """
+        同步所有尚未同步的行控件
+        :param tab: 标签页框架
+        """
+        for slot in tab.pending_rows:
+            self.sync_row(tab, slot)
+        tab.pending_rows.clear()
 
-        # 设置焦点并调整大小
-        text.focus_set()
-        self.root.update_idletasks()
-        self.adjust_row_size(tab, text, result_label)
-        self.update_all(tab)
+    def highlight_row(self, text_widget, content):
+        """
+        根据词法分析结果把注释标记为绿色
+        :param text_widget: 文本控件
+        :param content: 行文本
+        """
+        started = self.profiler.start()
+        text_widget.tag_remove("comment", "1.0", "end")
+        for start, end in comment_spans(content):
+            text_widget.tag_add("comment", f"1.0+{start}c", f"1.0+{end}c")
+        self.profiler.stop("高亮", started)
 
-    def copy_result(self, result_label):
+    def update_all(self, tab):
         """
-        双击复制结果到剪贴板
-        :param result_label: 结果标签控件
+        增量更新计算结果：只重算被修改的行及其下游依赖行，并刷新可见行
+        :param tab: 标签页框架
         """
-        # 获取标签文本并去除前缀"= "
-        result_text = result_label.cget("text")
-        if result_text.startswith("= "):
-            result_text = result_text[2:]
+        self.sync_pending(tab)
+        touched = tab.graph.recalculate()
+        tab.layout_dirty.update(tab.graph.rows[i] for i in touched)
+        self.render_rows(tab)
+        self.schedule_background(tab)
 
-        # 对于变量赋值格式 "= var_name → value"，只提取值部分
-        if " → " in result_text:
-            # 提取箭头后的值部分
-            result_text = result_text.split(" → ", 1)[1]
+    def result_text(self, node):
+        """
+        生成结果标签的显示文本：按当前的显示方式格式化，长度不超过 RESULT_MAX_CHARS；
+        结果未变时直接使用上次生成的文本
+        :param node: 行状态
+        """
+        if node.job is not None and node.kind != "empty":
+            return "= 计算中…"
+        key = (node.kind, node.name, node.ok, node.error, self.result_style)
+        display = node.display
+        if display is not None and display[0] is node.value and display[1] == key:
+            return display[2]
+        text = describe_result(node.kind, node.name, node.ok, node.value, node.error, self.result_style)
+        if len(text) > RESULT_MAX_CHARS:
+            text = text[:RESULT_MAX_CHARS - 1] + "…"
+        node.display = (node.value, key, text)
+        return text
 
-        # 复制到剪贴板
-        self.root.clipboard_clear()
-        self.root.clipboard_append(result_text)
-        self.root.update()
+    def set_result_style(self, digits=None, notation=None):
+        """
+        修改结果的显示方式（有效数字位数、记数法），所有行按新的方式重新显示
+        :param digits: 有效数字位数
+        :param notation: 记数法，RESULT_NOTATIONS 中的键
+        """
+        style = self.result_style._replace(
+            digits=self.result_style.digits if digits is None else max(MIN_RESULT_DIGITS, min(MAX_RESULT_DIGITS, digits)),
+            notation=notation or self.result_style.notation)
+        if style != self.result_style:
+            self.result_style = style
+            for tab in self.sheet_order:
+                if not tab.built:
+                    continue
+                # 可见行立即刷新，其余的行空闲时逐批重新测量
+                tab.layout_dirty.clear()
+                tab.layout_sweep = 0
+                self.render_rows(tab)
+                self.schedule_background(tab)
+        self.status.config(text=f"结果显示 {style.digits} 位有效数字，{RESULT_NOTATIONS[style.notation]}")
+        return "break"
 
+    def cycle_notation(self):
+        """
+        Ctrl+Shift+E：依次切换自动、科学记数法、工程记数法
+        """
+        notations = list(RESULT_NOTATIONS)
+        return self.set_result_style(notation=notations[(notations.index(self.result_style.notation) + 1) % len(notations)])
 
-    def adjust_row_size(self, tab, text_widget, result_label):
+    # ================= 后台计算 =================
+    def submit_row(self, tab, node, expr, variables):
         """
-        调整输入行大小以适应内容
+        把一行交给后台进程计算
         :param tab: 标签页框架
-        :param text_widget: 文本控件
-        :param result_label: 结果标签
+        :param node: 行
+        :param expr: 表达式
+        :param variables: 表达式用到的变量
+        :return: 任务号
         """
+        job = self.pool.submit(evaluate_expression, (expr, variables),
+                               lambda job, ok, value, error, t=tab, n=node: self.on_row_result(t, n, job, ok, value, error))
+        self.schedule_pool_poll()
+        return job
 
-        def pixel_to_chars(pixel, font):
-            """
-            把像素宽度转换为 Text.width 的字符数（基于 '0' 的像素宽做二分查找）
-            :param pixel: 像素数
-            :param font: 字体
-            :return: 字符数
-            """
-            if pixel <= 0:
-                return 1
-            zero_w = font.measure("0") or 7
-            # upper bound 初始估计
-            hi = max(1, int(pixel / zero_w) + 3)
-            # 保证 hi 足够大
-            while font.measure("0" * hi) < pixel:
-                hi *= 2
-            lo = 1
-            while lo < hi:
-                mid = (lo + hi) // 2
-                if font.measure("0" * mid) < pixel:
-                    lo = mid + 1
-                else:
-                    hi = mid
-            return max(1, lo)
+    def schedule_pool_poll(self):
+        """
+        安排定时收取后台计算结果
+        """
+        if self.pool_job is None:
+            self.pool_job = self.root.after(POOL_POLL_MS, self.poll_pool)
 
-        # 更新界面
-        self.root.update_idletasks()
-        font = tkfont.Font(font=text_widget['font'])
+    def poll_pool(self):
+        """
+        定时收取后台计算结果，直到没有未完成的任务
+        """
+        self.pool_job = None
+        self.pool.poll()
+        if self.pool.busy():
+            self.pool_job = self.root.after(POOL_POLL_MS, self.poll_pool)
 
-        # 获取文本内容
-        content = text_widget.get("1.0", "end-1c")
-        lines = content.split("\n") if content else [""]
+    def on_row_result(self, tab, node, job, ok, value, error):
+        """
+        后台计算完成：写入结果，并安排下游行重算、刷新显示
+        """
+        if not self.sheet_alive(tab):
+            return  # 标签页已删除
+        if not tab.graph.complete(node, job, ok, value, error):
+            return  # 过期的结果
+        if tab.built:
+            tab.layout_dirty.add(node)
+            self.schedule_update(tab)
+        else:
+            self.schedule_warm()
 
-        # === 临时关闭自动换行以测量逻辑行的完整像素宽 ===
-        old_wrap = text_widget.cget("wrap")
-        try:
-            text_widget.config(wrap="none")
-            self.root.update_idletasks()
-
-            def measure_line_by_bbox(line_index, line_text):
-                """
-                尝试用 bbox 测量整行像素宽，失败则回退到逐字符累计
-                :param line_index: 行索引
-                :param line_text: 行文本
-                :return: 像素宽度
-                """
-                if not line_text:
-                    return font.measure("0")  # 空行设为一个最小宽度
-                start_idx = f"{line_index}.0"
-                end_idx = f"{line_index}.end-1c"
-                try:
-                    bbox_start = text_widget.bbox(start_idx)
-                    bbox_end = text_widget.bbox(end_idx)
-                    if bbox_start and bbox_end:
-                        x_start = bbox_start[0]
-                        x_end = bbox_end[0] + bbox_end[2]
-                        # 有时 bbox 的 x 起点并非 0（存在内部 padding），直接取差值
-                        return max(0, x_end - x_start)
-                except Exception:
-                    pass
-                # 回退：逐字符测量（较慢，但稳妥）
-                return sum(font.measure(ch) for ch in line_text)
+    def recompute_workbook(self, tabs=None):
+        """
+        整个工作簿重算：每个 sheet 作为一个任务交给进程池并行计算，结果合并回各标签页，
+        全部完成后在状态栏显示吞吐量
+        :param tabs: 要重算的标签页，默认为全部
+        """
+        if tabs is None:
+            tabs = list(self.sheet_order)
+        run = {"started": time.perf_counter(), "sheets": len(tabs), "rows": 0, "pending": len(tabs)}
+        self.recompute = run
+        for tab in tabs:
+            if tab.remote is not None:
+                self.pool.cancel(tab.remote)
+            if tab.built:
+                self.sync_pending(tab)
+            # 尚未载入的 sheet 直接传行数据（未解码的行由计算进程自己从文件读取）
+            texts = tab.contents if tab.graph is None else [node.text for node in tab.graph.rows]
+            run["rows"] += len(texts)
+            tab.remote = self.pool.submit(
+                evaluate_sheet, (texts,),
+                lambda job, ok, value, error, t=tab, x=texts: self.on_sheet_result(t, job, x, ok, value, error),
+                timeout=SHEET_TIMEOUT)
+        self.schedule_pool_poll()
+        self.status.config(text=f"正在重算 {len(tabs)} 个 sheet…")
 
-            # 计算最长行的像素宽度
-            longest_pixel = max((measure_line_by_bbox(i + 1, lines[i]) for i in range(len(lines))), default=0)
-        finally:
-            # 恢复原来的换行设置
-            text_widget.config(wrap=old_wrap)
-            self.root.update_idletasks()
+    def on_sheet_result(self, tab, job, texts, ok, results, error):
+        """
+        一个 sheet 在后台算完：内容未被修改时直接采用结果，否则由界面进程增量重算
+        """
+        if tab.remote != job:
+            return  # 已被新的重算取代
+        tab.remote = None
+        if self.sheet_alive(tab):
+            self.ensure_model(tab)
+            if ok and [node.text for node in tab.graph.rows] == list(texts):
+                tab.graph.load_results(results)
+                if tab.built:
+                    tab.layout_sweep = 0
+                    self.render_rows(tab)
+            elif not ok:
+                tab.graph.invalidate_all()
+            if tab.built:
+                self.schedule_background(tab)
+            else:
+                self.schedule_warm()
+        self.sheet_job_done()
 
-        # 计算可用像素宽度 = 画布宽 - 结果标签宽 - padding
-        canvas_w = tab.canvas.winfo_width()
-        if canvas_w <= 1:
-            canvas_w = max(self.root.winfo_width(), 300)
-        result_req = result_label.winfo_reqwidth()
-        padding = 30
-        available_pixel = max(60, canvas_w - result_req - padding)
+    def sheet_job_done(self):
+        """
+        工作簿重算中的一个 sheet 结束（完成或取消），全部结束后报告吞吐量
+        """
+        run = self.recompute
+        run["pending"] -= 1
+        if run["pending"] == 0:
+            self.report_recompute(run)
 
-        # 给一点额外 margin 防止紧贴
-        margin_pixel = 6
-        needed_pixel = longest_pixel + margin_pixel
+    def report_recompute(self, run):
+        """
+        在状态栏显示工作簿重算的吞吐量
+        """
+        elapsed = max(time.perf_counter() - run["started"], 1e-9)
+        run["seconds"] = elapsed
+        run["rows_per_second"] = run["rows"] / elapsed
+        run["workers"] = min(self.pool.size, run["sheets"])
+        self.status.config(text=f"重算 {run['sheets']} 个 sheet、{run['rows']} 行，用时 {elapsed:.2f} 秒"
+                                f"（{run['rows_per_second']:.0f} 行/秒，{run['workers']} 个进程）")
 
-        # 根据内容长度决定是否换行
-        if needed_pixel <= available_pixel:
-            # 一行能完整显示，不需要换行
-            width_chars = pixel_to_chars(needed_pixel, font)
-            height_lines = max(1, len(lines))
+    # ================= 性能分析 =================
+    def set_profiling(self, enabled):
+        """
+        开启或关闭性能分析：开启时为各依赖图设置计时回调，并在状态栏上方显示最近一次操作的统计
+        :param enabled: 是否开启
+        """
+        self.profiler.enabled = enabled
+        self.profiler.begin()
+        for tab in self.sheet_order:
+            graph = tab.graph
+            if graph is not None:
+                self.profile_graph(graph)
+        if enabled:
+            self.profile_status.config(text="性能分析已开启（Ctrl+F12 导出 trace）")
+            self.profile_status.pack(fill="x", side="bottom", before=self.notebook)
         else:
-            # 宽度受限，需要换行：以 available_pixel 为列宽换算列数，并估算需要的行数
-            width_chars = pixel_to_chars(available_pixel - 2, font)  # 留一点余量
-            # 需要的视觉行数 = ceil(最长行像素 / available_pixel)
-            height_lines = max(1, math.ceil(longest_pixel / max(1, available_pixel)))
+            self.profile_status.pack_forget()
 
-        # 设置文本控件的宽度和高度
-        try:
-            text_widget.config(width=width_chars, height=height_lines)
-        except Exception:
-            pass
+    def profile_graph(self, graph):
+        """
+        按性能分析是否开启设置依赖图的计时回调
+        :param graph: 依赖图
+        """
+        if self.profiler.enabled:
+            graph.timer = lambda node, started, parse, compute, g=graph: self.profiler.row(g, node, started, parse, compute)
+        else:
+            graph.timer = None
 
-    def on_canvas_configure(self, tab):
+    def show_profile(self):
         """
-        处理画布配置事件，更新滚动区域
-        :param tab: 标签页框架
+        刷新性能分析浮层
         """
-        tab.canvas.configure(scrollregion=tab.canvas.bbox("all"))
+        if self.profiler.enabled and self.profiler.phases:
+            self.profile_status.config(text=self.profiler.summary())
 
-    # ================= 计算逻辑 =================
-    def update_all(self, tab):
+    def export_trace(self):
         """
-        更新所有计算结果
-        :param tab: 标签页框架
+        把性能分析记录导出为 Chrome trace 文件（保存在状态文件所在目录）
+        """
+        if not self.profiler.events:
+            self.status.config(text="没有性能分析记录（按 F12 开启性能分析）")
+            return
+        path = f"varcalc-trace-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        try:
+            self.profiler.export(path)
+        except OSError as e:
+            self.status.config(text=f"导出失败：{e}")
+            return
+        self.status.config(text=f"性能分析记录已导出到 {os.path.abspath(path)}")
+
+    # ================= 保存/恢复 =================
+    def journal_append(self, op, **fields):
         """
-        # 清空变量字典
-        tab.variables.clear()
-        # 获取所有行的内容
-        rows = [(text.get("1.0", "end-1c").strip(), text, label) for text, label, _ in tab.entries]
-        # 定义注释模式
-        comment_pattern = r'"[^"]*"'
+        记录一次编辑，延迟一段时间后与其他编辑一起写入日志
+        :param op: 操作类型（add_sheet / rename_sheet / delete_sheet / insert / delete / set）
+        :param fields: 操作参数（sheet 为标签页序号，row 为行号）
+        """
+        self.journal_seq += 1
+        fields["seq"] = self.journal_seq
+        fields["op"] = op
+        self.journal_buffer.append(json.dumps(fields, ensure_ascii=False) + "\n")
+        if self.journal_job is None:
+            self.journal_job = self.root.after(JOURNAL_FLUSH_MS, self.flush_journal)
 
-        # 处理每一行
-        for expr, text_widget, label in rows:
-            # 清除旧的注释标记
-            text_widget.tag_remove("comment", "1.0", "end")
+    def flush_journal(self, compact=True):
+        """
+        把缓冲的编辑追加写入日志并落盘；日志过大时在后台合并为快照
+        :param compact: 是否检查日志大小并开始合并（开始合并时写出缓冲为 False，避免重复开始）
+        """
+        if self.journal_job is not None:
+            self.root.after_cancel(self.journal_job)
+            self.journal_job = None
+        if not self.journal_buffer:
+            return
+        started = self.profiler.start()
+        data = "".join(self.journal_buffer).encode("utf-8")
+        self.journal_buffer.clear()
+        with open(JOURNAL_FILE, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_size += len(data)
+        self.profiler.stop("日志", started)
+        if compact and self.journal_size > JOURNAL_COMPACT_BYTES and self.compaction is None:
+            self.start_compaction()
 
-            # 如果表达式为空，显示默认值
-            if not expr:
-                label.config(text="= ?")
-                continue
+    def snapshot_state(self):
+        """
+        构建当前状态数据（包含日志序号，重放时跳过快照已包含的记录）
+        """
+        tabs = list(self.sheet_order)
+        # 先同步正在编辑的行，产生的日志记录也包含在快照中
+        for tab_widget in tabs:
+            if tab_widget.built:
+                self.sync_pending(tab_widget)
+        state = {"seq": self.journal_seq, "window": {"geometry": self.root.winfo_geometry(), "font_size": self.font_size,
+                                                     "result_style": list(self.result_style)},
+                 "tabs": []}
+        for tab_widget in tabs:
+            title = tab_widget.title
+            if tab_widget.graph is None:
+                contents = list(tab_widget.contents)
+                results = list(tab_widget.results) if tab_widget.results else []
+            else:
+                contents = [node.text for node in tab_widget.graph.rows]
+                results = tab_widget.graph.cache_entries()
+            state["tabs"].append({"title": title, "contents": contents, "results": results})
+        # 所有行都已解码，写快照前释放对状态文件的映射
+        self.close_workbook()
+        return state
 
-            # 标记注释为绿色
-            for m in re.finditer(comment_pattern, expr):
-                start_idx = f"1.0+{m.start()}c"
-                end_idx = f"1.0+{m.end()}c"
-                text_widget.tag_add("comment", start_idx, end_idx)
+    def close_workbook(self):
+        """
+        关闭打开的二进制工作簿
+        """
+        if self.workbook is not None:
+            self.workbook.close()
+            self.workbook = None
 
-            # 生成计算表达式：去掉注释
-            calc_expr = re.sub(comment_pattern, "", expr)
+    def start_compaction(self):
+        """
+        在后台线程中把当前状态写成快照，完成后丢弃快照已包含的日志；
+        同一时间只有一个合并线程写临时快照文件
+        """
+        if self.compaction is not None:
+            return
+        state = self.snapshot_state()
+        # 同步正在编辑的行时产生的记录也写入日志，但不能在这里再次开始合并
+        self.flush_journal(compact=False)
+        result = []
 
+        def work():
             try:
-                # 如果包含等号且不以问号结尾，则为变量赋值
-                if "=" in calc_expr and not calc_expr.endswith("?") and not calc_expr.endswith("？"):
-                    var, val = calc_expr.split("=",1)
-                    var = var.strip()
-                    val = val.strip()
-                    calc_val = self.safe_eval(val, tab.variables)
-                    if calc_val is not None:
-                        tab.variables[var] = calc_val
-                        label.config(text=f"= {var} → {calc_val}")
-                    else:
-                        label.config(text="= 错误")
-                else:
-                    # 否则为表达式计算
-                    calc_expr = calc_expr.rstrip("?？").strip()
-                    for var, val in tab.variables.items():
-                        calc_expr = re.sub(r"\b"+re.escape(var)+r"\b", str(val), calc_expr)
-                    calc_val = self.safe_eval(calc_expr, tab.variables)
-                    if calc_val is not None:
-                        label.config(text=f"= {calc_val}")
-                    else:
-                        label.config(text="= 错误")
-            except Exception:
-                label.config(text="= 错误")
+                write_snapshot(state)
+                result.append(True)
+            except OSError:
+                result.append(False)
 
-        # 更新界面
-        self.root.update_idletasks()
-        for text_widget, label, _ in tab.entries:
-            self.adjust_row_size(tab, text_widget, label)
+        thread = threading.Thread(target=work, daemon=True)
+        self.compaction = (thread, self.journal_size, result)
+        thread.start()
+        self.root.after(COMPACT_POLL_MS, self.finish_compaction)
 
-    def safe_eval(self, expr, variables):
+    def finish_compaction(self):
         """
-        安全计算表达式
-        :param expr: 表达式
-        :param variables: 变量字典
-        :return: 计算结果或None
+        后台快照写完后，只保留快照之后追加的日志
         """
-        try:
-            expr = expr.strip()
-            if expr == "":
-                return None
-            # 定义允许的字符模式
-            allowed_re = re.compile(r'^[0-9+\-*/().\s]+$')
-            if allowed_re.match(expr):
-                # 只包含基本数学运算符的表达式
-                return eval(expr, {"__builtins__": None}, {})
-            else:
-                # 包含变量的表达式
-                return eval(expr, {"__builtins__": None}, variables)
-        except Exception:
-            return None
+        if self.compaction is None:
+            return
+        thread, offset, result = self.compaction
+        if thread.is_alive():
+            self.root.after(COMPACT_POLL_MS, self.finish_compaction)
+            return
+        self.compaction = None
+        if not result or not result[0]:
+            return
+        with open(JOURNAL_FILE, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        tmp = JOURNAL_FILE + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, JOURNAL_FILE)
+        self.journal_size = len(tail)
 
-    # ================= 保存/恢复 =================
     def save_state(self):
         """
-        保存程序状态到文件
+        保存程序状态到文件，并删除已包含在快照中的日志
         """
-        # 构建状态数据结构
-        state = {"window":{"geometry":self.root.winfo_geometry()}, "tabs":[]}
-        for i, tab_id in enumerate(self.notebook.tabs()):
-            tab_widget = self.notebook.nametowidget(tab_id)
-            title = self.notebook.tab(tab_id, "text")
-            contents = [text.get("1.0","end-1c") for text,_,_ in tab_widget.entries]
-            state["tabs"].append({"title":title,"contents":contents})
-        # 写入文件
-        with open(STATE_FILE,"w",encoding="utf-8") as f:
-            json.dump(state,f,ensure_ascii=False,indent=2)
+        self.profiler.begin("保存")
+        started = self.profiler.start()
+        if self.compaction is not None:
+            self.compaction[0].join()
+            self.compaction = None
+        state = self.snapshot_state()
+        if self.journal_job is not None:
+            self.root.after_cancel(self.journal_job)
+            self.journal_job = None
+        self.journal_buffer.clear()
+        write_snapshot(state)
+        if os.path.exists(JOURNAL_FILE):
+            os.remove(JOURNAL_FILE)
+        self.journal_size = 0
+        self.profiler.stop("保存", started)
+        self.show_profile()
 
     def load_state(self):
         """
-        从文件加载程序状态
+        从文件加载程序状态；上次未正常退出时重放日志中的编辑
         """
-        # 读取状态文件
-        with open(STATE_FILE,"r",encoding="utf-8") as f:
-            state = json.load(f)
+        self.profiler.begin("打开")
+        started = self.profiler.start()
+        # 读取状态文件：二进制工作簿只读取文件头，各 sheet 的行在用到时才解码
+        state = {"tabs": []}
+        if os.path.exists(STATE_FILE):
+            self.workbook = BinaryWorkbook(STATE_FILE)
+            state = self.workbook.state()
+        elif os.path.exists(LEGACY_STATE_FILE):
+            with open(LEGACY_STATE_FILE,"r",encoding="utf-8") as f:
+                state = json.load(f)
+        # 上次未正常退出：重放日志后立即写成快照，之后的记录接着日志的序号继续编号
+        if os.path.exists(JOURNAL_FILE):
+            self.journal_seq = replay_journal(state, read_journal(JOURNAL_FILE))
+            materialize(state)
+            self.close_workbook()
+            write_snapshot(state)
+            os.remove(JOURNAL_FILE)
+        else:
+            self.journal_seq = state.get("seq", 0)
         # 恢复窗口几何信息
         if "window" in state and "geometry" in state["window"]:
             try:
                 self.root.geometry(state["window"]["geometry"])
             except Exception:
                 pass
-        # 恢复标签页
+        # 恢复缩放
+        font_size = state.get("window", {}).get("font_size")
+        if isinstance(font_size, int) and MIN_FONT_SIZE <= font_size <= MAX_FONT_SIZE and font_size != self.font_size:
+            self.font_size = font_size
+            self.update_font()
+        # 恢复结果的显示方式
+        style = state.get("window", {}).get("result_style")
+        if (isinstance(style, list) and len(style) == 2 and isinstance(style[0], int)
+                and MIN_RESULT_DIGITS <= style[0] <= MAX_RESULT_DIGITS and style[1] in RESULT_NOTATIONS):
+            self.result_style = ResultStyle(*style)
+        # 恢复标签页：只有当前显示的标签页立即创建控件，其余的在首次选中时创建
         for sheet in state.get("tabs",[]):
-            self.add_tab(title=sheet["title"], contents=sheet["contents"])
+            self.add_tab(title=sheet["title"], contents=sheet["contents"], lazy=True, results=sheet.get("results"))
+        # 有结果缓存的 sheet 只重算哈希不一致的行；其余的 sheet 总行数较多时交给进程池并行计算，
+        # 较少时在空闲时直接计算
+        uncached = [(tab, sheet) for tab, sheet in zip(self.sheet_order, state.get("tabs", []))
+                    if not sheet.get("results")]
+        if sum(len(sheet["contents"]) for _, sheet in uncached) >= PARALLEL_MIN_ROWS:
+            self.recompute_workbook([tab for tab, _ in uncached])
+        self.build_tab(self.current_tab())
+        self.schedule_warm()
+        self.profiler.stop("打开", started)
+        self.show_profile()
 
     def on_close(self):
         """
@@ -624,12 +5615,23 @@ class VariableCalculator:
             self.save_state()
         except Exception:
             pass
+        self.pool.shutdown()
         self.root.destroy()
 
 
 
 
 if __name__ == "__main__":
+    # 转换状态文件格式：python 变量计算器.py convert state.json state.vcb
+    if len(sys.argv) == 4 and sys.argv[1] == "convert":
+        convert_state(sys.argv[2], sys.argv[3])
+        sys.exit()
+    # 命令行批量计算：python 变量计算器.py eval state.vcb --format csv
+    if len(sys.argv) > 1 and sys.argv[1] == "eval":
+        sys.exit(batch_main(sys.argv[2:]))
+    # 本地计算服务：python 变量计算器.py serve state.vcb --port 8765
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        sys.exit(serve_main(sys.argv[2:]))
     # 创建主窗口并运行程序
     root = tk.Tk()
     root.geometry("900x600")
@@ -0,0 +1,413 @@
+"""
+VarCalc 性能测试：生成不同规模的合成工作簿，测量
+  - 计算吞吐量（整个 sheet 从头计算，行/秒）
+  - 按键到结果的延迟（模拟在一行中输入一个字符，直到该行结果刷新、以及所有下游行算完）
+  - load_state / save_state 用时（首次打开、保存、带结果缓存再次打开）
+  - 峰值内存
+每个测试用例在单独的子进程中运行，峰值内存互不影响；结果写入 JSON 文件，便于比较不同版本。
+
+用法：
+    python 性能测试.py                                # 全部用例，结果写入 benchmark-<时间>.json
+    python 性能测试.py --rows 10 1000 --case chain    # 只运行部分规模 / 部分用例
+    python 性能测试.py --target /tmp/old/变量计算器.py  # 测试其他版本（例如 git worktree 中的旧版本）
+    python 性能测试.py --compare old.json new.json    # 比较两次结果，有指标变慢超过阈值时返回 1
+没有显示器的 Linux 上自动启动 Xvfb 虚拟显示（也可以用 xvfb-run 运行）。
+"""
+import argparse
+import datetime
+import importlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows 上没有 resource 模块，不记录峰值内存
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TARGET = os.path.join(HERE, "变量计算器.py")
+
+SIZES = (10, 1000, 10000, 100000)   # 默认测试的行数
+KEYSTROKES = 10                      # 每个位置（首行、中间、末行）模拟的按键次数
+SETTLE_TIMEOUT = 600.0               # 等待计算完成的最长时间（秒）
+CASE_TIMEOUT = 3600.0                # 单个用例子进程的最长运行时间（秒）
+REGRESSION_THRESHOLD = 0.2           # 比较时变慢超过该比例视为性能退化
+XVFB_SCREEN = "1280x1024x24"
+
+# 用例：(名称, 变量个数（None 为每行一个）, 依赖深度（None 为整表一条链）, 带注释的行比例)
+CASES = (
+    ("flat", None, 1, 0.0),         # 互不依赖的常量行
+    ("chain", None, None, 0.0),     # 每行依赖上一行，修改首行时所有行都要重算
+    ("layered", 100, 20, 0.3),      # 100 个变量反复重新定义，依赖链长 20
+    ("commented", None, 10, 1.0),   # 每行都带注释
+)
+
+# 合成表达式中使用的运算（结尾都是数字，模拟按键时在数字后追加一位）
+OPERATIONS = ("{a} + {k}", "{a} * 1.0001 + {k}", "({a} - {k}) / 2 + {k}", "{a} + {b} * 0.5 + {k}", "max({a}, {b}) + {k}")
+
+
+# ================= 合成工作簿 =================
+def make_sheet(rows, variables=None, depth=None, comments=0.0, seed=0):
+    """
+    生成合成 sheet 的行文本
+    :param rows: 行数
+    :param variables: 不同变量名的个数，少于行数时变量被反复重新定义；None 为每行一个变量
+    :param depth: 依赖链长度：每 depth 行从常量重新开始，每行引用上一行；None 为整表一条链
+    :param comments: 带注释的行所占比例
+    :param seed: 随机数种子，相同参数生成相同的 sheet
+    :return: 行文本列表
+    """
+    rng = random.Random(seed)
+    variables = max(1, min(variables or rows, rows))
+    depth = depth or rows
+    texts = []
+    for i in range(rows):
+        name = f"v{i % variables}"
+        level = i % depth
+        if level == 0:
+            text = f"{name} = {rng.randint(1, 99)}"
+        else:
+            operation = OPERATIONS[rng.randrange(len(OPERATIONS) if level > 1 else 3)]
+            text = f"{name} = " + operation.format(a=f"v{(i - 1) % variables}", b=f"v{(i - 2) % variables}",
+                                                   k=rng.randint(1, 9))
+        if rng.random() < comments:
+            text += ' "' + "说明" * rng.randint(1, 8) + f' {i}"'
+        texts.append(text)
+    return texts
+
+
+def edit_position(text):
+    """
+    模拟按键的位置：表达式结尾的数字之后（注释之前）
+    """
+    end = text.find(' "')
+    return len(text) if end < 0 else end
+
+
+# ================= 单个用例（子进程中运行） =================
+def load_target(target):
+    """
+    导入被测试的程序模块；计算进程也按模块名导入，因此通过 sys.path 导入而不是直接执行文件
+    :param target: 程序文件路径
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(target)))
+    return importlib.import_module(os.path.splitext(os.path.basename(target))[0])
+
+
+def pump(root, done, timeout=SETTLE_TIMEOUT):
+    """
+    运行事件循环直到 done() 为真
+    :return: 用时（秒）
+    """
+    started = time.perf_counter()
+    while not done():
+        root.update()
+        if time.perf_counter() - started > timeout:
+            raise TimeoutError("等待计算完成超时")
+        time.sleep(0.0005)  # 让出 CPU 给计算进程
+    return time.perf_counter() - started
+
+
+def settled(app):
+    """
+    所有 sheet 都已算完、布局完成，且没有待执行的任务
+    """
+    if app.warm_job is not None or app.pool.busy():
+        return False
+    for tab_id in app.notebook.tabs():
+        tab = app.notebook.nametowidget(tab_id)
+        if tab.remote is not None or tab.graph is None or tab.graph.dirty:
+            return False
+        if tab.built and (tab.update_job is not None or tab.background_job is not None
+                          or tab.layout_dirty or tab.layout_sweep is not None):
+            return False
+    return True
+
+
+def open_app(vc, tk):
+    """
+    创建窗口并打开当前目录下的状态文件
+    :return: (根窗口, 程序, 到首次显示的用时, 到全部算完的用时)
+    """
+    started = time.perf_counter()
+    root = tk.Tk()
+    root.geometry("900x600")
+    app = vc.VariableCalculator(root)
+    root.update()
+    opened = time.perf_counter() - started
+    return root, app, opened, opened + pump(root, lambda: settled(app))
+
+
+def close_app(root, app):
+    app.pool.shutdown()
+    app.close_workbook()
+    root.destroy()
+
+
+def stats(samples):
+    """
+    延迟统计（毫秒）
+    """
+    ordered = sorted(samples)
+    return {"n": len(ordered), "median": statistics.median(ordered),
+            "p95": ordered[min(len(ordered) - 1, round(0.95 * (len(ordered) - 1)))], "max": ordered[-1]}
+
+
+def measure_keystrokes(app, root, count):
+    """
+    在首行、中间行和末行分别模拟按键：在行文本中插入一个字符并触发 KeyRelease，
+    测量到该行结果刷新（result_ms）和所有下游行算完（settle_ms）的时间
+    :return: {位置: {"result_ms": 统计, "settle_ms": 统计}}
+    """
+    tab = app.current_tab()
+    rows = tab.graph.rows
+    measured = {}
+    for place, index in (("first", 0), ("middle", len(rows) // 2), ("last", len(rows) - 1)):
+        result_ms, settle_ms = [], []
+        for i in range(count):
+            app.scroll_into_view(tab, index)
+            app.render_rows(tab)
+            root.update()
+            slot = tab.bound[rows[index]]
+            before = slot.label.cget("text")
+            position = f"1.{edit_position(slot.text.get('1.0', 'end-1c'))}"
+            started = time.perf_counter()
+            # 交替输入和删除一个数字，行文本在两种内容之间切换
+            if i % 2 == 0:
+                slot.text.insert(position, "7")
+            else:
+                slot.text.delete(f"{position}-1c", position)
+            slot.text.event_generate("<KeyRelease>")
+            pump(root, lambda: slot.label.cget("text") != before)
+            result_ms.append((time.perf_counter() - started) * 1000)
+            pump(root, lambda: settled(app))
+            settle_ms.append((time.perf_counter() - started) * 1000)
+        measured[place] = {"result_ms": stats(result_ms), "settle_ms": stats(settle_ms)}
+    return measured
+
+
+def peak_memory(who):
+    """
+    峰值常驻内存（MB），不支持时为 None
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024  # macOS 上单位是字节，Linux 上是 KB
+
+
+def run_case(case, target, keystrokes):
+    """
+    运行一个用例并返回测量结果
+    :param case: 用例参数（见 case_list）
+    :param target: 被测试的程序文件
+    :param keystrokes: 每个位置的按键次数
+    """
+    import tkinter as tk
+    vc = load_target(target)
+    texts = make_sheet(case["rows"], case["variables"], case["depth"], case["comments"])
+    result = dict(case)
+
+    # 计算吞吐量：与计算进程中整表计算相同的路径，表达式编译缓存为空
+    started = time.perf_counter()
+    graph = vc.SheetGraph(vc.ExpressionEvaluator().evaluate)
+    graph.insert_many(0, texts)
+    graph.recalculate()
+    elapsed = time.perf_counter() - started
+    result["eval_s"] = elapsed
+    result["eval_rows_per_s"] = len(texts) / max(elapsed, 1e-9)
+    result["errors"] = sum(not node.ok for node in graph.rows)
+    del graph
+
+    with tempfile.TemporaryDirectory(prefix="varcalc-bench-") as workdir:
+        os.chdir(workdir)
+        vc.write_snapshot({"tabs": [{"title": "Sheet1", "contents": texts}]}, vc.STATE_FILE)
+        # 首次打开：没有结果缓存，所有行都要计算
+        root, app, result["load_s"], result["load_done_s"] = open_app(vc, tk)
+        result["keystroke"] = measure_keystrokes(app, root, keystrokes)
+        # 保存：写入内容和结果缓存
+        started = time.perf_counter()
+        app.save_state()
+        result["save_s"] = time.perf_counter() - started
+        result["state_bytes"] = os.path.getsize(vc.STATE_FILE)
+        close_app(root, app)
+        # 再次打开：内容未变化的行直接采用保存的结果
+        root, app, result["reload_s"], result["reload_done_s"] = open_app(vc, tk)
+        close_app(root, app)
+        os.chdir(HERE)
+
+    result["peak_rss_mb"] = peak_memory(resource.RUSAGE_SELF) if resource else None
+    result["peak_worker_rss_mb"] = peak_memory(resource.RUSAGE_CHILDREN) if resource else None
+    return result
+
+
+# ================= 运行全部用例 =================
+def case_list(sizes, names):
+    """
+    按规模和用例名展开用例
+    """
+    cases = []
+    for rows in sizes:
+        for name, variables, depth, comments in CASES:
+            if names and name not in names:
+                continue
+            cases.append({"name": f"{name}-{rows}", "rows": rows, "variables": variables,
+                          "depth": depth, "comments": comments})
+    return cases
+
+
+def ensure_display():
+    """
+    Linux 上没有显示器时启动 Xvfb 虚拟显示
+    :return: Xvfb 进程，不需要时为 None
+    """
+    if not sys.platform.startswith("linux") or os.environ.get("DISPLAY"):
+        return None
+    xvfb = shutil.which("Xvfb")
+    if xvfb is None:
+        sys.exit("没有显示器：请安装 Xvfb，或用 xvfb-run 运行")
+    for number in range(99, 199):
+        if os.path.exists(f"/tmp/.X{number}-lock"):
+            continue
+        process = subprocess.Popen([xvfb, f":{number}", "-screen", "0", XVFB_SCREEN, "-nolisten", "tcp"],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.perf_counter() + 10
+        while process.poll() is None and time.perf_counter() < deadline:
+            if os.path.exists(f"/tmp/.X11-unix/X{number}"):
+                os.environ["DISPLAY"] = f":{number}"
+                return process
+            time.sleep(0.05)
+        process.kill()
+    sys.exit("无法启动 Xvfb")
+
+
+def describe(target):
+    """
+    记录被测试的版本和运行环境
+    """
+    try:
+        version = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(target)),
+                                 capture_output=True, text=True, timeout=30).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        version = None
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {"target": os.path.abspath(target), "version": version,
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "numpy": numpy_version}
+
+
+def run_all(args):
+    """
+    每个用例在单独的子进程中运行，结果汇总写入 JSON 文件
+    """
+    xvfb = ensure_display()
+    report = {"meta": describe(args.target), "cases": []}
+    try:
+        for case in case_list(args.rows, args.case):
+            command = [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case),
+                       "--target", args.target, "--keystrokes", str(args.keystrokes)]
+            try:
+                process = subprocess.run(command, capture_output=True, text=True, timeout=CASE_TIMEOUT)
+                if process.returncode != 0:
+                    raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr.strip()
+                                       else f"退出码 {process.returncode}")
+                result = json.loads(process.stdout.strip().splitlines()[-1])
+            except Exception as e:
+                result = dict(case, error=str(e))
+            report["cases"].append(result)
+            print(summary(result), flush=True)
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+    output = args.output or f"benchmark-{datetime.datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"结果已写入 {output}")
+
+
+def summary(result):
+    """
+    一个用例的单行摘要
+    """
+    if "error" in result:
+        return f"{result['name']:<18} 失败：{result['error']}"
+    first = result["keystroke"]["first"]
+    return (f"{result['name']:<18} 计算 {result['eval_rows_per_s']:>9.0f} 行/秒  "
+            f"按键 {first['result_ms']['median']:>6.1f} ms（全部算完 {first['settle_ms']['median']:>8.1f} ms）  "
+            f"打开 {result['load_done_s']:>6.2f} s  保存 {result['save_s']:>6.2f} s  "
+            f"再次打开 {result['reload_done_s']:>6.2f} s  内存 {result['peak_rss_mb'] or 0:>6.0f} MB")
+
+
+# ================= 比较结果 =================
+def metrics(result, prefix=""):
+    """
+    把一个用例的结果展开为 {指标路径: 数值}
+    """
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(metrics(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and key not in ("rows", "variables", "depth",
+                                                                                            "comments", "n", "errors"):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(base_path, new_path, threshold):
+    """
+    比较两次结果：吞吐量越高越好，其余指标越低越好
+    :return: 是否有指标退化超过阈值
+    """
+    with open(base_path, encoding="utf-8") as f:
+        base = {case["name"]: case for case in json.load(f)["cases"]}
+    with open(new_path, encoding="utf-8") as f:
+        new = {case["name"]: case for case in json.load(f)["cases"]}
+    regressed = False
+    for name in [name for name in new if name in base]:
+        old_metrics, new_metrics = metrics(base[name]), metrics(new[name])
+        for key in sorted(set(old_metrics) & set(new_metrics)):
+            old, value = old_metrics[key], new_metrics[key]
+            if old <= 0:
+                continue
+            change = value / old - 1
+            worse = -change if key.endswith("_per_s") else change
+            mark = ""
+            if worse > threshold:
+                mark, regressed = "  ← 变慢", True
+            elif worse < -threshold:
+                mark = "  ← 变快"
+            print(f"{name:<18} {key:<36} {old:>12.4g} → {value:>12.4g}  {change:+7.1%}{mark}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VarCalc 性能测试")
+    parser.add_argument("--rows", type=int, nargs="+", default=list(SIZES), help="测试的行数")
+    parser.add_argument("--case", nargs="+", help="只运行指定的用例：" + "、".join(name for name, *_ in CASES))
+    parser.add_argument("--target", default=DEFAULT_TARGET, help="被测试的程序文件")
+    parser.add_argument("--keystrokes", type=int, default=KEYSTROKES, help="每个位置模拟的按键次数")
+    parser.add_argument("--output", help="结果文件，默认为 benchmark-<时间>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="比较两次结果")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="视为性能退化的变慢比例")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, args.threshold) else 0)
+    elif args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case), args.target, args.keystrokes)))
+    else:
+        run_all(args)